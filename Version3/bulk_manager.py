@@ -0,0 +1,422 @@
+# MirrorPost AI - 离线批量任务模块
+# 把大量海报请求打包成一个模型批处理任务（Batch API）提交，保存任务编号，轮询完成后把结果保存到 generated_posters
+# 适合通宵跑的活动素材：不追求交互延迟，换取更高的吞吐与更低的单价
+
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+from google.genai import types
+from PIL import Image
+
+from backend import IMAGE_MODEL, build_request, extract_images
+from client_manager import get_client
+from key_pool import key_pool, mask_key
+
+# 任务状态
+STATE_PENDING = "pending"
+STATE_RUNNING = "running"
+STATE_SUCCEEDED = "succeeded"
+STATE_FAILED = "failed"
+STATE_CANCELLED = "cancelled"
+STATE_EXPIRED = "expired"
+
+# 已结束的状态（不再轮询）
+FINISHED_STATES = {STATE_SUCCEEDED, STATE_FAILED, STATE_CANCELLED, STATE_EXPIRED}
+
+# Batch API 的任务状态 -> 本模块的任务状态
+_GENAI_STATES = {
+    "JOB_STATE_QUEUED": STATE_PENDING,
+    "JOB_STATE_PENDING": STATE_PENDING,
+    "JOB_STATE_RUNNING": STATE_RUNNING,
+    "JOB_STATE_UPDATING": STATE_RUNNING,
+    "JOB_STATE_PAUSED": STATE_RUNNING,
+    "JOB_STATE_SUCCEEDED": STATE_SUCCEEDED,
+    "JOB_STATE_PARTIALLY_SUCCEEDED": STATE_SUCCEEDED,
+    "JOB_STATE_FAILED": STATE_FAILED,
+    "JOB_STATE_CANCELLING": STATE_CANCELLED,
+    "JOB_STATE_CANCELLED": STATE_CANCELLED,
+    "JOB_STATE_EXPIRED": STATE_EXPIRED,
+}
+
+# 单个请求的结果：(图片列表, 错误信息)
+RequestResult = Tuple[List[Image.Image], Optional[str]]
+
+
+class GenaiBatchTransport:
+    """Batch API 传输层：通过 client.batches 提交、查询、取消任务（任务归属于提交它的 API Key）"""
+
+    def __init__(self, api_key: Optional[str] = None):
+        """
+        参数:
+            api_key (str): 提交 / 查询任务使用的 Key，默认取 Key 池中的第一个
+        """
+        self.api_key = api_key or key_pool.keys()[0]
+        self.client = get_client(self.api_key)
+
+    @property
+    def key_hint(self) -> str:
+        """保存到任务记录中的 Key 标识（脱敏），用于之后找回同一个 Key 查询任务"""
+        return mask_key(self.api_key)
+
+    def submit(self, requests: List[tuple], display_name: str) -> str:
+        """
+        提交批处理任务
+
+        参数:
+            requests (List[tuple]): (contents, config) 列表，每项生成一张海报
+            display_name (str): 任务显示名称
+
+        返回:
+            str: 服务端任务名称
+        """
+        job = self.client.batches.create(
+            model=IMAGE_MODEL,
+            src=[types.InlinedRequest(contents=contents, config=config) for contents, config in requests],
+            config=types.CreateBatchJobConfig(display_name=display_name)
+        )
+        return job.name
+
+    def state(self, job_name: str) -> str:
+        """查询任务状态（STATE_* 之一）"""
+        job = self.client.batches.get(name=job_name)
+        return _GENAI_STATES.get(job.state.name if job.state else "", STATE_PENDING)
+
+    def results(self, job_name: str) -> List[RequestResult]:
+        """获取已完成任务的结果，顺序与提交顺序一致"""
+        job = self.client.batches.get(name=job_name)
+        results = []
+        for inlined in (job.dest.inlined_responses if job.dest else None) or []:
+            # 单个请求失败只记录该项，不影响同一任务中其他请求的结果
+            if inlined.error:
+                results.append(([], str(inlined.error.message or inlined.error)))
+                continue
+            if inlined.response is None:
+                results.append(([], "服务端没有返回结果"))
+                continue
+            try:
+                images = extract_images(inlined.response)
+            except Exception as e:
+                results.append(([], f"结果解析失败: {str(e)}"))
+                continue
+            results.append((images, None if images else "内容安全过滤"))
+        return results
+
+    def cancel(self, job_name: str):
+        """取消任务"""
+        self.client.batches.cancel(name=job_name)
+
+
+class FakeBatchTransport:
+    """本地模拟的批处理服务：不调用模型，用于测试与演练整个提交 / 轮询 / 保存流程"""
+
+    def __init__(self, polls_until_done: int = 1, render=None):
+        """
+        参数:
+            polls_until_done (int): 任务在被查询多少次后完成
+            render (callable): render(contents, config) -> Image.Image，抛出异常表示该请求失败；
+                默认生成一张纯色占位图
+        """
+        self.polls_until_done = polls_until_done
+        self.render = render or self._placeholder
+        self.key_hint = "fake"
+        self._jobs: Dict[str, Dict] = {}
+
+    @staticmethod
+    def _placeholder(contents, config) -> Image.Image:
+        prompt = contents if isinstance(contents, str) else contents[0]
+        color = tuple(hash(prompt) >> shift & 0xFF for shift in (0, 8, 16))
+        return Image.new("RGB", (256, 256), color)
+
+    def submit(self, requests: List[tuple], display_name: str) -> str:
+        job_name = f"fakeBatches/{len(self._jobs) + 1}"
+        self._jobs[job_name] = {"requests": requests, "polls": 0, "cancelled": False}
+        return job_name
+
+    def state(self, job_name: str) -> str:
+        job = self._jobs.get(job_name)
+        if job is None:
+            return STATE_EXPIRED
+        if job["cancelled"]:
+            return STATE_CANCELLED
+        job["polls"] += 1
+        return STATE_SUCCEEDED if job["polls"] >= self.polls_until_done else STATE_RUNNING
+
+    def results(self, job_name: str) -> List[RequestResult]:
+        results = []
+        for contents, config in self._jobs[job_name]["requests"]:
+            try:
+                results.append(([self.render(contents, config)], None))
+            except Exception as e:
+                results.append(([], str(e)))
+        return results
+
+    def cancel(self, job_name: str):
+        self._jobs[job_name]["cancelled"] = True
+
+
+class BulkManager:
+    """离线批量任务管理器：提交、持久化、轮询任务并保存结果"""
+
+    def __init__(
+        self,
+        jobs_dir: str = "bulk_jobs",
+        output_dir: str = "generated_posters",
+        transport=None
+    ):
+        """
+        初始化批量任务管理器
+
+        参数:
+            jobs_dir (str): 任务记录存储目录（每个任务一个 JSON 文件）
+            output_dir (str): 结果图片保存目录（每个任务一个子目录）
+            transport: 传输层（需实现 submit / state / results / cancel），
+                默认使用 Batch API，可替换为 FakeBatchTransport 等本地实现
+        """
+        self.jobs_dir = jobs_dir
+        self.output_dir = output_dir
+        self.transport = transport
+        self._ensure_jobs_dir()
+
+    def _ensure_jobs_dir(self):
+        """确保任务目录存在"""
+        if not os.path.exists(self.jobs_dir):
+            os.makedirs(self.jobs_dir)
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _save_job(self, job: Dict):
+        """保存任务记录（先写临时文件再替换，避免中断时留下半个文件）"""
+        path = self._job_path(job["id"])
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def _transport_for(self, job: Optional[Dict] = None):
+        """获取传输层：查询已有任务时使用提交该任务的 Key"""
+        if self.transport is not None:
+            return self.transport
+        if job is not None:
+            for api_key in key_pool.keys():
+                if mask_key(api_key) == job["key"]:
+                    return GenaiBatchTransport(api_key)
+            raise ValueError(f"找不到提交任务 {job['id']} 时使用的 API Key（{job['key']}）")
+        key_pool.check()
+        return GenaiBatchTransport()
+
+    def submit(self, items: List[Dict], name: Optional[str] = None) -> str:
+        """
+        把多组海报请求打包成一个批处理任务提交
+
+        参数:
+            items (List[Dict]): 每组的参数，键同 generate_posters（user_prompt 必填，
+                另有 num_images、aspect_ratio、thinking_mode、style_prompt、reference_image、
+                logo_image、qrcode_image、slogan 等），每张海报对应任务中的一个请求
+            name (str): 任务名称，默认按时间生成
+
+        返回:
+            str: 本地任务编号（用于 poll / wait / cancel）
+        """
+        if not items:
+            raise ValueError("批量任务至少需要一组请求")
+
+        requests = []
+        request_items = []  # 每个请求属于第几组
+        summaries = []
+        for item_index, item in enumerate(items):
+            params = {key: value for key, value in item.items() if value is not None}
+            num_images = params.pop("num_images", 1)
+            request = build_request(**params)
+            requests.extend([request] * num_images)
+            request_items.extend([item_index] * num_images)
+            summaries.append({
+                "prompt": params["user_prompt"],
+                "aspect_ratio": params.get("aspect_ratio", "9:16"),
+                "num_images": num_images
+            })
+
+        job_id = datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:6]
+        name = name or f"mirrorpost-{job_id}"
+        transport = self._transport_for()
+        job_name = transport.submit(requests, name)
+
+        job = {
+            "id": job_id,
+            "name": name,
+            "job_name": job_name,
+            "key": transport.key_hint,
+            "state": STATE_PENDING,
+            "created_at": datetime.now().isoformat(),
+            "finished_at": None,
+            "items": summaries,
+            "request_items": request_items,
+            "files": [],
+            "errors": []
+        }
+        self._save_job(job)
+        print(f"批量任务已提交: {job_id}（{len(requests)} 张海报，{len(items)} 组）")
+        return job_id
+
+    def load_job(self, job_id: str) -> Optional[Dict]:
+        """
+        加载任务记录
+
+        返回:
+            Dict: 任务记录，不存在时返回 None
+        """
+        path = self._job_path(job_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def list_jobs(self) -> List[Dict]:
+        """列出所有任务记录（最新的在前）"""
+        jobs = []
+        for file_name in sorted(os.listdir(self.jobs_dir), reverse=True):
+            if file_name.endswith(".json"):
+                job = self.load_job(file_name[:-5])
+                if job:
+                    jobs.append(job)
+        return jobs
+
+    def poll(self, job_id: str) -> Dict:
+        """
+        查询一次任务状态；任务成功完成时下载结果并保存图片
+
+        返回:
+            Dict: 更新后的任务记录（files 为已保存的图片路径，errors 为失败的请求）
+        """
+        job = self.load_job(job_id)
+        if job is None:
+            raise ValueError(f"批量任务不存在: {job_id}")
+        if job["state"] in FINISHED_STATES:
+            return job
+
+        transport = self._transport_for(job)
+        state = transport.state(job["job_name"])
+        if state == STATE_SUCCEEDED:
+            self._store_results(job, transport.results(job["job_name"]))
+        if state in FINISHED_STATES:
+            job["finished_at"] = datetime.now().isoformat()
+            print(f"批量任务 {job_id} 已结束: {state}")
+        job["state"] = state
+        self._save_job(job)
+        return job
+
+    def wait(self, job_id: str, interval: float = 60.0, timeout: Optional[float] = None) -> Dict:
+        """
+        轮询直到任务结束
+
+        参数:
+            job_id (str): 本地任务编号
+            interval (float): 轮询间隔（秒）
+            timeout (float): 最长等待时间（秒），None 表示一直等待
+
+        返回:
+            Dict: 任务记录（超时返回时状态仍为 pending / running）
+        """
+        started = time.monotonic()
+        while True:
+            job = self.poll(job_id)
+            if job["state"] in FINISHED_STATES:
+                return job
+            if timeout is not None and time.monotonic() - started + interval > timeout:
+                return job
+            time.sleep(interval)
+
+    def cancel(self, job_id: str) -> Dict:
+        """取消尚未结束的任务"""
+        job = self.load_job(job_id)
+        if job is None:
+            raise ValueError(f"批量任务不存在: {job_id}")
+        if job["state"] not in FINISHED_STATES:
+            self._transport_for(job).cancel(job["job_name"])
+            job["state"] = STATE_CANCELLED
+            job["finished_at"] = datetime.now().isoformat()
+            self._save_job(job)
+            print(f"批量任务 {job_id} 已取消")
+        return job
+
+    def _store_results(self, job: Dict, results: List[RequestResult]):
+        """把任务结果保存到 output_dir/bulk_<任务编号>/，文件名为 组序号_组内序号"""
+        job_dir = os.path.join(self.output_dir, f"bulk_{job['id']}")
+        if not os.path.exists(job_dir):
+            os.makedirs(job_dir)
+
+        counters: Dict[int, int] = {}
+        for request_index, (images, error) in enumerate(results):
+            item_index = job["request_items"][request_index] if request_index < len(job["request_items"]) else -1
+            counters[item_index] = counters.get(item_index, 0) + 1
+            if not images:
+                job["errors"].append({"item": item_index, "error": error or "未知错误"})
+                continue
+            path = os.path.join(job_dir, f"{item_index + 1:03d}_{counters[item_index]}.png")
+            images[0].save(path)
+            job["files"].append(path)
+
+        print(f"已保存 {len(job['files'])} 张海报到 {job_dir}，失败 {len(job['errors'])} 张")
+
+
+def _load_image(path: Optional[str]) -> Optional[Image.Image]:
+    """读取活动配置中引用的素材图片"""
+    if not path:
+        return None
+    with open(path, "rb") as f:
+        return Image.open(BytesIO(f.read()))
+
+
+def load_campaign(path: str) -> List[Dict]:
+    """
+    读取活动配置文件（JSON 数组），素材字段为图片路径
+
+    每项示例: {"prompt": "...", "count": 4, "aspect_ratio": "9:16", "thinking_mode": false,
+              "style": "...", "slogan": "...", "logo": "logo.png", "qrcode": "qr.png", "reference": "ref.jpg"}
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    return [
+        {
+            "user_prompt": entry["prompt"],
+            "num_images": entry.get("count", 1),
+            "aspect_ratio": entry.get("aspect_ratio"),
+            "thinking_mode": entry.get("thinking_mode"),
+            "style_prompt": entry.get("style"),
+            "slogan": entry.get("slogan"),
+            "logo_image": _load_image(entry.get("logo")),
+            "qrcode_image": _load_image(entry.get("qrcode")),
+            "reference_image": _load_image(entry.get("reference"))
+        }
+        for entry in entries
+    ]
+
+
+if __name__ == "__main__":
+    # 命令行用法:
+    #   python bulk_manager.py submit campaign.json   提交活动配置中的所有海报
+    #   python bulk_manager.py status <任务编号>       查询一次（完成时保存结果）
+    #   python bulk_manager.py wait <任务编号>         轮询直到完成
+    #   python bulk_manager.py cancel <任务编号>       取消任务
+    #   python bulk_manager.py list                    列出所有任务
+    manager = BulkManager()
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+    if command == "submit":
+        print(manager.submit(load_campaign(sys.argv[2])))
+    elif command == "status":
+        job = manager.poll(sys.argv[2])
+        print(f"{job['id']}: {job['state']}，已保存 {len(job['files'])} 张")
+    elif command == "wait":
+        job = manager.wait(sys.argv[2])
+        print(f"{job['id']}: {job['state']}，已保存 {len(job['files'])} 张")
+    elif command == "cancel":
+        manager.cancel(sys.argv[2])
+    else:
+        for job in manager.list_jobs():
+            print(f"{job['id']}  {job['state']:<10}  {sum(item['num_images'] for item in job['items'])} 张  {job['name']}")
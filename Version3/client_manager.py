@@ -0,0 +1,155 @@
+# MirrorPost AI - 客户端管理模块
+# 进程内共享 genai.Client，复用 HTTP 连接池，避免每次请求重新建立 TLS 连接
+
+import os
+import threading
+from typing import Dict, Optional
+
+import httpx
+from dotenv import load_dotenv
+from google import genai
+from google.genai import types
+
+from key_pool import key_pool
+
+# 加载环境变量
+load_dotenv()
+
+# HTTP 参数（可通过环境变量覆盖）
+DEFAULT_TIMEOUT_SECONDS = float(os.getenv("MIRRORPOST_HTTP_TIMEOUT", "180"))
+DEFAULT_MAX_CONNECTIONS = int(os.getenv("MIRRORPOST_MAX_CONNECTIONS", "20"))
+DEFAULT_KEEPALIVE_EXPIRY = float(os.getenv("MIRRORPOST_KEEPALIVE_EXPIRY", "120"))
+
+# 预热时请求的模型（只读取模型元数据，不消耗生成配额）
+WARM_UP_MODEL = "gemini-3-pro-image-preview"
+
+
+class ClientManager:
+    """客户端管理器：按 API Key 缓存 genai.Client，线程安全"""
+
+    def __init__(
+        self,
+        timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY
+    ):
+        """
+        初始化客户端管理器
+
+        参数:
+            timeout_seconds (float): 单次 HTTP 请求超时（秒）
+            max_connections (int): 每个客户端的最大连接数
+            keepalive_expiry (float): 空闲连接保活时间（秒）
+        """
+        self.timeout_seconds = timeout_seconds
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self._clients: Dict[str, genai.Client] = {}
+        self._warmed: set = set()
+        self._lock = threading.Lock()
+
+    def get_client(self, api_key: Optional[str] = None) -> genai.Client:
+        """
+        获取（必要时创建）共享客户端
+
+        参数:
+            api_key (str): API Key，默认使用 Key 池中第一个有效的 Key
+
+        返回:
+            genai.Client: 可在多线程 / 协程间共享的客户端
+        """
+        if not api_key:
+            key_pool.check()
+            keys = key_pool.keys()
+            if not keys:
+                raise ValueError("所有 API Key 均已失效，请检查 .env 中的 GOOGLE_API_KEYS")
+            api_key = keys[0]
+
+        client = self._clients.get(api_key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._create_client(api_key)
+                self._clients[api_key] = client
+            return client
+
+    def _create_client(self, api_key: str) -> genai.Client:
+        """创建带连接池与超时配置的客户端"""
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+        timeout = httpx.Timeout(self.timeout_seconds)
+
+        http_options = types.HttpOptions(
+            timeout=int(self.timeout_seconds * 1000),  # SDK 以毫秒为单位
+            httpx_client=httpx.Client(limits=limits, timeout=timeout),
+            httpx_async_client=httpx.AsyncClient(limits=limits, timeout=timeout)
+        )
+        return genai.Client(api_key=api_key, http_options=http_options)
+
+    def warm_up(self, api_key: Optional[str] = None, background: bool = False) -> bool:
+        """
+        预热连接：提前完成 DNS / TLS 握手，降低首张海报的延迟
+
+        参数:
+            api_key (str): API Key，默认预热 Key 池中的所有 Key（顺带摘除无效的 Key）
+            background (bool): 是否在后台线程中执行
+
+        返回:
+            bool: 预热是否成功（后台模式下表示是否已启动）
+        """
+        if background:
+            threading.Thread(target=self.warm_up, args=(api_key,), daemon=True).start()
+            return True
+
+        if api_key:
+            keys = [api_key]
+        else:
+            try:
+                key_pool.check()
+            except ValueError as e:
+                print(f"客户端预热失败: {str(e)}")
+                return False
+            keys = key_pool.keys()
+
+        warmed = 0
+        for key in keys:
+            try:
+                client = self.get_client(key)
+                if id(client) not in self._warmed:
+                    client.models.get(model=WARM_UP_MODEL)
+                    self._warmed.add(id(client))
+                    key_pool.report(key)
+                warmed += 1
+            except Exception as e:
+                print(f"客户端预热失败: {str(e)}")
+                key_pool.report(key, e)
+
+        if warmed:
+            print(f"客户端连接预热完成（{warmed}/{len(keys)} 个 Key）")
+        return warmed > 0
+
+    def close_all(self):
+        """关闭所有客户端及其连接池"""
+        with self._lock:
+            for client in self._clients.values():
+                try:
+                    client.close()
+                except Exception as e:
+                    print(f"关闭客户端失败: {str(e)}")
+            self._clients.clear()
+            self._warmed.clear()
+
+
+# 进程内共享的客户端管理器
+client_manager = ClientManager()
+
+
+def get_client(api_key: Optional[str] = None) -> genai.Client:
+    """获取进程内共享的 genai.Client"""
+    return client_manager.get_client(api_key)
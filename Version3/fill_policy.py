@@ -0,0 +1,57 @@
+# MirrorPost AI - 补足数量模块
+# 某张海报最终失败时立即补发一张，直到成功数量达到请求数量或补发预算用完
+
+import math
+import threading
+import time
+from typing import Optional
+
+
+class FillPolicy:
+    """补足策略：每批最多额外发起多少张、在多长时间内补发"""
+
+    def __init__(
+        self,
+        extra_ratio: float = 0.5,
+        max_extra_attempts: Optional[int] = None,
+        time_budget: Optional[float] = None
+    ):
+        """
+        初始化补足策略
+
+        参数:
+            extra_ratio (float): 额外补发数量上限占请求数量的比例（未指定 max_extra_attempts 时使用）
+            max_extra_attempts (int): 额外补发数量上限，优先于 extra_ratio
+            time_budget (float): 自本批开始超过该秒数后不再补发，None 表示不限（仍受截止时间约束）
+        """
+        self.extra_ratio = extra_ratio
+        self.max_extra_attempts = max_extra_attempts
+        self.time_budget = time_budget
+
+    def budget_for(self, num_images: int) -> "FillBudget":
+        """为一批生成创建补发预算（至少 1 张）"""
+        if self.max_extra_attempts is not None:
+            limit = max(0, self.max_extra_attempts)
+        else:
+            limit = max(1, math.ceil(num_images * self.extra_ratio))
+        return FillBudget(limit, self.time_budget)
+
+
+class FillBudget:
+    """一批生成的补发预算，线程安全"""
+
+    def __init__(self, limit: int, time_budget: Optional[float] = None):
+        self.limit = limit
+        self.used = 0
+        self.expires_at = None if time_budget is None else time.monotonic() + time_budget
+        self._lock = threading.Lock()
+
+    def try_spend(self) -> bool:
+        """占用一次补发，预算用完或超过补发时限时返回 False"""
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            return False
+        with self._lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
@@ -0,0 +1,229 @@
+# MirrorPost AI - API Key 池模块
+# 多个 API Key 分摊调用：按负载或轮询选择，配额不足的 Key 暂时摘除，失效的 Key 永久摘除
+
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from rate_limiter import is_quota_error
+
+# 加载环境变量
+load_dotenv()
+
+# Key 池参数（可通过环境变量覆盖）
+DEFAULT_STRATEGY = os.getenv("MIRRORPOST_KEY_STRATEGY", "least_loaded")
+DEFAULT_QUOTA_COOLDOWN = float(os.getenv("MIRRORPOST_KEY_COOLDOWN", "60"))
+MAX_QUOTA_COOLDOWN = 600.0
+
+# 选择策略
+STRATEGY_LEAST_LOADED = "least_loaded"
+STRATEGY_ROUND_ROBIN = "round_robin"
+
+
+def configured_keys() -> List[str]:
+    """
+    读取环境变量中配置的 API Key
+
+    GOOGLE_API_KEYS 为逗号分隔的多个 Key；未设置时使用单个 GOOGLE_API_KEY
+
+    返回:
+        List[str]: 去重后的 Key 列表（保持配置顺序）
+    """
+    raw = os.getenv("GOOGLE_API_KEYS") or os.getenv("GOOGLE_API_KEY") or ""
+    keys = []
+    for key in raw.split(","):
+        key = key.strip()
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def is_key_error(error: Exception) -> bool:
+    """
+    判断异常是否说明 API Key 无效或已被吊销（HTTP 401 / 403）
+
+    按 SDK 异常（google.genai.errors.APIError）的状态码与状态判断，不在错误信息中查找 "401" / "403"，
+    以免请求 ID、字节数等数字误判把正常的 Key 停用
+    """
+    if getattr(error, "code", None) in (401, 403):
+        return True
+    if getattr(error, "status", None) in ("UNAUTHENTICATED", "PERMISSION_DENIED"):
+        return True
+    error_msg = str(error).lower()
+    return "api key not valid" in error_msg or "api_key_invalid" in error_msg
+
+
+def mask_key(api_key: str) -> str:
+    """日志与状态接口中显示的 Key（只保留末 4 位）"""
+    return f"***{api_key[-4:]}"
+
+
+class _KeyState:
+    """单个 API Key 的健康状态"""
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.in_flight = 0
+        self.successes = 0
+        self.errors = 0
+        self.quota_errors = 0
+        self.quota_strikes = 0  # 连续配额不足次数，决定摘除时长
+        self.ejected_until = 0.0
+        self.revoked = False
+
+    def available(self, now: float) -> bool:
+        return not self.revoked and now >= self.ejected_until
+
+
+class ApiKeyPool:
+    """API Key 池：选择 Key 并跟踪每个 Key 的负载与健康状态，线程安全"""
+
+    def __init__(
+        self,
+        keys: Optional[List[str]] = None,
+        strategy: str = DEFAULT_STRATEGY,
+        quota_cooldown: float = DEFAULT_QUOTA_COOLDOWN
+    ):
+        """
+        初始化 Key 池
+
+        参数:
+            keys (List[str]): API Key 列表，默认读取 GOOGLE_API_KEYS / GOOGLE_API_KEY
+            strategy (str): "least_loaded"（进行中调用最少）或 "round_robin"（轮询）
+            quota_cooldown (float): Key 配额不足时的摘除时长（秒），连续不足时加倍
+        """
+        self.strategy = strategy
+        self.quota_cooldown = quota_cooldown
+        self._states: Dict[str, _KeyState] = {
+            key: _KeyState(key) for key in (keys if keys is not None else configured_keys())
+        }
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def size(self) -> int:
+        """池中的 Key 数量（含已摘除的）"""
+        return len(self._states)
+
+    def keys(self) -> List[str]:
+        """池中所有未失效的 Key"""
+        with self._lock:
+            return [key for key, state in self._states.items() if not state.revoked]
+
+    def check(self):
+        """没有配置任何 Key 时抛出 ValueError"""
+        if not self._states:
+            raise ValueError("GOOGLE_API_KEY 未在 .env 文件中设置")
+
+    def acquire(self) -> str:
+        """
+        选择一个 Key 用于下一次调用（调用结束后必须 release）
+
+        返回:
+            str: 选中的 Key；所有 Key 都在配额冷却中时返回最早恢复的那个
+
+        异常:
+            ValueError: 没有配置 Key 或所有 Key 均已失效
+        """
+        self.check()
+        with self._lock:
+            now = time.monotonic()
+            states = list(self._states.values())
+            candidates = [state for state in states if state.available(now)]
+            if not candidates:
+                cooling = [state for state in states if not state.revoked]
+                if not cooling:
+                    raise ValueError("所有 API Key 均已失效，请检查 .env 中的 GOOGLE_API_KEYS")
+                candidates = [min(cooling, key=lambda state: state.ejected_until)]
+
+            # 从轮询位置开始排列候选，最少负载策略在负载相同时也会轮流使用各个 Key
+            start = self._next % len(candidates)
+            candidates = candidates[start:] + candidates[:start]
+            self._next += 1
+            if self.strategy == STRATEGY_ROUND_ROBIN:
+                state = candidates[0]
+            else:
+                state = min(candidates, key=lambda state: state.in_flight)
+
+            state.in_flight += 1
+            return state.api_key
+
+    def release(self, api_key: str, error: Optional[Exception] = None, cancelled: bool = False):
+        """
+        归还 Key 并记录调用结果
+
+        参数:
+            api_key (str): acquire 返回的 Key
+            error (Exception): 调用异常，成功时为 None
+            cancelled (bool): 调用被取消（结果未知），只归还负载不记录结果
+        """
+        with self._lock:
+            state = self._states.get(api_key)
+            if state is None:
+                return
+            state.in_flight = max(0, state.in_flight - 1)
+        if not cancelled:
+            self.report(api_key, error)
+
+    def report(self, api_key: str, error: Optional[Exception] = None):
+        """
+        记录一次使用某个 Key 的结果（不占用负载，如预热）
+
+        参数:
+            api_key (str): API Key
+            error (Exception): 调用异常，成功时为 None
+        """
+        with self._lock:
+            state = self._states.get(api_key)
+            if state is None:
+                return
+            if error is None:
+                state.successes += 1
+                state.quota_strikes = 0
+            elif is_quota_error(error):
+                state.quota_errors += 1
+                state.quota_strikes += 1
+                cooldown = min(MAX_QUOTA_COOLDOWN, self.quota_cooldown * 2 ** (state.quota_strikes - 1))
+                state.ejected_until = time.monotonic() + cooldown
+                print(f"[KeyPool] {mask_key(api_key)} 配额不足，暂停使用 {cooldown:.0f} 秒")
+            elif is_key_error(error):
+                state.errors += 1
+                if not state.revoked:
+                    state.revoked = True
+                    print(f"[KeyPool] {mask_key(api_key)} 无效或已被吊销，已移出 Key 池")
+            else:
+                state.errors += 1
+
+    def stats(self) -> List[Dict]:
+        """
+        获取每个 Key 的状态
+
+        返回:
+            List[Dict]: 脱敏后的 Key、状态、进行中调用数、成功 / 错误 / 配额不足次数
+        """
+        with self._lock:
+            now = time.monotonic()
+            result = []
+            for state in self._states.values():
+                if state.revoked:
+                    status = "revoked"
+                elif now < state.ejected_until:
+                    status = "cooling"
+                else:
+                    status = "healthy"
+                result.append({
+                    "key": mask_key(state.api_key),
+                    "status": status,
+                    "in_flight": state.in_flight,
+                    "successes": state.successes,
+                    "errors": state.errors,
+                    "quota_errors": state.quota_errors,
+                    "retry_after": round(state.ejected_until - now, 1) if status == "cooling" else None
+                })
+            return result
+
+
+# 进程内共享的 Key 池
+key_pool = ApiKeyPool()
@@ -0,0 +1,165 @@
+# MirrorPost AI - 请求预检模块
+# 调用模型之前检查请求参数与图片素材，注定失败的请求直接以 4xx 拒绝，不消耗模型调用
+
+import base64
+import binascii
+import os
+from io import BytesIO
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from PIL import Image
+
+from prompt_compiler import TOKEN_BUDGET, brief_tokens
+
+# 加载环境变量
+load_dotenv()
+
+# 图像模型支持的纵横比
+SUPPORTED_ASPECT_RATIOS = ("1:1", "2:3", "3:2", "3:4", "4:3", "4:5", "5:4", "9:16", "16:9", "21:9")
+
+# 预检上限（可通过环境变量覆盖）
+MAX_COUNT = int(os.getenv("MIRRORPOST_MAX_COUNT", "10"))
+MAX_PROMPT_CHARS = int(os.getenv("MIRRORPOST_MAX_PROMPT_CHARS", "4000"))
+MAX_IMAGE_BYTES = int(float(os.getenv("MIRRORPOST_MAX_IMAGE_MB", "7")) * 1024 * 1024)
+MAX_IMAGE_SIDE = int(os.getenv("MIRRORPOST_MAX_IMAGE_SIDE", "8192"))
+MIN_IMAGE_SIDE = 16
+MAX_INPUT_IMAGES = 14  # 单次请求的素材图片总数（含参考图、Logo、二维码、品牌组合、草稿）
+MAX_TIMEOUT_SECONDS = 1800
+MAX_SAFETY_ABORT_AFTER = 10
+
+
+class PreflightError(ValueError):
+    """请求未通过预检：status_code 为应返回的 HTTP 状态码，field 为出错的字段"""
+
+    def __init__(self, field: str, message: str, status_code: int = 400):
+        super().__init__(f"{field}: {message}")
+        self.field = field
+        self.message = message
+        self.status_code = status_code
+
+    def to_dict(self) -> dict:
+        """结构化的错误详情（用作 HTTP 响应的 detail）"""
+        return {"reason": "请求参数无效", "field": self.field, "message": self.message}
+
+
+def check_aspect_ratio(aspect_ratio: str):
+    """纵横比必须是模型支持的取值"""
+    if aspect_ratio not in SUPPORTED_ASPECT_RATIOS:
+        raise PreflightError(
+            "aspect_ratio", f"不支持 {aspect_ratio!r}，可选 {', '.join(SUPPORTED_ASPECT_RATIOS)}"
+        )
+
+
+def check_range(field: str, value, low, high):
+    """数值必须在 [low, high] 范围内"""
+    if value is not None and not low <= value <= high:
+        raise PreflightError(field, f"取值 {value} 超出范围 {low}-{high}")
+
+
+def decode_image(field: str, data: str) -> Image.Image:
+    """
+    解码并检查一张 Base64 图片
+
+    依次检查编码长度、Base64 格式、图片格式与尺寸，最后完整解码一次，确保截断或损坏的文件在调用模型前被拒绝
+
+    参数:
+        field (str): 字段名（用于错误信息）
+        data (str): Base64 字符串，可带 data:image/...;base64, 前缀
+
+    返回:
+        Image.Image: 已解码的图片
+
+    异常:
+        PreflightError: 超过大小上限时为 413，其余为 400
+    """
+    if "," in data:
+        data = data.split(",", 1)[1]
+
+    # 解码前按编码长度估算字节数，过大的图片不必解码
+    if len(data) * 3 // 4 > MAX_IMAGE_BYTES:
+        raise PreflightError(field, f"图片超过 {MAX_IMAGE_BYTES // (1024 * 1024)} MB 上限", 413)
+
+    try:
+        img_bytes = base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        raise PreflightError(field, "不是有效的 Base64 编码")
+
+    try:
+        image = Image.open(BytesIO(img_bytes))
+    except Exception:
+        raise PreflightError(field, "无法识别的图片格式")
+
+    # 只读取文件头即可得到尺寸，超大图片不做完整解码
+    width, height = image.size
+    if max(width, height) > MAX_IMAGE_SIDE:
+        raise PreflightError(field, f"图片尺寸 {width}x{height} 超过 {MAX_IMAGE_SIDE} 像素上限", 413)
+    if min(width, height) < MIN_IMAGE_SIDE:
+        raise PreflightError(field, f"图片尺寸 {width}x{height} 过小（至少 {MIN_IMAGE_SIDE} 像素）")
+
+    try:
+        image.load()
+    except Exception as e:
+        raise PreflightError(field, f"图片无法解码: {str(e)}")
+    return image
+
+
+def validate_request(
+    prompt: str,
+    aspect_ratio: str,
+    count: int,
+    style_intensity: Optional[float] = None,
+    timeout_seconds: Optional[float] = None,
+    safety_abort_after: Optional[int] = None,
+    images: Optional[Dict[str, Optional[str]]] = None,
+    image_lists: Optional[Dict[str, Optional[List[str]]]] = None
+) -> Dict:
+    """
+    预检一个生成请求并解码其中的图片素材
+
+    先做不需要解码的检查（提示词长度与 token 预算、纵横比、数量、数值范围、图片数量），再逐张解码图片
+
+    参数:
+        prompt (str): 海报描述
+        aspect_ratio (str): 纵横比
+        count (int): 生成数量
+        style_intensity (float): 风格强度
+        timeout_seconds (float): 时间预算（秒）
+        safety_abort_after (int): 连续安全过滤的放弃次数
+        images (Dict[str, str]): 字段名 -> Base64 图片（None 表示未提供）
+        image_lists (Dict[str, List[str]]): 字段名 -> Base64 图片列表
+
+    返回:
+        Dict: 字段名 -> 解码后的图片（列表字段为图片列表），未提供的字段为 None
+
+    异常:
+        PreflightError: 请求不合法
+    """
+    images = images or {}
+    image_lists = image_lists or {}
+
+    if not prompt or not prompt.strip():
+        raise PreflightError("prompt", "海报描述不能为空")
+    if len(prompt) > MAX_PROMPT_CHARS:
+        raise PreflightError("prompt", f"海报描述超过 {MAX_PROMPT_CHARS} 字上限")
+    # 用户描述不会被裁剪，超出提示词预算时直接拒绝，而不是悄悄省略其中的日期、地点等信息
+    tokens = brief_tokens(prompt)
+    if TOKEN_BUDGET and tokens > TOKEN_BUDGET:
+        raise PreflightError("prompt", f"海报描述约 {tokens} token，超过 {TOKEN_BUDGET} token 预算，请精简描述")
+    check_aspect_ratio(aspect_ratio)
+    check_range("count", count, 1, MAX_COUNT)
+    check_range("style_intensity", style_intensity, 0.0, 1.0)
+    check_range("safety_abort_after", safety_abort_after, 0, MAX_SAFETY_ABORT_AFTER)
+    if timeout_seconds is not None and not 0 < timeout_seconds <= MAX_TIMEOUT_SECONDS:
+        raise PreflightError("timeout_seconds", f"取值 {timeout_seconds} 超出范围 (0, {MAX_TIMEOUT_SECONDS}]")
+
+    total = sum(1 for data in images.values() if data) + sum(len(items or []) for items in image_lists.values())
+    if total > MAX_INPUT_IMAGES:
+        raise PreflightError("images", f"素材图片共 {total} 张，超过 {MAX_INPUT_IMAGES} 张上限")
+
+    decoded = {}
+    for field, data in images.items():
+        decoded[field] = decode_image(field, data) if data else None
+    for field, items in image_lists.items():
+        decoded[field] = [decode_image(f"{field}[{i}]", data) for i, data in enumerate(items)] if items else None
+    return decoded
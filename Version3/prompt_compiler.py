@@ -0,0 +1,218 @@
+# MirrorPost AI - 提示词编译模块
+# 统一拼接用户描述、优化指令、预设风格、自定义风格与负向提示词：去除重复子句，按 token 预算裁剪
+
+import os
+import re
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 最终提示词的 token 预算（可通过环境变量覆盖，不含后端追加的素材说明）；
+# 用户描述本身始终完整保留，只省略优化指令与自定义风格
+TOKEN_BUDGET = int(os.getenv("MIRRORPOST_PROMPT_BUDGET", "400"))
+
+# 预设风格关键词（界面名称如「极简主义 (Minimalist)」取括号中的英文名）
+PRESET_STYLES = {
+    "Minimalist": "minimalist design, clean layout, simple geometric shapes, plenty of white space",
+    "Cyberpunk": "cyberpunk style, neon colors, futuristic elements, tech-inspired, dark background with bright accents",
+    "Tech Corporate": "professional business style, modern tech aesthetic, corporate colors, clean and sophisticated",
+    "Warm Illustration": "warm hand-drawn illustration style, friendly and approachable, soft colors, artistic touch",
+    "Tech": "tech-inspired design, modern digital aesthetic, futuristic elements",
+    "Hand-drawn": "hand-drawn illustration style, warm colors, artistic and friendly"
+}
+
+# 预编译的风格子句
+_PRESET_CLAUSES = {name: f"Style: {keywords}" for name, keywords in PRESET_STYLES.items()}
+
+# 子句分隔：英文句末标点后需有空白（避免拆开 "v2.0"），中文句末标点直接分隔
+_CLAUSE_SPLIT = re.compile(r"(?<=[.!?;])\s+|(?<=[。！？；])\s*")
+_PRESET_LABEL = re.compile(r"\(([^()]+)\)\s*$")
+_CJK_CHAR = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+def resolve_preset(preset_style: Optional[str]) -> Optional[str]:
+    """
+    把界面上的风格名称解析为预设名
+
+    参数:
+        preset_style (str): "Minimalist" 或 "极简主义 (Minimalist)" 形式的名称
+
+    返回:
+        str: PRESET_STYLES 中的预设名；自动匹配或未知风格返回 None
+    """
+    if not preset_style:
+        return None
+    match = _PRESET_LABEL.search(preset_style)
+    name = match.group(1).strip() if match else preset_style.strip()
+    return name if name in PRESET_STYLES else None
+
+
+def split_clauses(text: Optional[str]) -> List[str]:
+    """把一段提示词拆成子句（去掉首尾空白与句末的英文句号）"""
+    clauses = []
+    for clause in _CLAUSE_SPLIT.split(text or ""):
+        clause = clause.strip().rstrip(".").strip()
+        if clause:
+            clauses.append(clause)
+    return clauses
+
+
+def _clause_key(clause: str) -> str:
+    """子句去重用的规范形式：忽略大小写、空白与句末标点"""
+    return " ".join(clause.lower().split()).rstrip(".。!！?？;；,，")
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """
+    估算一段文本的 token 数（结果缓存，重复的子句只计算一次）
+
+    中日韩字符按每字 1 个 token，其余按每 4 个字符 1 个 token 估算
+    """
+    cjk = len(_CJK_CHAR.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def brief_tokens(user_prompt: Optional[str]) -> int:
+    """估算用户描述按子句编译后的 token 数（与 compile_prompt 的预算计算方式一致）"""
+    return sum(count_tokens(clause) + 1 for clause in split_clauses(user_prompt))
+
+
+def _join(clauses: Sequence[str]) -> str:
+    """用 ". " 连接子句；以中文句末标点结尾的子句直接连接，以其他句末标点结尾的只补空格"""
+    text = ""
+    for clause in clauses:
+        if text and text[-1] not in "。！？；":
+            text += " " if text[-1] in "!?;" else ". "
+        text += clause
+    return text
+
+
+def join_clauses(parts: Sequence[str]) -> str:
+    """
+    用 ". " 连接提示词片段，并去掉与前文重复的子句
+
+    没有重复子句的片段原样保留，便于按片段原文查找替换（如 Thinking 前缀）
+
+    参数:
+        parts (Sequence[str]): 按顺序排列的提示词片段
+
+    返回:
+        str: 拼接后的提示词
+    """
+    seen = set()
+    result = []
+    for part in parts:
+        clauses = split_clauses(part)
+        fresh = [clause for clause in clauses if _clause_key(clause) not in seen]
+        seen.update(_clause_key(clause) for clause in clauses)
+        if not fresh:
+            continue
+        result.append(part if len(fresh) == len(clauses) else _join(fresh))
+    return ". ".join(result)
+
+
+def compile_prompt(
+    user_prompt: str,
+    refinements: Sequence[str] = (),
+    preset_style: Optional[str] = None,
+    style_strength: Optional[float] = None,
+    custom_style: Optional[str] = None,
+    negative_prompt: Optional[str] = None,
+    budget: int = TOKEN_BUDGET
+) -> str:
+    """
+    编译发送给后端的最终提示词
+
+    依次拼接用户描述、优化指令（按先后顺序）、预设风格、自定义风格与负向提示词，
+    重复的子句只保留第一次出现的。超出 token 预算时先省略最早的优化指令，再省略自定义风格；
+    用户描述、预设风格与负向提示词始终完整保留（用户描述本身超出预算时由调用方预检拒绝或提示）。
+    编译结果按参数缓存，多轮优化时重复的请求不再重新拼接。
+
+    参数:
+        user_prompt (str): 用户描述
+        refinements (Sequence[str]): 之后每轮的优化指令
+        preset_style (str): 预设风格名（界面名称或预设名），自动匹配时为 None
+        style_strength (float): 风格强度
+        custom_style (str): 自定义风格的提示词
+        negative_prompt (str): 需要避免的内容
+        budget (int): token 预算，0 表示不限制
+
+    返回:
+        str: 最终提示词
+    """
+    return _compile(
+        user_prompt or "", tuple(refinements), resolve_preset(preset_style),
+        style_strength, custom_style or "", negative_prompt or "", budget
+    )
+
+
+@lru_cache(maxsize=256)
+def _compile(
+    user_prompt: str,
+    refinements: tuple,
+    preset: Optional[str],
+    style_strength: Optional[float],
+    custom_style: str,
+    negative_prompt: str,
+    budget: int
+) -> str:
+    """compile_prompt 的缓存实现（参数均可哈希）"""
+    # (子句, 省略优先级)：优先级越小越先省略，None 表示始终保留
+    entries = [(clause, None) for clause in split_clauses(user_prompt)]
+    for i, refinement in enumerate(refinements):
+        entries.extend((clause, i) for clause in split_clauses(refinement))
+    if preset:
+        entries.append((_PRESET_CLAUSES[preset], None))
+        if style_strength is not None:
+            entries.append((f"Style strength: {style_strength}", None))
+    custom = split_clauses(custom_style)
+    for i, clause in enumerate(custom):
+        entries.append((clause, 1000 - i))
+    if negative_prompt:
+        entries.append((f"Avoid: {negative_prompt.strip().rstrip('.')}", None))
+
+    # 去除重复子句（保留第一次出现的）
+    seen = set()
+    unique = []
+    for clause, priority in entries:
+        key = _clause_key(clause)
+        if key not in seen:
+            seen.add(key)
+            unique.append((clause, priority))
+
+    # 按预算从优先级最低的子句开始省略
+    total = sum(count_tokens(clause) + 1 for clause, _ in unique)
+    if budget and total > budget:
+        droppable = sorted(
+            (priority, i) for i, (_, priority) in enumerate(unique) if priority is not None
+        )
+        dropped = set()
+        for _, i in droppable:
+            if total <= budget:
+                break
+            dropped.add(i)
+            total -= count_tokens(unique[i][0]) + 1
+        unique = [entry for i, entry in enumerate(unique) if i not in dropped]
+        print(f"[Prompt] 提示词超出 {budget} token 预算，已省略 {len(dropped)} 个优化指令 / 风格子句")
+        if total > budget:
+            print(f"[Prompt] 警告: 必须保留的部分（用户描述、风格、负向提示词）约 {total} token，仍超出预算")
+
+    return _join([clause for clause, _ in unique])
+
+
+def cache_stats() -> dict:
+    """提示词编译与 token 计数缓存的命中情况"""
+    compiled = _compile.cache_info()
+    counted = count_tokens.cache_info()
+    return {
+        "compile_hits": compiled.hits,
+        "compile_misses": compiled.misses,
+        "token_hits": counted.hits,
+        "token_misses": counted.misses
+    }
@@ -0,0 +1,179 @@
+# MirrorPost AI - 限流模块
+# 令牌桶 + AIMD 自适应并发：遇到配额 / 429 错误时降速，成功后逐步恢复
+
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 限流参数（可通过环境变量覆盖）
+DEFAULT_REQUESTS_PER_MINUTE = float(os.getenv("MIRRORPOST_RATE_LIMIT_RPM", "60"))
+DEFAULT_BURST = int(os.getenv("MIRRORPOST_RATE_LIMIT_BURST", "10"))
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("MIRRORPOST_MAX_CONCURRENCY", "16"))
+
+# 以上速率为单个 API Key 的额度；配置多个 Key（GOOGLE_API_KEYS）时按 Key 数量放大
+KEY_COUNT = max(1, len({key.strip() for key in os.getenv("GOOGLE_API_KEYS", "").split(",") if key.strip()}))
+
+# 调用结果
+OUTCOME_SUCCESS = "success"
+OUTCOME_THROTTLED = "throttled"
+OUTCOME_ERROR = "error"
+OUTCOME_UNUSED = "unused"  # 获得许可后没有发起调用（如等待期间批次已取消），令牌一并退还
+
+
+def is_quota_error(error: Exception) -> bool:
+    """
+    判断异常是否为配额 / 限流错误（HTTP 429）
+
+    按 SDK 异常（google.genai.errors.APIError）的状态码与状态判断，不在错误信息中查找 "429"，
+    以免请求 ID、字节数等数字误判为限流而压低并发
+    """
+    if getattr(error, "code", None) == 429:
+        return True
+    if getattr(error, "status", None) == "RESOURCE_EXHAUSTED":
+        return True
+    error_msg = str(error).lower()
+    return "resource_exhausted" in error_msg or "quota" in error_msg or "rate limit" in error_msg
+
+
+class AdaptiveRateLimiter:
+    """自适应限流器：令牌桶控制请求速率，AIMD 控制并发上限，线程与协程共用"""
+
+    def __init__(
+        self,
+        requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+        burst: int = DEFAULT_BURST,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        min_concurrency: int = 1,
+        decrease_factor: float = 0.5
+    ):
+        """
+        初始化限流器
+
+        参数:
+            requests_per_minute (float): 令牌补充速率（每分钟请求数）
+            burst (int): 令牌桶容量（允许的突发请求数）
+            max_concurrency (int): 并发上限的最大值
+            min_concurrency (int): 并发上限的最小值
+            decrease_factor (float): 遇到限流时并发上限的乘性缩减系数
+        """
+        self.rate = requests_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.decrease_factor = decrease_factor
+
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._limit = float(self.max_concurrency)
+        self._in_flight = 0
+        self._throttled_count = 0
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        """按流逝时间补充令牌（调用方需持有锁）"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _try_acquire(self) -> float:
+        """尝试占用一个并发名额和一个令牌，成功返回 0，否则返回建议等待秒数"""
+        with self._condition:
+            self._refill()
+            if self._in_flight >= int(self._limit):
+                return 0.05
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate if self.rate > 0 else 1.0
+            self._tokens -= 1
+            self._in_flight += 1
+            return 0.0
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        阻塞直到获得调用许可
+
+        参数:
+            timeout (float): 最长等待秒数，None 表示一直等待
+
+        返回:
+            bool: 是否获得许可
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._try_acquire()
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            with self._condition:
+                self._condition.wait(wait)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> bool:
+        """acquire 的异步版本，等待期间不阻塞事件循环"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._try_acquire()
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            await asyncio.sleep(min(wait, 0.5))
+
+    def release(self, outcome: str = OUTCOME_SUCCESS):
+        """
+        归还调用许可，并根据调用结果调整并发上限
+
+        参数:
+            outcome (str): OUTCOME_SUCCESS / OUTCOME_THROTTLED / OUTCOME_ERROR / OUTCOME_UNUSED
+        """
+        with self._condition:
+            self._in_flight = max(0, self._in_flight - 1)
+
+            if outcome == OUTCOME_UNUSED:
+                self._refill()
+                self._tokens = min(self.burst, self._tokens + 1)
+            elif outcome == OUTCOME_THROTTLED:
+                # 乘性减：并发上限减半，并清空令牌让后续请求稍作等待
+                self._throttled_count += 1
+                self._limit = max(self.min_concurrency, self._limit * self.decrease_factor)
+                self._tokens = min(self._tokens, 0.0)
+            elif outcome == OUTCOME_SUCCESS:
+                # 加性增：每个并发窗口的请求都成功后上限约增加 1
+                self._limit = min(self.max_concurrency, self._limit + 1.0 / self._limit)
+
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        获取限流器当前状态
+
+        返回:
+            Dict[str, float]: 并发上限、进行中请求数、剩余令牌、限流次数
+        """
+        with self._condition:
+            self._refill()
+            return {
+                "concurrency_limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "tokens": round(self._tokens, 2),
+                "throttled_count": self._throttled_count
+            }
+
+
+# 进程内共享的限流器
+rate_limiter = AdaptiveRateLimiter(
+    requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE * KEY_COUNT,
+    burst=DEFAULT_BURST * KEY_COUNT
+)
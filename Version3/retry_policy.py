@@ -0,0 +1,148 @@
+# MirrorPost AI - 重试策略模块
+# 按错误类别配置重试次数与退避时间（指数退避 + 随机抖动），并记录每次尝试
+
+import random
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# 各错误类别的默认规则：(最大尝试次数, 基础退避秒数, 最大退避秒数)
+DEFAULT_RULES: Dict[str, Tuple[int, float, float]] = {
+    "生成超时": (2, 2.0, 20.0),
+    "网络波动": (3, 1.0, 10.0),
+    "服务器繁忙": (3, 2.0, 30.0),
+    "API配额不足": (3, 5.0, 60.0),
+    "未知错误": (2, 1.0, 10.0),
+    "API Key无效": (2, 0.0, 0.0),  # 失效的 Key 已移出 Key 池，立即换用其他 Key 重试
+}
+
+# 永不重试的错误类别（重试只会得到同样的结果）
+NEVER_RETRY = {"内容安全过滤"}
+
+
+class RetryPolicy:
+    """重试策略：决定某类错误是否重试以及重试前等待多久"""
+
+    def __init__(
+        self,
+        rules: Optional[Dict[str, Tuple[int, float, float]]] = None,
+        max_batch_retries: Optional[int] = None,
+        jitter: bool = True
+    ):
+        """
+        初始化重试策略
+
+        参数:
+            rules (Dict): 覆盖默认规则，{错误类别: (最大尝试次数, 基础退避, 最大退避)}
+            max_batch_retries (int): 一批生成中允许的重试总数，None 表示不限
+            jitter (bool): 是否对退避时间加随机抖动（避免并发请求同时重试）
+        """
+        self.rules = dict(DEFAULT_RULES)
+        if rules:
+            self.rules.update(rules)
+        self.max_batch_retries = max_batch_retries
+        self.jitter = jitter
+
+    def should_retry(self, reason: str, attempt: int) -> bool:
+        """
+        判断第 attempt 次尝试失败后是否还应重试
+
+        参数:
+            reason (str): 错误类别
+            attempt (int): 已完成的尝试次数（从 1 开始）
+
+        返回:
+            bool: 是否重试
+        """
+        if reason in NEVER_RETRY or reason not in self.rules:
+            return False
+        max_attempts = self.rules[reason][0]
+        return attempt < max_attempts
+
+    def backoff(self, reason: str, attempt: int) -> float:
+        """
+        计算第 attempt 次失败后的等待秒数
+
+        参数:
+            reason (str): 错误类别
+            attempt (int): 已完成的尝试次数（从 1 开始）
+
+        返回:
+            float: 等待秒数
+        """
+        _, base_delay, max_delay = self.rules.get(reason, (1, 1.0, 10.0))
+        delay = min(max_delay, base_delay * (2 ** (attempt - 1)))
+        if self.jitter:
+            # Full jitter：在 [0, delay] 内均匀取值
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class AttemptLog:
+    """尝试记录：保存一批生成中每次模型调用的结果，线程安全"""
+
+    def __init__(self):
+        """初始化尝试记录"""
+        self.records: List[Dict] = []
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def record(self, index: int, attempt: int, reason: Optional[str], duration: float):
+        """
+        记录一次尝试
+
+        参数:
+            index (int): 海报序号（从 0 开始）
+            attempt (int): 第几次尝试（从 1 开始）
+            reason (str): 失败原因，成功为 None
+            duration (float): 本次调用耗时（秒）
+        """
+        with self._lock:
+            self.records.append({
+                "index": index,
+                "attempt": attempt,
+                "success": reason is None,
+                "reason": reason,
+                "duration": round(duration, 3)
+            })
+
+    def consume_retry(self, max_batch_retries: Optional[int]) -> bool:
+        """
+        占用一次批次重试额度
+
+        参数:
+            max_batch_retries (int): 批次重试总数上限，None 表示不限
+
+        返回:
+            bool: 是否还有额度
+        """
+        with self._lock:
+            if max_batch_retries is not None and self.retries >= max_batch_retries:
+                return False
+            self.retries += 1
+            return True
+
+    def summary(self) -> Dict:
+        """
+        汇总本批次的尝试情况
+
+        返回:
+            Dict: 尝试次数、成功次数、重试次数、成功率、各错误类别次数
+        """
+        with self._lock:
+            attempts = len(self.records)
+            successes = sum(1 for r in self.records if r["success"])
+            reasons: Dict[str, int] = {}
+            for r in self.records:
+                if r["reason"]:
+                    reasons[r["reason"]] = reasons.get(r["reason"], 0) + 1
+            return {
+                "attempts": attempts,
+                "successes": successes,
+                "retries": self.retries,
+                "success_rate": round(successes / attempts, 3) if attempts else 0.0,
+                "reasons": reasons
+            }
+
+
+# 默认重试策略
+default_retry_policy = RetryPolicy()
@@ -1,10 +1,13 @@
 # FastAPI 服务器 - 连接前后端
 # 此文件提供 RESTful API 接口供前端调用
 
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
+import asyncio
 import base64
 from io import BytesIO
 from PIL import Image
@@ -12,10 +15,42 @@ import json
 import os
 from datetime import datetime
 
-from backend import generate_posters
+from backend import (
+    DEFAULT_IMAGE_SIZE, DRAFT_IMAGE_SIZE, FINAL_IMAGE_SIZES, BatchAbortedError, finalize_poster_async, find_cache_offer,
+    generate_posters_async, iter_posters_async
+)
+from circuit_breaker import CircuitOpenError, circuit_breaker
+from key_pool import key_pool
+from prompt_compiler import compile_prompt
+from client_manager import client_manager
+from deadline import Deadline, DeadlineExceeded
+from fill_policy import FillPolicy
+from preflight import PreflightError, check_range, decode_image, validate_request
+from single_flight import SingleFlight, fingerprint
+from upscaler import DEFAULT_SHARPEN, MAX_SCALE, shutdown_pool, upscale
+
+# 启动时是否预热模型连接（MIRRORPOST_WARMUP=0 可关闭）
+WARM_UP_ON_STARTUP = os.getenv("MIRRORPOST_WARMUP", "1") != "0"
+
+# 单个生成请求的默认时间预算（秒），请求中的 timeout_seconds 可覆盖
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv("MIRRORPOST_REQUEST_TIMEOUT", "300"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时预热共享客户端，退出时关闭连接池与放大进程池"""
+    if WARM_UP_ON_STARTUP:
+        await asyncio.to_thread(client_manager.warm_up)
+    yield
+    client_manager.close_all()
+    shutdown_pool()
+
 
 # 创建 FastAPI 应用
-app = FastAPI(title="MirrorPost AI API", version="2.0")
+app = FastAPI(title="MirrorPost AI API", version="2.0", lifespan=lifespan)
+
+# 进行中的生成请求（相同请求合并为一次模型调用）
+generation_flights = SingleFlight()
 
 # 配置 CORS - 允许前端访问
 app.add_middleware(
@@ -40,6 +75,22 @@ class GenerateRequest(BaseModel):
     logo_image: Optional[str] = None  # Base64 编码的 Logo 图片
     qrcode_image: Optional[str] = None  # Base64 编码的二维码图片
     combo_images: Optional[List[str]] = None  # Base64 编码的品牌组合图片列表
+    timeout_seconds: Optional[float] = None  # 时间预算（秒），到期返回已完成的海报，默认 DEFAULT_REQUEST_TIMEOUT
+    safety_abort_after: Optional[int] = None  # 连续几次安全过滤后放弃整批（0 表示不放弃），默认由后端决定
+    fill_to_target: Optional[bool] = None  # 失败时立即补发，尽量返回 count 张，默认由后端决定
+    draft: bool = False  # 草稿模式：先生成低分辨率预览，选中的海报再调用 /api/finalize 定稿
+    accept_offer: Optional[str] = None  # 已确认使用的近似缓存候选（/api/cache/offer 返回的 offer_id）
+
+
+class FinalizeRequest(GenerateRequest):
+    draft_image: str  # Base64 编码的草稿海报（其余字段与生成草稿时相同）
+    image_size: str = "2k"  # 定稿分辨率："2k" 或 "4k"
+
+
+class UpscaleRequest(BaseModel):
+    image: str  # Base64 编码的海报
+    scale: float = 2.0  # 放大倍数（1-4）
+    sharpen: float = DEFAULT_SHARPEN  # 锐化强度，0 表示不锐化
 
 
 # 响应数据模型
@@ -50,6 +101,11 @@ class GenerateResponse(BaseModel):
     error_reason: Optional[str] = None  # 错误原因（部分成功时）
 
 
+class CacheOfferResponse(BaseModel):
+    offer_id: Optional[str] = None  # 近似缓存候选，没有时为 None
+    similarity: Optional[float] = None  # 估计的提示词相似度
+
+
 # 历史对话数据模型
 class Turn(BaseModel):
     prompt: str
@@ -137,106 +193,185 @@ async def root():
     return {
         "service": "MirrorPost AI API",
         "status": "running",
-        "version": "2.0"
+        "version": "2.0",
+        "circuit_breaker": circuit_breaker.stats(),
+        "api_keys": key_pool.stats()
+    }
+
+
+def build_final_prompt(request: GenerateRequest) -> str:
+    """拼接风格关键词与负向提示词，得到发送给后端的最终提示词"""
+    return compile_prompt(
+        request.prompt,
+        preset_style=request.preset_style,
+        style_strength=request.style_intensity,
+        negative_prompt=request.negative_prompt
+    )
+
+
+def generation_key(request: GenerateRequest) -> str:
+    """生成请求指纹：最终提示词、比例、数量、Thinking 模式以及所有图片素材的哈希"""
+    return fingerprint(
+        build_final_prompt(request),
+        request.aspect_ratio,
+        request.count,
+        request.thinking_mode,
+        request.reference_image,
+        request.logo_image,
+        request.qrcode_image,
+        request.combo_images or [],
+        request.safety_abort_after,
+        request.fill_to_target,
+        request.draft,
+        request.accept_offer
+    )
+
+
+def request_deadline(request: GenerateRequest) -> Deadline:
+    """根据请求的时间预算创建截止时间"""
+    seconds = request.timeout_seconds if request.timeout_seconds else DEFAULT_REQUEST_TIMEOUT
+    return Deadline(seconds)
+
+
+async def cancel_on_disconnect(http_request: Request, deadline: Deadline, waiter: Optional[asyncio.Future] = None):
+    """
+    调用方断开连接后停止为它生成
+
+    参数:
+        http_request (Request): 当前 HTTP 请求
+        deadline (Deadline): 本次生成的截止时间，调用方断开时取消
+        waiter (asyncio.Future): 合并请求时本调用方的等待；传入时只取消这次等待，
+            共享的生成由 generation_flights 在所有等待者都离开后停止
+    """
+    while not deadline.expired():
+        if await http_request.is_disconnected():
+            if waiter is None:
+                print("[API] 调用方已断开，取消剩余生成")
+                deadline.cancel()
+            else:
+                print("[API] 调用方已断开，退出等待")
+                waiter.cancel()
+            return
+        await asyncio.sleep(1.0)
+
+
+def preflight_request(request: GenerateRequest) -> dict:
+    """
+    预检请求并解码所有图片素材，不合法的请求以 4xx 拒绝，不调用模型
+
+    返回:
+        dict: 字段名 -> 解码后的图片（combo_images 为图片列表），未提供的字段为 None
+
+    异常:
+        HTTPException: 预检未通过（400 / 413）
+    """
+    images = {
+        "reference_image": request.reference_image,
+        "logo_image": request.logo_image,
+        "qrcode_image": request.qrcode_image
+    }
+    try:
+        if isinstance(request, FinalizeRequest):
+            if request.image_size not in FINAL_IMAGE_SIZES:
+                raise PreflightError("image_size", f"只支持 {' / '.join(FINAL_IMAGE_SIZES)}")
+            images["draft_image"] = request.draft_image
+        return validate_request(
+            request.prompt,
+            request.aspect_ratio,
+            request.count,
+            style_intensity=request.style_intensity,
+            timeout_seconds=request.timeout_seconds,
+            safety_abort_after=request.safety_abort_after,
+            images=images,
+            image_lists={"combo_images": request.combo_images}
+        )
+    except PreflightError as e:
+        print(f"[API] 预检未通过: {str(e)}")
+        raise HTTPException(status_code=e.status_code, detail=e.to_dict())
+
+
+def prepare_generation(request: GenerateRequest, assets: dict) -> dict:
+    """
+    将请求转换为后端生成参数：拼接提示词并带上预检时解码的图片素材
+
+    参数:
+        request (GenerateRequest): 生成请求
+        assets (dict): preflight_request 的返回值
+
+    返回:
+        dict: 可直接传给 generate_posters_async / iter_posters_async 的关键字参数
+    """
+    final_prompt = build_final_prompt(request)
+    reference_img = assets["reference_image"]
+    logo_img = assets["logo_image"]
+    qrcode_img = assets["qrcode_image"]
+    combo_imgs = assets["combo_images"]
+
+    print(f"\n[API] 收到生成请求:")
+    print(f"  - 提示词: {request.prompt}")
+    print(f"  - 比例: {request.aspect_ratio}")
+    print(f"  - 数量: {request.count}")
+    print(f"  - 风格: {request.preset_style}")
+    print(f"  - Thinking 模式: {request.thinking_mode}")
+    print(f"  - 图生图模式: {'是 (' + str(reference_img.size) + ')' if reference_img else '否'}")
+    print(f"  - Logo: {'是' if logo_img else '否'}")
+    print(f"  - 二维码: {'是' if qrcode_img else '否'}")
+    print(f"  - 品牌组合: {'是 (' + str(len(combo_imgs)) + ' 张)' if combo_imgs else '否'}")
+    print(f"  - 草稿模式: {'是' if request.draft else '否'}")
+    print(f"  - 时间预算: {request.timeout_seconds or DEFAULT_REQUEST_TIMEOUT} 秒")
+    print(f"  - 最终提示词: {final_prompt[:100]}...")
+
+    generation_kwargs = {
+        "user_prompt": final_prompt,
+        "aspect_ratio": request.aspect_ratio,
+        "num_images": request.count,
+        "thinking_mode": request.thinking_mode,
+        "reference_image": reference_img,
+        "logo_image": logo_img,
+        "qrcode_image": qrcode_img,
+        "combo_images": combo_imgs
     }
+    if request.safety_abort_after is not None:
+        generation_kwargs["safety_abort_after"] = request.safety_abort_after
+    if request.fill_to_target is not None:
+        generation_kwargs["fill_policy"] = FillPolicy() if request.fill_to_target else None
+    if request.draft:
+        generation_kwargs["image_size"] = DRAFT_IMAGE_SIZE
+    return generation_kwargs
 
 
 @app.post("/api/generate", response_model=GenerateResponse)
-async def generate(request: GenerateRequest):
+async def generate(request: GenerateRequest, http_request: Request):
     """
     生成海报 API
 
-    接收前端参数，调用后端生成逻辑，返回 Base64 图片
+    接收前端参数，调用后端生成逻辑，返回 Base64 图片。
+    超过时间预算或调用方断开时停止剩余生成，返回已完成的海报。
     """
-    try:
-        # 构建风格提示词
-        style_prompt = None
-        if request.preset_style != "Auto":
-            style_keywords = {
-                "Minimalist": "minimalist design, clean layout, simple geometric shapes, plenty of white space",
-                "Tech": "tech-inspired design, modern digital aesthetic, futuristic elements",
-                "Hand-drawn": "hand-drawn illustration style, warm colors, artistic and friendly"
-            }
-            style_keyword = style_keywords.get(request.preset_style, "")
-            if style_keyword:
-                style_prompt = f"{style_keyword}. Style strength: {request.style_intensity}"
-
-        # 合并提示词
-        final_prompt = request.prompt
-        if style_prompt:
-            final_prompt = f"{request.prompt}. Style: {style_prompt}"
-        if request.negative_prompt:
-            final_prompt = f"{final_prompt}. Avoid: {request.negative_prompt}"
-
-        # 处理参考图片（图生图）
-        reference_img = None
-        if request.reference_image:
-            try:
-                reference_img = base64_to_image(request.reference_image)
-                print(f"  - 参考图片: 已接收 ({reference_img.size})")
-            except Exception as e:
-                print(f"  - 参考图片解码失败: {str(e)}")
-
-        # 处理 Logo 图片
-        logo_img = None
-        if request.logo_image:
-            try:
-                logo_img = base64_to_image(request.logo_image)
-                print(f"  - Logo 图片: 已接收 ({logo_img.size})")
-            except Exception as e:
-                print(f"  - Logo 图片解码失败: {str(e)}")
-
-        # 处理二维码图片
-        qrcode_img = None
-        if request.qrcode_image:
-            try:
-                qrcode_img = base64_to_image(request.qrcode_image)
-                print(f"  - 二维码图片: 已接收 ({qrcode_img.size})")
-            except Exception as e:
-                print(f"  - 二维码图片解码失败: {str(e)}")
-
-        # 处理品牌组合图片
-        combo_imgs = None
-        if request.combo_images:
-            try:
-                combo_imgs = []
-                for i, img_b64 in enumerate(request.combo_images):
-                    img = base64_to_image(img_b64)
-                    combo_imgs.append(img)
-                print(f"  - 品牌组合图片: 已接收 {len(combo_imgs)} 张")
-            except Exception as e:
-                print(f"  - 品牌组合图片解码失败: {str(e)}")
-                combo_imgs = None
-
-        print(f"\n[API] 收到生成请求:")
-        print(f"  - 提示词: {request.prompt}")
-        print(f"  - 比例: {request.aspect_ratio}")
-        print(f"  - 数量: {request.count}")
-        print(f"  - 风格: {request.preset_style}")
-        print(f"  - Thinking 模式: {request.thinking_mode}")
-        print(f"  - 图生图模式: {'是' if reference_img else '否'}")
-        print(f"  - Logo: {'是' if logo_img else '否'}")
-        print(f"  - 二维码: {'是' if qrcode_img else '否'}")
-        print(f"  - 品牌组合: {'是 (' + str(len(combo_imgs)) + ' 张)' if combo_imgs else '否'}")
-        print(f"  - 最终提示词: {final_prompt[:100]}...")
-
-        # 调用后端生成
-        generated_images, error_reason = generate_posters(
-            user_prompt=final_prompt,
-            aspect_ratio=request.aspect_ratio,
-            num_images=request.count,
-            thinking_mode=request.thinking_mode,
-            reference_image=reference_img,
-            logo_image=logo_img,
-            qrcode_image=qrcode_img,
-            combo_images=combo_imgs
+    # 预检不合法的请求直接拒绝，不进入生成
+    assets = await asyncio.to_thread(preflight_request, request)  # 图片解码较慢，不阻塞事件循环
+    key = generation_key(request)
+    deadline = request_deadline(request)
+
+    async def run_generation():
+        generation_kwargs = prepare_generation(request, assets)
+
+        # 调用后端生成（异步，不阻塞事件循环）
+        generated_images, error_reason = await generate_posters_async(
+            **generation_kwargs, deadline=deadline, accept_offer=request.accept_offer
         )
 
-        # 转换为 Base64
-        base64_images = []
-        for img in generated_images:
-            base64_str = image_to_base64(img)
-            base64_images.append(base64_str)
+        # 转换为 Base64（PNG 编码较耗 CPU，放到线程中执行）
+        base64_images = await asyncio.to_thread(
+            lambda: [image_to_base64(img) for img in generated_images]
+        )
+        return base64_images, error_reason
+
+    # 相同请求仍在生成时直接共享其结果（如前端重复提交）；所有调用方都断开后才取消共享的生成
+    flight = asyncio.ensure_future(generation_flights.do(key, run_generation, on_abandon=deadline.cancel))
+    watcher = asyncio.create_task(cancel_on_disconnect(http_request, deadline, flight))
+    try:
+        base64_images, error_reason = await flight
 
         print(f"[API] 成功生成 {len(base64_images)} 张海报")
         if error_reason:
@@ -249,6 +384,27 @@ async def generate(request: GenerateRequest):
             error_reason=error_reason
         )
 
+    except asyncio.CancelledError:
+        # 调用方已断开（watcher 取消了本次等待），响应无人接收
+        if not (flight.cancelled() and watcher.done()):
+            raise
+        raise HTTPException(status_code=499, detail="调用方已断开")
+
+    except BatchAbortedError as e:
+        # 提示词反复触发安全过滤，整批提前中止
+        print(f"[API] 生成中止: {str(e)}")
+        raise HTTPException(status_code=422, detail=e.to_dict())
+
+    except CircuitOpenError as e:
+        # 图像服务故障，熔断期间快速失败
+        print(f"[API] 熔断中: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
+
+    except DeadlineExceeded as e:
+        # 时间预算内没有完成任何海报
+        print(f"[API] 生成超时: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
+
     except ValueError as e:
         # 配置错误（如缺少 API Key）
         print(f"[API] 配置错误: {str(e)}")
@@ -259,6 +415,178 @@ async def generate(request: GenerateRequest):
         print(f"[API] 生成失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"生成失败: {str(e)}")
 
+    finally:
+        watcher.cancel()
+
+
+@app.post("/api/cache/offer", response_model=CacheOfferResponse)
+async def cache_offer(request: GenerateRequest):
+    """
+    近似缓存候选 API
+
+    查找素材相同、提示词相近的已缓存结果，不调用模型。近似结果不会被自动使用（改了颜色或主体的提示词
+    相似度也可能很高），由前端询问用户，确认后把 offer_id 作为 accept_offer 随 /api/generate 提交。
+    """
+    assets = await asyncio.to_thread(preflight_request, request)
+    generation_kwargs = prepare_generation(request, assets)
+    offer = await asyncio.to_thread(
+        find_cache_offer,
+        generation_kwargs["user_prompt"],
+        aspect_ratio=request.aspect_ratio,
+        num_images=request.count,
+        thinking_mode=request.thinking_mode,
+        reference_image=generation_kwargs["reference_image"],
+        logo_image=generation_kwargs["logo_image"],
+        qrcode_image=generation_kwargs["qrcode_image"],
+        combo_images=generation_kwargs["combo_images"],
+        image_size=generation_kwargs.get("image_size", DEFAULT_IMAGE_SIZE)
+    )
+    return CacheOfferResponse(**offer) if offer else CacheOfferResponse()
+
+
+@app.post("/api/generate/stream")
+async def generate_stream(request: GenerateRequest):
+    """
+    流式生成海报 API
+
+    以 NDJSON 逐行返回：每完成一张海报立即输出一行
+    {"index", "success", "image", "error_reason", "elapsed"}，最后输出一行 {"done": true, "count"}。
+    超过时间预算时未完成的海报以失败行输出；调用方断开时停止生成。
+    """
+    assets = await asyncio.to_thread(preflight_request, request)
+
+    try:
+        circuit_breaker.check()
+    except CircuitOpenError as e:
+        print(f"[API] 熔断中: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
+
+    try:
+        generation_kwargs = prepare_generation(request, assets)
+        generation_kwargs["deadline"] = request_deadline(request)
+    except Exception as e:
+        print(f"[API] 请求解析失败: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def event_stream():
+        succeeded = 0
+        try:
+            async for result in iter_posters_async(**generation_kwargs, accept_offer=request.accept_offer):
+                image_b64 = None
+                if result.success:
+                    succeeded += 1
+                    image_b64 = await asyncio.to_thread(image_to_base64, result.image)
+                yield json.dumps({
+                    "index": result.index,
+                    "success": result.success,
+                    "image": image_b64,
+                    "error_reason": result.error_reason,
+                    "elapsed": round(result.elapsed, 2)
+                }, ensure_ascii=False) + "\n"
+        except Exception as e:
+            print(f"[API] 流式生成失败: {str(e)}")
+            yield json.dumps({"error": f"生成失败: {str(e)}"}, ensure_ascii=False) + "\n"
+
+        print(f"[API] 流式生成完成: {succeeded}/{request.count} 张")
+        yield json.dumps({"done": True, "count": succeeded}) + "\n"
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
+@app.post("/api/finalize", response_model=GenerateResponse)
+async def finalize(request: FinalizeRequest, http_request: Request):
+    """
+    草稿定稿 API
+
+    以 2k / 4k 重新渲染一张草稿海报：草稿作为参考图，保持构图、文字与配色，只提高分辨率与细节。
+    请求中的提示词、风格与素材应与生成草稿时相同。
+    """
+    assets = await asyncio.to_thread(preflight_request, request)
+    draft_img = assets["draft_image"]
+
+    generation_kwargs = prepare_generation(request, assets)
+    print(f"  - 定稿分辨率: {request.image_size}（草稿 {draft_img.size}）")
+
+    deadline = request_deadline(request)
+    watcher = asyncio.create_task(cancel_on_disconnect(http_request, deadline))
+    try:
+        final_image = await finalize_poster_async(
+            draft_img,
+            generation_kwargs["user_prompt"],
+            aspect_ratio=request.aspect_ratio,
+            image_size=request.image_size,
+            logo_image=generation_kwargs["logo_image"],
+            qrcode_image=generation_kwargs["qrcode_image"],
+            combo_images=generation_kwargs["combo_images"],
+            deadline=deadline
+        )
+        image_b64 = await asyncio.to_thread(image_to_base64, final_image)
+
+        print(f"[API] 定稿完成: {final_image.size}")
+        return GenerateResponse(
+            success=True,
+            images=[image_b64],
+            message=f"已生成 {request.image_size} 定稿"
+        )
+
+    except CircuitOpenError as e:
+        print(f"[API] 熔断中: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
+
+    except DeadlineExceeded as e:
+        print(f"[API] 定稿超时: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
+
+    except ValueError as e:
+        # 分辨率不支持、缺少 API Key 或定稿失败
+        print(f"[API] 定稿失败: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+    except Exception as e:
+        print(f"[API] 定稿失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"定稿失败: {str(e)}")
+
+    finally:
+        watcher.cancel()
+
+
+@app.post("/api/upscale", response_model=GenerateResponse)
+async def upscale_poster(request: UpscaleRequest):
+    """
+    印刷放大 API
+
+    在本地放大一张海报（分块 Lanczos 重采样 + 锐化，多进程并行），不调用模型。
+    """
+    try:
+        # 放大倍数必须大于 1（1 倍不需要放大，upscale 也不接受）
+        if not 1.0 < request.scale <= MAX_SCALE:
+            raise PreflightError("scale", f"取值 {request.scale} 超出范围 (1, {MAX_SCALE:g}]")
+        check_range("sharpen", request.sharpen, 0.0, 2.0)
+        image = await asyncio.to_thread(decode_image, "image", request.image)
+    except PreflightError as e:
+        print(f"[API] 预检未通过: {str(e)}")
+        raise HTTPException(status_code=e.status_code, detail=e.to_dict())
+
+    try:
+        upscaled = await asyncio.to_thread(upscale, image, request.scale, request.sharpen)
+        image_b64 = await asyncio.to_thread(image_to_base64, upscaled)
+
+        print(f"[API] 放大完成: {image.size} -> {upscaled.size}")
+        return GenerateResponse(
+            success=True,
+            images=[image_b64],
+            message=f"已放大到 {upscaled.width}x{upscaled.height}"
+        )
+
+    except ValueError as e:
+        # 放大倍数不支持或输出过大
+        print(f"[API] 放大失败: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+    except Exception as e:
+        print(f"[API] 放大失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"放大失败: {str(e)}")
+
 
 # ============= 历史对话 API =============
 
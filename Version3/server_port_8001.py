@@ -1,18 +1,35 @@
 # FastAPI Server - Using Port 8001
 # This is a copy of server.py with modified port
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List
+import asyncio
 import base64
+import os
 from io import BytesIO
 from PIL import Image
 
 from backend import generate_posters
+from client_manager import client_manager
+
+# Warm up model connections on startup (set MIRRORPOST_WARMUP=0 to disable)
+WARM_UP_ON_STARTUP = os.getenv("MIRRORPOST_WARMUP", "1") != "0"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """App lifespan: warm up the shared client, close its pools on exit"""
+    if WARM_UP_ON_STARTUP:
+        await asyncio.to_thread(client_manager.warm_up)
+    yield
+    client_manager.close_all()
+
 
 # Create FastAPI app
-app = FastAPI(title="MirrorPost AI API", version="2.0")
+app = FastAPI(title="MirrorPost AI API", version="2.0", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -0,0 +1,100 @@
+# MirrorPost AI - 请求合并模块
+# 相同的请求在第一个仍在执行时到达，直接等待第一个的结果，不再重复调用模型
+
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+def fingerprint(*parts: Optional[Any]) -> str:
+    """
+    计算请求指纹：对各部分（字符串、数字、布尔值、None 或它们的列表）做 SHA-256
+
+    参数:
+        parts: 参与计算的请求字段，顺序有意义
+
+    返回:
+        str: 十六进制摘要
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            digest.update(f"[{len(part)}]".encode("utf-8"))
+            for item in part:
+                digest.update(hashlib.sha256(str(item).encode("utf-8")).digest())
+        else:
+            digest.update(hashlib.sha256(repr(part).encode("utf-8")).digest())
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class SingleFlight:
+    """请求合并器：同一 key 同时只执行一次，后到的调用共享第一次的结果"""
+
+    def __init__(self):
+        """初始化请求合并器"""
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self._on_abandon: Dict[asyncio.Task, Callable[[], None]] = {}
+        self.coalesced_count = 0
+
+    async def do(
+        self,
+        key: str,
+        func: Callable[[], Awaitable[Any]],
+        on_abandon: Optional[Callable[[], None]] = None
+    ) -> Any:
+        """
+        执行或加入一个进行中的调用
+
+        等待者按引用计数：某个等待者被取消（如调用方断开）只退出它自己的等待；
+        所有等待者都退出而调用仍未完成时，已经没有人需要结果，调用 on_abandon 停止共享的调用，
+        之后到达的相同请求重新执行。
+
+        参数:
+            key (str): 请求指纹
+            func (Callable): 无参协程函数，仅在没有进行中的同 key 调用时执行
+            on_abandon (Callable): 发起调用的一方提供的停止方式（如取消截止时间），默认直接取消任务；
+                加入已有调用时忽略
+
+        返回:
+            Any: func 的结果（异常同样会传给所有等待者）
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            self._on_abandon[task] = on_abandon or task.cancel
+
+            def forget(done_task: asyncio.Task):
+                if self._in_flight.get(key) is done_task:
+                    del self._in_flight[key]
+                self._on_abandon.pop(done_task, None)
+
+            task.add_done_callback(forget)
+        else:
+            self.coalesced_count += 1
+            print(f"[SingleFlight] 合并重复请求: {key[:12]}")
+
+        # shield：某个等待者被取消时不取消其他人共享的任务
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    print(f"[SingleFlight] 等待者已全部离开，停止请求: {key[:12]}")
+                    if self._in_flight.get(key) is task:
+                        del self._in_flight[key]
+                    self._on_abandon.pop(task)()
+
+    def waiters(self, key: str) -> int:
+        """正在等待某个请求结果的调用方数量"""
+        task = self._in_flight.get(key)
+        return self._waiters.get(task, 0) if task else 0
+
+    def in_flight(self) -> int:
+        """当前进行中的不同请求数"""
+        return len(self._in_flight)
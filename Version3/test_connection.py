@@ -26,7 +26,8 @@ def test_generate_simple():
             "count": 1,
             "preset_style": "Auto",
             "style_intensity": 0.5,
-            "thinking_mode": False  # 使用快速模式测试
+            "thinking_mode": False,  # 使用快速模式测试
+            "timeout_seconds": 55  # 略短于客户端超时，服务器在客户端放弃前返回
         }
 
         print("\n发送测试请求...")
@@ -0,0 +1,172 @@
+# MirrorPost AI - 本地放大模块
+# 印刷导出时在本地放大海报：分块 Lanczos 重采样 + 锐化，多进程并行处理各块，不调用模型
+
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image, ImageFilter
+
+# 加载环境变量
+load_dotenv()
+
+# 放大参数（可通过环境变量覆盖）
+UPSCALE_WORKERS = int(os.getenv("MIRRORPOST_UPSCALE_WORKERS", str(os.cpu_count() or 2)))
+MAX_OUTPUT_PIXELS = int(float(os.getenv("MIRRORPOST_UPSCALE_MAX_MP", "100")) * 1_000_000)
+MAX_SCALE = 4.0
+DEFAULT_SHARPEN = 0.6
+
+# 每块的源图边长（像素）；每块外扩的边距要覆盖 Lanczos 核与锐化模糊的范围，拼接处才没有接缝
+TILE_SIZE = 512
+TILE_MARGIN = 8
+SHARPEN_RADIUS = 1.2  # 锐化模糊半径（输出像素）
+
+# 输出小于这个像素数时在当前进程内直接处理，进程间传输的开销不划算
+INLINE_PIXELS = 4_000_000
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _tile_boxes(width: int, height: int, scale: float, tile_size: int) -> List[Tuple[int, int, int, int]]:
+    """按源图分块，返回每块在输出图上的区域（相邻块在输出坐标上首尾相接）"""
+    out_width, out_height = round(width * scale), round(height * scale)
+    boxes = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            boxes.append((
+                round(x * scale), round(y * scale),
+                out_width if x + tile_size >= width else round((x + tile_size) * scale),
+                out_height if y + tile_size >= height else round((y + tile_size) * scale)
+            ))
+    return boxes
+
+
+def _upscale_tile(patch: np.ndarray, origin: Tuple[int, int], out_box: Tuple[int, int, int, int],
+                  padded_box: Tuple[int, int, int, int], scale: float, sharpen: float) -> np.ndarray:
+    """
+    放大一块（在进程池中执行）
+
+    参数:
+        patch (np.ndarray): 含边距的源图块
+        origin (tuple): 源图块左上角在源图中的坐标
+        out_box (tuple): 这一块在输出图上的区域
+        padded_box (tuple): 外扩边距后的输出区域，锐化后裁回 out_box
+        scale (float): 放大倍数
+        sharpen (float): 锐化强度，0 表示不锐化
+
+    返回:
+        np.ndarray: 输出区域的像素
+    """
+    ox0, oy0, ox1, oy1 = out_box
+    px0, py0, px1, py1 = padded_box
+
+    # 输出像素对应的源图坐标（浮点），各块使用同一映射，拼接处逐像素一致
+    height, width = patch.shape[:2]
+    box = (
+        max(0.0, px0 / scale - origin[0]), max(0.0, py0 / scale - origin[1]),
+        min(float(width), px1 / scale - origin[0]), min(float(height), py1 / scale - origin[1])
+    )
+    image = Image.fromarray(patch).resize((px1 - px0, py1 - py0), Image.LANCZOS, box=box)
+
+    pixels = np.asarray(image, dtype=np.float32)
+    if sharpen > 0:
+        # 反锐化掩模：原图 + 强度 ×（原图 - 模糊图）
+        blurred = np.asarray(image.filter(ImageFilter.GaussianBlur(SHARPEN_RADIUS)), dtype=np.float32)
+        pixels = pixels + sharpen * (pixels - blurred)
+    return np.clip(pixels[oy0 - py0:oy1 - py0, ox0 - px0:ox1 - px0], 0, 255).astype(np.uint8)
+
+
+def _get_pool(max_workers: int) -> ProcessPoolExecutor:
+    """获取进程池（首次使用时创建，之后复用）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=max_workers)
+            print(f"[Upscale] 已创建 {max_workers} 个放大进程")
+        return _pool
+
+
+def shutdown_pool():
+    """关闭进程池（应用退出时调用）"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def upscale(
+    image: Image.Image,
+    scale: float = 2.0,
+    sharpen: float = DEFAULT_SHARPEN,
+    max_workers: int = UPSCALE_WORKERS,
+    tile_size: int = TILE_SIZE
+) -> Image.Image:
+    """
+    在本地放大海报（印刷导出）
+
+    源图按 tile_size 分块，每块带边距做 Lanczos 重采样与反锐化掩模，再写入输出图。
+    同时在处理中的块不超过 2 × max_workers 个，内存占用与整图大小无关（输出图本身除外）。
+
+    参数:
+        image (Image.Image): 海报
+        scale (float): 放大倍数，大于 1 且不超过 4
+        sharpen (float): 锐化强度，0 表示不锐化
+        max_workers (int): 并行进程数，1 表示在当前进程内处理
+        tile_size (int): 每块的源图边长
+
+    返回:
+        Image.Image: 放大后的海报
+
+    异常:
+        ValueError: 放大倍数超出范围或输出过大
+    """
+    if not 1.0 < scale <= MAX_SCALE:
+        raise ValueError(f"放大倍数需大于 1 且不超过 {MAX_SCALE:g} 倍")
+    out_width, out_height = round(image.width * scale), round(image.height * scale)
+    if out_width * out_height > MAX_OUTPUT_PIXELS:
+        raise ValueError(f"放大后 {out_width}x{out_height} 超过 {MAX_OUTPUT_PIXELS // 1_000_000} 百万像素上限")
+
+    source = image if image.mode in ("RGB", "RGBA") else image.convert("RGB")
+    pixels = np.asarray(source)
+    output = Image.new(source.mode, (out_width, out_height))
+
+    # 输出区域外扩的边距（输出像素），覆盖锐化模糊的范围
+    pad = int(TILE_MARGIN * scale / 2)
+
+    def tile_args(out_box):
+        # 输出区域对应的源图范围，外扩边距覆盖 Lanczos 核
+        ox0, oy0, ox1, oy1 = out_box
+        padded_box = (max(0, ox0 - pad), max(0, oy0 - pad), min(out_width, ox1 + pad), min(out_height, oy1 + pad))
+        x0 = max(0, int(ox0 / scale) - TILE_MARGIN)
+        y0 = max(0, int(oy0 / scale) - TILE_MARGIN)
+        x1 = min(source.width, int(np.ceil(ox1 / scale)) + TILE_MARGIN)
+        y1 = min(source.height, int(np.ceil(oy1 / scale)) + TILE_MARGIN)
+        return pixels[y0:y1, x0:x1].copy(), (x0, y0), out_box, padded_box, scale, sharpen
+
+    boxes = _tile_boxes(source.width, source.height, scale, tile_size)
+    if max_workers <= 1 or len(boxes) == 1 or out_width * out_height < INLINE_PIXELS:
+        for out_box in boxes:
+            output.paste(Image.fromarray(_upscale_tile(*tile_args(out_box))), out_box[:2])
+        return output
+
+    # 多进程处理：限制同时在途的块数，边处理边写入输出图
+    pool = _get_pool(max_workers)
+    pending = {}
+    remaining = iter(boxes)
+    while True:
+        while len(pending) < 2 * max_workers:
+            out_box = next(remaining, None)
+            if out_box is None:
+                break
+            pending[pool.submit(_upscale_tile, *tile_args(out_box))] = out_box
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            output.paste(Image.fromarray(future.result()), pending.pop(future)[:2])
+    return output
@@ -1,13 +1,24 @@
 # MirrorPost AI - 前端界面
 # 此文件使用 Streamlit 构建用户界面
 
-import os
+import uuid
+from io import BytesIO
+
 import streamlit as st
 from dotenv import load_dotenv
 from PIL import Image
-from backend import generate_posters
+from backend import (
+    DRAFT_IMAGE_SIZE, FINAL_IMAGE_SIZES, build_request, finalize_poster, generate_posters, iter_posters
+)
+from fill_policy import FillPolicy
 from style_manager import StyleManager
 from asset_manager import AssetManager
+from client_manager import client_manager
+from key_pool import key_pool
+from prompt_compiler import TOKEN_BUDGET, brief_tokens, compile_prompt
+from refine_manager import refine_manager
+from relayout import RELAYOUT_RATIOS, relayout_all, save_relayouts
+from upscaler import upscale
 
 # 加载环境变量
 load_dotenv()
@@ -331,6 +342,8 @@ if "generated_images" not in st.session_state:
     st.session_state.generated_images = []
 if "current_prompt" not in st.session_state:
     st.session_state.current_prompt = ""
+if "refinements" not in st.session_state:
+    st.session_state.refinements = []
 if "current_config" not in st.session_state:
     st.session_state.current_config = {}
 if "selected_image_idx" not in st.session_state:
@@ -339,11 +352,54 @@ if "show_upload_voice" not in st.session_state:
     st.session_state.show_upload_voice = False
 if "thinking_mode" not in st.session_state:
     st.session_state.thinking_mode = True
+if "fill_to_target" not in st.session_state:
+    st.session_state.fill_to_target = False
+if "draft_mode" not in st.session_state:
+    st.session_state.draft_mode = False
+if "finalized_indices" not in st.session_state:
+    st.session_state.finalized_indices = set()
+if "poster_ids" not in st.session_state:
+    st.session_state.poster_ids = []
+if "relayouts" not in st.session_state:
+    st.session_state.relayouts = {}
+if "upscaled" not in st.session_state:
+    st.session_state.upscaled = None
 if "show_asset_manager" not in st.session_state:
     st.session_state.show_asset_manager = False
 
-# 获取 API Key
-api_key = os.getenv("GOOGLE_API_KEY")
+# 是否已配置 API Key（GOOGLE_API_KEYS 或 GOOGLE_API_KEY）
+api_key = key_pool.size() > 0
+
+
+@st.cache_resource
+def warm_up_client():
+    """预热共享客户端连接（每个进程只执行一次）"""
+    return client_manager.warm_up(background=True)
+
+
+if api_key:
+    warm_up_client()
+
+
+def refine_request(config: dict, image_size: str) -> tuple:
+    """微调对话所需的 (提示词, 模型配置)：对话只带提示词摘要与海报，不再附带素材"""
+    _, request_config = build_request(
+        config["final_prompt"],
+        aspect_ratio=config["aspect_ratio"],
+        thinking_mode=False,
+        image_size=image_size
+    )
+    return config["final_prompt"], request_config
+
+
+def register_refine_sessions(images: list, config: dict) -> list:
+    """为每张海报登记微调对话，之后的「继续优化」「应用微调」只发送修改指令；返回海报编号"""
+    prompt, request_config = refine_request(config, DRAFT_IMAGE_SIZE if config.get("draft") else "2k")
+    batch_id = uuid.uuid4().hex[:8]
+    poster_ids = [f"{batch_id}-{i}" for i in range(len(images))]
+    for poster_id, image in zip(poster_ids, images):
+        refine_manager.start(poster_id, image, prompt, request_config)
+    return poster_ids
 
 # ========== 侧边栏：控制台 ==========
 with st.sidebar:
@@ -463,6 +519,20 @@ with st.sidebar:
         )
         st.session_state.thinking_mode = thinking_mode_sidebar
 
+        # 补足数量
+        st.session_state.fill_to_target = st.checkbox(
+            "失败时自动补足数量",
+            value=st.session_state.fill_to_target,
+            help="某张生成失败时立即补发一张，尽量凑满所选数量（最多额外补发一半）"
+        )
+
+        # 草稿模式
+        st.session_state.draft_mode = st.checkbox(
+            "草稿模式（先出低清预览）",
+            value=st.session_state.draft_mode,
+            help="先快速生成低分辨率草稿，在 🔍 预览中选中满意的海报再以 2K/4K 定稿"
+        )
+
 # ========== 主界面 ==========
 
 # 主标题
@@ -585,6 +655,24 @@ if st.session_state.show_upload_voice:
         if audio_bytes:
             st.caption("⚠️ 需要 Speech API")
 
+
+def build_final_prompt(base_prompt: str, refinements: list = ()) -> str:
+    """按侧边栏的风格配置编译发送给后端的最终提示词"""
+    custom_style_prompt = None
+    if selected_custom_style != "不使用":
+        selected_style = style_manager.load_style(selected_custom_style)
+        if selected_style:
+            custom_style_prompt = selected_style.get("user_prompt")
+    return compile_prompt(
+        base_prompt,
+        refinements,
+        preset_style=preset_style,
+        style_strength=style_strength,
+        custom_style=custom_style_prompt,
+        negative_prompt=negative_prompt
+    )
+
+
 # 生成逻辑
 if generate_button:
     if not user_prompt:
@@ -593,35 +681,12 @@ if generate_button:
         st.error("❌ 请先在 .env 文件中设置 GOOGLE_API_KEY")
     else:
         try:
-            # 构建完整的提示词
-            final_prompt = user_prompt
-
-            # 添加预设风格关键词
-            style_keywords = {
-                "自动匹配 (Auto)": "",
-                "极简主义 (Minimalist)": "minimalist design, clean layout, simple geometric shapes, plenty of white space",
-                "赛博朋克 (Cyberpunk)": "cyberpunk style, neon colors, futuristic elements, tech-inspired, dark background with bright accents",
-                "商务科技 (Tech Corporate)": "professional business style, modern tech aesthetic, corporate colors, clean and sophisticated",
-                "温暖手绘 (Warm Illustration)": "warm hand-drawn illustration style, friendly and approachable, soft colors, artistic touch"
-            }
+            # 描述本身超出提示词预算时完整保留，但之后的优化指令与自定义风格会被省略，提前提示
+            if TOKEN_BUDGET and brief_tokens(user_prompt) > TOKEN_BUDGET:
+                st.warning(f"⚠️ 海报描述超过 {TOKEN_BUDGET} token 预算，自定义风格与后续优化指令可能被省略，建议精简")
 
-            # 拼接风格关键词
-            if preset_style != "自动匹配 (Auto)" and style_keywords.get(preset_style):
-                style_keyword = style_keywords[preset_style]
-                final_prompt = f"{user_prompt}. Style: {style_keyword}. Style strength: {style_strength}"
-
-            # 获取自定义风格提示词
-            custom_style_prompt = None
-            if selected_custom_style != "不使用":
-                selected_style = style_manager.load_style(selected_custom_style)
-                if selected_style:
-                    custom_style_prompt = selected_style.get("user_prompt")
-                    if custom_style_prompt:
-                        final_prompt = f"{final_prompt}. {custom_style_prompt}"
-
-            # 添加负向提示词（如果有）
-            if negative_prompt:
-                final_prompt = f"{final_prompt}. Avoid: {negative_prompt}"
+            # 构建完整的提示词
+            final_prompt = build_final_prompt(user_prompt)
 
             # 加载素材
             logo_image = None
@@ -649,26 +714,60 @@ if generate_button:
             thinking_mode = st.session_state.thinking_mode
             spinner_text = "AI 正在思考设计方案并绘图..." if thinking_mode else "AI 正在快速生成海报..."
 
-            with st.spinner(spinner_text):
-                # 调用后端批量生成
-                generated_images = generate_posters(
-                    user_prompt=final_prompt,
-                    aspect_ratio=aspect_ratio,
-                    num_images=num_images,
-                    thinking_mode=thinking_mode,
-                    reference_image=reference_image,
-                    style_prompt=None,  # 已经拼接到final_prompt中
-                    logo_image=logo_image,
-                    qrcode_image=qrcode_image
+            # 流式生成：每完成一张立即显示，不必等整批结束
+            progress_bar = st.progress(0.0, text=spinner_text)
+            preview_area = st.empty()
+            finished_images = {}
+            completed = 0
+
+            for result in iter_posters(
+                user_prompt=final_prompt,
+                aspect_ratio=aspect_ratio,
+                num_images=num_images,
+                thinking_mode=thinking_mode,
+                reference_image=reference_image,
+                style_prompt=None,  # 已经拼接到final_prompt中
+                logo_image=logo_image,
+                qrcode_image=qrcode_image,
+                fill_policy=FillPolicy() if st.session_state.fill_to_target else None,
+                image_size=DRAFT_IMAGE_SIZE if st.session_state.draft_mode else "2k"
+            ):
+                completed += 1
+                progress_bar.progress(
+                    completed / num_images,
+                    text=f"已完成 {completed}/{num_images} 张（{result.elapsed:.0f} 秒）"
                 )
+                if result.image is not None:
+                    finished_images[result.index] = result.image
+                    with preview_area.container():
+                        preview_cols = st.columns(4)
+                        for k, idx in enumerate(sorted(finished_images)):
+                            preview_cols[k % 4].image(finished_images[idx], use_container_width=True)
+
+            progress_bar.empty()
+            preview_area.empty()
+
+            if not finished_images:
+                raise ValueError("所有海报生成均失败")
+            generated_images = [finished_images[idx] for idx in sorted(finished_images)]
 
             # 保存到 session state
             st.session_state.generated_images = generated_images
             st.session_state.current_prompt = user_prompt
+            st.session_state.refinements = []
             st.session_state.current_config = {
                 "aspect_ratio": aspect_ratio,
-                "thinking_mode": thinking_mode
+                "thinking_mode": thinking_mode,
+                "draft": st.session_state.draft_mode,
+                # 定稿时沿用生成草稿的提示词与素材
+                "final_prompt": final_prompt,
+                "reference_image": reference_image,
+                "logo_image": logo_image,
+                "qrcode_image": qrcode_image
             }
+            st.session_state.finalized_indices = set()
+            st.session_state.relayouts = {}
+            st.session_state.poster_ids = register_refine_sessions(generated_images, st.session_state.current_config)
 
             st.success(f"✅ 成功生成 {len(generated_images)} 张海报！")
             st.info("💾 所有海报已保存至 `generated_posters/` 文件夹")
@@ -721,36 +820,32 @@ if st.session_state.generated_images:
     if st.button("⚡ 重新生成", type="secondary", use_container_width=True):
         if refine_prompt:
             try:
-                # 合并原始提示词和优化指令
-                combined_prompt = f"{st.session_state.current_prompt}. {refine_prompt}"
-
-                # 应用风格配置
-                final_refine_prompt = combined_prompt
-
-                # 添加预设风格关键词
-                style_keywords = {
-                    "自动匹配 (Auto)": "",
-                    "极简主义 (Minimalist)": "minimalist design, clean layout, simple geometric shapes, plenty of white space",
-                    "赛博朋克 (Cyberpunk)": "cyberpunk style, neon colors, futuristic elements, tech-inspired, dark background with bright accents",
-                    "商务科技 (Tech Corporate)": "professional business style, modern tech aesthetic, corporate colors, clean and sophisticated",
-                    "温暖手绘 (Warm Illustration)": "warm hand-drawn illustration style, friendly and approachable, soft colors, artistic touch"
-                }
-
-                if preset_style != "自动匹配 (Auto)" and style_keywords.get(preset_style):
-                    style_keyword = style_keywords[preset_style]
-                    final_refine_prompt = f"{combined_prompt}. Style: {style_keyword}. Style strength: {style_strength}"
-
-                # 获取自定义风格
-                if selected_custom_style != "不使用":
-                    selected_style = style_manager.load_style(selected_custom_style)
-                    if selected_style:
-                        custom_style_prompt = selected_style.get("user_prompt")
-                        if custom_style_prompt:
-                            final_refine_prompt = f"{final_refine_prompt}. {custom_style_prompt}"
+                # 之前的优化指令加上本轮指令
+                refinements = st.session_state.refinements + [refine_prompt]
+
+                # 每张海报先在自己的微调对话中发送优化指令（对话过期或调用失败的海报不在结果中）
+                poster_ids = st.session_state.poster_ids
+                refined = {}
+                if poster_ids:
+                    with st.spinner("AI 正在根据你的反馈修改海报..."):
+                        refined = refine_manager.refine_many(poster_ids, refine_prompt)
+                    for k, poster_id in enumerate(poster_ids):
+                        if poster_id in refined:
+                            # 修改后的海报需要重新定稿、改版
+                            st.session_state.generated_images[k] = refined[poster_id]
+                            st.session_state.finalized_indices.discard(k)
+                            st.session_state.relayouts.pop(k, None)
+                failed = [k for k, poster_id in enumerate(poster_ids) if poster_id not in refined]
+                if refined and not failed:
+                    st.session_state.refinements = refinements
+                    st.session_state.current_config["final_prompt"] = build_final_prompt(
+                        st.session_state.current_prompt, refinements
+                    )
+                    st.success(f"✅ 已根据反馈修改 {len(refined)} 张海报！")
+                    st.rerun()
 
-                # 添加负向提示词
-                if negative_prompt:
-                    final_refine_prompt = f"{final_refine_prompt}. Avoid: {negative_prompt}"
+                # 对话修改失败的海报：重建完整提示词重新生成
+                final_refine_prompt = build_final_prompt(st.session_state.current_prompt, refinements)
 
                 # 加载素材
                 logo_image = None
@@ -770,25 +865,55 @@ if st.session_state.generated_images:
                     if qrcodes:
                         qrcode_image = asset_manager.load_qrcode(qrcodes[0])
 
+                # 只补生成部分海报时沿用这批海报的比例与设置，整批重新生成时使用侧边栏的当前设置
+                batch_config = st.session_state.current_config
+                regen_settings = {
+                    "aspect_ratio": batch_config["aspect_ratio"] if refined else aspect_ratio,
+                    "thinking_mode": batch_config["thinking_mode"] if refined else st.session_state.thinking_mode,
+                    "draft": batch_config.get("draft") if refined else st.session_state.draft_mode
+                }
+
                 spinner_text = "AI 正在根据你的反馈重新生成..."
 
                 with st.spinner(spinner_text):
-                    # 重新生成
+                    # 重新生成（部分海报已在对话中修改时，只补生成失败的那几张）
                     generated_images = generate_posters(
                         user_prompt=final_refine_prompt,
-                        aspect_ratio=aspect_ratio,
-                        num_images=num_images,
-                        thinking_mode=st.session_state.thinking_mode,
+                        aspect_ratio=regen_settings["aspect_ratio"],
+                        num_images=len(failed) if refined else num_images,
+                        thinking_mode=regen_settings["thinking_mode"],
                         reference_image=reference_image,
                         style_prompt=None,
                         logo_image=logo_image,
-                        qrcode_image=qrcode_image
+                        qrcode_image=qrcode_image,
+                        image_size=DRAFT_IMAGE_SIZE if regen_settings["draft"] else "2k"
                     )
 
-                # 更新 session state
-                st.session_state.generated_images = generated_images
-                st.session_state.current_prompt = combined_prompt
-                st.success(f"✅ 已根据反馈重新生成 {len(generated_images)} 张海报！")
+                # 更新 session state（之后的定稿、改版使用实际生成这批海报的配置）
+                st.session_state.refinements = refinements
+                st.session_state.current_config.update({
+                    **regen_settings,
+                    "final_prompt": final_refine_prompt,
+                    "reference_image": reference_image,
+                    "logo_image": logo_image,
+                    "qrcode_image": qrcode_image
+                })
+                new_ids = register_refine_sessions(generated_images, st.session_state.current_config)
+                if refined:
+                    for k, image, poster_id in zip(failed, generated_images, new_ids):
+                        st.session_state.generated_images[k] = image
+                        st.session_state.poster_ids[k] = poster_id
+                        st.session_state.finalized_indices.discard(k)
+                        st.session_state.relayouts.pop(k, None)
+                    st.success(
+                        f"✅ 已根据反馈修改 {len(refined)} 张海报，重新生成 {len(generated_images)} 张！"
+                    )
+                else:
+                    st.session_state.generated_images = generated_images
+                    st.session_state.finalized_indices = set()
+                    st.session_state.relayouts = {}
+                    st.session_state.poster_ids = new_ids
+                    st.success(f"✅ 已根据反馈重新生成 {len(generated_images)} 张海报！")
                 st.rerun()
 
             except Exception as e:
@@ -810,7 +935,9 @@ if st.session_state.generated_images:
                         if style_name:
                             style_manager.save_style(
                                 name=style_name,
-                                user_prompt=st.session_state.current_prompt,
+                                user_prompt=compile_prompt(
+                                    st.session_state.current_prompt, st.session_state.refinements
+                                ),
                                 aspect_ratio=st.session_state.current_config["aspect_ratio"],
                                 thinking_mode=st.session_state.current_config["thinking_mode"],
                                 description=style_desc
@@ -838,6 +965,107 @@ if st.session_state.generated_images:
                 # 显示大图
                 st.image(images[idx], use_container_width=True)
 
+                # 草稿定稿：以选定分辨率重新渲染这一张，替换草稿
+                config = st.session_state.current_config
+                if config.get("draft") and idx not in st.session_state.finalized_indices:
+                    final_col1, final_col2 = st.columns([1, 2])
+                    with final_col1:
+                        final_size = st.radio(
+                            "定稿分辨率",
+                            FINAL_IMAGE_SIZES,
+                            format_func=str.upper,
+                            horizontal=True,
+                            key="final_size",
+                            label_visibility="collapsed"
+                        )
+                    with final_col2:
+                        if st.button("🖨️ 高清定稿", key="finalize_draft", use_container_width=True):
+                            try:
+                                with st.spinner(f"正在以 {final_size.upper()} 渲染定稿..."):
+                                    final_image = finalize_poster(
+                                        images[idx],
+                                        config["final_prompt"],
+                                        aspect_ratio=config["aspect_ratio"],
+                                        image_size=final_size,
+                                        logo_image=config["logo_image"],
+                                        qrcode_image=config["qrcode_image"]
+                                    )
+                                st.session_state.generated_images[idx] = final_image
+                                st.session_state.finalized_indices.add(idx)
+                                if idx < len(st.session_state.poster_ids):
+                                    # 之后的微调在定稿上继续，并保持定稿分辨率
+                                    refine_manager.start(
+                                        st.session_state.poster_ids[idx], final_image,
+                                        *refine_request(config, final_size)
+                                    )
+                                st.success("✅ 已生成高清定稿")
+                                st.rerun()
+                            except Exception as e:
+                                st.error(f"❌ 定稿失败: {str(e)}")
+
+                # 多比例改版：本地裁剪 / 填充出其他比例，质量不够的比例才交给模型重绘
+                other_ratios = [ratio for ratio in RELAYOUT_RATIOS if ratio != config["aspect_ratio"]]
+                if st.button("📐 生成其他比例", key="relayout", use_container_width=True):
+                    try:
+                        def redraw(draft, ratio):
+                            return finalize_poster(
+                                draft,
+                                config["final_prompt"],
+                                aspect_ratio=ratio,
+                                logo_image=config["logo_image"],
+                                qrcode_image=config["qrcode_image"]
+                            )
+
+                        with st.spinner("正在改版为其他比例..."):
+                            results = relayout_all(images[idx], other_ratios, fallback=redraw)
+                            save_relayouts(results)
+                        # 连同原图一起保存，海报被定稿或微调替换后不再显示旧的改版
+                        st.session_state.relayouts[idx] = (images[idx], results)
+                    except Exception as e:
+                        st.error(f"❌ 改版失败: {str(e)}")
+
+                source_image, results = st.session_state.relayouts.get(idx, (None, {}))
+                if results and source_image is images[idx]:
+                    ratio_cols = st.columns(len(results))
+                    for ratio_col, (ratio, result) in zip(ratio_cols, results.items()):
+                        with ratio_col:
+                            st.image(result.image, use_container_width=True)
+                            method = "AI 重绘" if result.method == "model" else "本地改版"
+                            st.caption(f"{ratio} · {method}")
+
+                # 印刷放大：本地分块放大并锐化，不调用模型
+                upscale_col1, upscale_col2 = st.columns([1, 2])
+                with upscale_col1:
+                    upscale_factor = st.radio(
+                        "放大倍数",
+                        [2, 3, 4],
+                        format_func=lambda factor: f"{factor}×",
+                        horizontal=True,
+                        key="upscale_factor",
+                        label_visibility="collapsed"
+                    )
+                with upscale_col2:
+                    if st.button("🖼️ 印刷放大", key="upscale", use_container_width=True):
+                        try:
+                            with st.spinner(f"正在本地放大 {upscale_factor} 倍..."):
+                                upscaled = upscale(images[idx], upscale_factor)
+                                buffer = BytesIO()
+                                upscaled.save(buffer, format="PNG")
+                            # 连同原图一起保存，海报被替换后不再提供旧的放大结果
+                            st.session_state.upscaled = (images[idx], upscale_factor, upscaled.size, buffer.getvalue())
+                        except Exception as e:
+                            st.error(f"❌ 放大失败: {str(e)}")
+
+                if st.session_state.upscaled and st.session_state.upscaled[0] is images[idx]:
+                    _, factor, (width, height), png_bytes = st.session_state.upscaled
+                    st.download_button(
+                        f"⬇️ 下载印刷版 {width}×{height}",
+                        data=png_bytes,
+                        file_name=f"poster_{idx+1}_{factor}x.png",
+                        mime="image/png",
+                        use_container_width=True
+                    )
+
             with col_tune:
                 st.markdown("#### 🎨 微调选项")
 
@@ -900,35 +1128,28 @@ if st.session_state.generated_images:
                         try:
                             # 合并提示词
                             tune_instruction = ", ".join(tune_parts)
-                            tuned_prompt = f"{st.session_state.current_prompt}. Apply these adjustments: {tune_instruction}"
-
-                            # 应用风格配置
-                            final_tuned_prompt = tuned_prompt
-
-                            # 添加预设风格关键词
-                            style_keywords = {
-                                "自动匹配 (Auto)": "",
-                                "极简主义 (Minimalist)": "minimalist design, clean layout, simple geometric shapes, plenty of white space",
-                                "赛博朋克 (Cyberpunk)": "cyberpunk style, neon colors, futuristic elements, tech-inspired, dark background with bright accents",
-                                "商务科技 (Tech Corporate)": "professional business style, modern tech aesthetic, corporate colors, clean and sophisticated",
-                                "温暖手绘 (Warm Illustration)": "warm hand-drawn illustration style, friendly and approachable, soft colors, artistic touch"
-                            }
-
-                            if preset_style != "自动匹配 (Auto)" and style_keywords.get(preset_style):
-                                style_keyword = style_keywords[preset_style]
-                                final_tuned_prompt = f"{tuned_prompt}. Style: {style_keyword}. Style strength: {style_strength}"
-
-                            # 获取自定义风格
-                            if selected_custom_style != "不使用":
-                                selected_style = style_manager.load_style(selected_custom_style)
-                                if selected_style:
-                                    custom_style_prompt = selected_style.get("user_prompt")
-                                    if custom_style_prompt:
-                                        final_tuned_prompt = f"{final_tuned_prompt}. {custom_style_prompt}"
-
-                            # 添加负向提示词
-                            if negative_prompt:
-                                final_tuned_prompt = f"{final_tuned_prompt}. Avoid: {negative_prompt}"
+
+                            # 微调对话仍在时只发送调整指令，不再上传整张海报与素材
+                            poster_ids = st.session_state.poster_ids
+                            tuned_image = None
+                            if idx < len(poster_ids) and refine_manager.has(poster_ids[idx]):
+                                try:
+                                    with st.spinner("正在应用微调..."):
+                                        tuned_image = refine_manager.refine(
+                                            poster_ids[idx], f"Apply these adjustments: {tune_instruction}"
+                                        )
+                                except Exception as e:
+                                    print(f"微调对话失败，改为重新生成: {str(e)}")
+                            if tuned_image is not None:
+                                st.session_state.generated_images[idx] = tuned_image
+                                st.success("✅ 微调已应用")
+                                st.rerun()
+
+                            # 对话已过期或调用失败：以当前海报为参考图重新生成
+                            final_tuned_prompt = build_final_prompt(
+                                st.session_state.current_prompt,
+                                st.session_state.refinements + [f"Apply these adjustments: {tune_instruction}"]
+                            )
 
                             # 加载素材
                             logo_image = None
@@ -949,12 +1170,12 @@ if st.session_state.generated_images:
                                     qrcode_image = asset_manager.load_qrcode(qrcodes[0])
 
                             with st.spinner("正在应用微调..."):
-                                # 只生成一张微调后的海报
+                                # 只生成一张微调后的海报（替换这批中的一张，沿用这批海报的比例）
                                 tuned_images = generate_posters(
                                     user_prompt=final_tuned_prompt,
-                                    aspect_ratio=aspect_ratio,
+                                    aspect_ratio=st.session_state.current_config["aspect_ratio"],
                                     num_images=1,
-                                    thinking_mode=st.session_state.thinking_mode,
+                                    thinking_mode=st.session_state.current_config["thinking_mode"],
                                     reference_image=images[idx],  # 使用当前图片作为参考
                                     style_prompt=None,
                                     logo_image=logo_image,
@@ -964,6 +1185,12 @@ if st.session_state.generated_images:
                             if tuned_images:
                                 # 替换当前图片
                                 st.session_state.generated_images[idx] = tuned_images[0]
+                                st.session_state.finalized_indices.add(idx)  # 微调结果已是 2K
+                                if idx < len(poster_ids):
+                                    refine_manager.start(
+                                        poster_ids[idx], tuned_images[0],
+                                        *refine_request(st.session_state.current_config, "2k")
+                                    )
                                 st.success("✅ 微调已应用")
                                 st.rerun()
 
@@ -2,17 +2,200 @@
 # 此文件用于处理核心业务逻辑
 
 import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime
 from io import BytesIO
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
-from google import genai
 from google.genai import types
 from PIL import Image
 
+from cache_manager import cache_manager, make_key, similarity_key
+from circuit_breaker import CIRCUIT_OPEN_REASON, CircuitOpenError, circuit_breaker
+from client_manager import get_client
+from deadline import CANCELLED_REASON, Deadline, DeadlineExceeded
+from design_planner import PLANNER_ENABLED, plan_designs
+from fill_policy import FillPolicy
+from hedging import HedgePolicy, latency_tracker
+from image_encoder import encode_asset, part_size
+from key_pool import is_key_error, key_pool
+from prompt_compiler import join_clauses
+from rate_limiter import (
+    OUTCOME_ERROR, OUTCOME_SUCCESS, OUTCOME_THROTTLED, OUTCOME_UNUSED, is_quota_error, rate_limiter
+)
+from retry_policy import AttemptLog, RetryPolicy, default_retry_policy
+
 # 加载环境变量
 load_dotenv()
 
+# 图像生成模型
+IMAGE_MODEL = "gemini-3-pro-image-preview"
+
+# 批量生成时的默认并发数（同时进行的模型调用数）
+DEFAULT_MAX_WORKERS = int(os.getenv("MIRRORPOST_MAX_WORKERS", "4"))
+
+# 对冲请求默认关闭，MIRRORPOST_HEDGE=1 时启用默认策略
+DEFAULT_HEDGE_POLICY = HedgePolicy() if os.getenv("MIRRORPOST_HEDGE", "0") == "1" else None
+
+# 每次模型调用请求的图片数量（candidate_count）。当前图像模型通常每次只返回 1 张，默认 1；
+# 模型支持多候选时调大，可用更少的调用完成一批，减少请求开销与配额占用
+DEFAULT_IMAGES_PER_CALL = int(os.getenv("MIRRORPOST_IMAGES_PER_CALL", "1"))
+
+# 图片分辨率：草稿模式先出低分辨率预览，选中的海报再用 finalize_poster 以定稿分辨率重新渲染
+DEFAULT_IMAGE_SIZE = "2k"
+DRAFT_IMAGE_SIZE = os.getenv("MIRRORPOST_DRAFT_SIZE", "1k")
+FINAL_IMAGE_SIZES = ("2k", "4k")
+
+# 补足数量默认关闭，MIRRORPOST_FILL_TO_TARGET=1 时启用默认策略
+DEFAULT_FILL_POLICY = FillPolicy() if os.getenv("MIRRORPOST_FILL_TO_TARGET", "0") == "1" else None
+
+# 连续多少次安全过滤 / 空响应后放弃整批剩余的调用（0 表示不放弃），调用方可逐次覆盖
+DEFAULT_SAFETY_ABORT_AFTER = int(os.getenv("MIRRORPOST_SAFETY_ABORT_AFTER", "3"))
+
+# 安全过滤（含空响应）的错误原因
+SAFETY_REASON = "内容安全过滤"
+
+# Thinking 模式前缀（整批设计规划成功时，每次调用以对应的设计方案替换）
+THINKING_PREFIX = (
+    "First, analyze the design requirements and plan the visual strategy. "
+    "Then generate the poster based on your analysis."
+)
+
+# API Key 无效或已被吊销（该 Key 已移出 Key 池，重试会换用其他 Key）
+KEY_ERROR_REASON = "API Key无效"
+
+# 说明图像服务本身故障的错误原因（计入熔断失败率）
+BREAKER_FAILURE_REASONS = {"服务器繁忙", "网络波动", "生成超时", "未知错误"}
+
+# 同步路径中对冲请求使用的线程池
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+
+class BatchAbortedError(Exception):
+    """整批提前中止且没有任何海报完成（如提示词本身触发安全过滤）"""
+
+    def __init__(self, reason: str, message: str, blocked: int):
+        """
+        参数:
+            reason (str): 中止原因（错误类别，如 "内容安全过滤"）
+            message (str): 面向用户的说明
+            blocked (int): 触发中止的连续失败次数
+        """
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+        self.blocked = blocked
+
+    def to_dict(self) -> dict:
+        """结构化的中止原因，便于接口直接返回"""
+        return {"reason": self.reason, "message": self.message, "blocked": self.blocked}
+
+
+class _BatchContext:
+    """一批生成共享的状态：客户端、请求内容、配置、重试 / 对冲策略与尝试记录"""
+
+    def __init__(
+        self,
+        contents,
+        config: types.GenerateContentConfig,
+        total: int,
+        retry_policy: RetryPolicy,
+        attempt_log: AttemptLog,
+        hedge_policy: Optional[HedgePolicy] = None,
+        deadline: Optional[Deadline] = None,
+        safety_abort_after: int = 0,
+        fill_policy: Optional[FillPolicy] = None,
+        images_per_call: int = 1,
+        planning: bool = False,
+        prompt_rest: Optional[List[str]] = None
+    ):
+        self.contents = contents
+        self.prompt_rest = prompt_rest or []  # 提示词中用户输入以外的片段（近似缓存键用）
+        self.config = config
+        self.total = total
+        self.retry_policy = retry_policy
+        self.attempt_log = attempt_log
+        self.hedge_policy = hedge_policy
+        self.hedge_budget = hedge_policy.budget_for(total) if hedge_policy else None
+        self.deadline = deadline or Deadline()
+        self.safety_abort_after = safety_abort_after
+        self.abort_reason: Optional[str] = None
+        self._consecutive_blocked = 0
+        self._aborted_after = 0
+        self._lock = threading.Lock()
+        self.fill_budget = fill_policy.budget_for(total) if fill_policy else None
+        self.images_per_call = max(1, images_per_call)
+        self.planning = planning
+        self.plans: Optional[List[str]] = None  # 每张海报的设计方案，规划失败时为空列表
+
+    def note_outcome(self, reason: Optional[str]):
+        """记录一次调用结果：连续安全过滤达到上限时中止整批"""
+        with self._lock:
+            if reason is None:
+                self._consecutive_blocked = 0
+            elif reason == SAFETY_REASON:
+                self._consecutive_blocked += 1
+                if (self.safety_abort_after and self.abort_reason is None
+                        and self._consecutive_blocked >= self.safety_abort_after):
+                    self.abort_reason = SAFETY_REASON
+                    self._aborted_after = self._consecutive_blocked
+                    print(f"连续 {self._consecutive_blocked} 次{SAFETY_REASON}，放弃本批剩余海报")
+
+    def try_replace(self, index: int, reason: Optional[str]) -> bool:
+        """某张最终失败时判断是否立即补发一张（补足到请求数量），会占用补发预算"""
+        if self.fill_budget is None or self.stopped() or reason == CIRCUIT_OPEN_REASON:
+            return False
+        if not self.fill_budget.try_spend():
+            return False
+        print(f"第 {index+1} 张{reason}，立即补发（已补发 {self.fill_budget.used}/{self.fill_budget.limit}）")
+        return True
+
+    def stopped(self) -> bool:
+        """整批是否应停止：截止时间到期、被取消或已中止"""
+        return self.abort_reason is not None or self.deadline.expired()
+
+    def stop_reason(self) -> str:
+        """停止后未完成海报的错误原因"""
+        return self.abort_reason or CANCELLED_REASON
+
+    def abort_error(self) -> BatchAbortedError:
+        """中止且没有任何海报完成时抛出的异常"""
+        return BatchAbortedError(
+            self.abort_reason,
+            f"提示词连续 {self._aborted_after} 次触发{self.abort_reason}，已停止生成，请修改描述后重试",
+            self._aborted_after
+        )
+
+
+class PosterResult:
+    """流式生成中单张海报的结果"""
+
+    def __init__(
+        self,
+        index: int,
+        image: Optional[Image.Image],
+        error_reason: Optional[str],
+        elapsed: float
+    ):
+        """
+        参数:
+            index (int): 海报序号（从 0 开始，对应提交顺序）
+            image (Image.Image): 生成的海报，失败时为 None
+            error_reason (str): 失败原因，成功时为 None
+            elapsed (float): 自本批开始到该张完成的秒数
+        """
+        self.index = index
+        self.image = image
+        self.error_reason = error_reason
+        self.elapsed = elapsed
+
+    @property
+    def success(self) -> bool:
+        return self.image is not None
+
 
 def generate_posters(
     user_prompt: str,
@@ -23,7 +206,18 @@ def generate_posters(
     style_prompt: Optional[str] = None,
     logo_image: Optional[Image.Image] = None,
     qrcode_image: Optional[Image.Image] = None,
-    slogan: Optional[str] = None
+    slogan: Optional[str] = None,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    retry_policy: Optional[RetryPolicy] = None,
+    attempt_log: Optional[AttemptLog] = None,
+    use_cache: bool = True,
+    accept_offer: Optional[str] = None,
+    hedge_policy: Optional[HedgePolicy] = DEFAULT_HEDGE_POLICY,
+    deadline: Optional[Deadline] = None,
+    safety_abort_after: int = DEFAULT_SAFETY_ABORT_AFTER,
+    fill_policy: Optional[FillPolicy] = DEFAULT_FILL_POLICY,
+    images_per_call: int = DEFAULT_IMAGES_PER_CALL,
+    image_size: str = DEFAULT_IMAGE_SIZE
 ) -> List[Image.Image]:
     """
     批量生成海报，支持多种模式
@@ -38,81 +232,790 @@ def generate_posters(
         logo_image (Image.Image): Logo 图片
         qrcode_image (Image.Image): 二维码图片
         slogan (str): Slogan 文案
+        max_workers (int): 最大并发调用数，1 表示逐张顺序生成
+        retry_policy (RetryPolicy): 失败重试策略，默认按错误类别重试
+        attempt_log (AttemptLog): 传入后记录每次模型调用，用于统计成功率
+        use_cache (bool): 为 False 时跳过结果缓存（缓存由 MIRRORPOST_CACHE=1 启用）
+        accept_offer (str): 调用方已接受的近似缓存候选（find_cache_offer 返回的 offer_id），仍可用时直接返回
+        hedge_policy (HedgePolicy): 对冲策略，None 表示不对冲（默认由 MIRRORPOST_HEDGE 决定）
+        deadline (Deadline): 整批的截止时间，到期或被取消后不再发起新调用，返回已完成的海报
+        safety_abort_after (int): 连续这么多次安全过滤 / 空响应后放弃剩余海报，0 表示不放弃；
+            没有任何海报完成时抛出 BatchAbortedError
+        fill_policy (FillPolicy): 补足策略，某张最终失败时立即补发，直到达到 num_images 张或预算用完；
+            None 表示不补发（默认由 MIRRORPOST_FILL_TO_TARGET 决定）
+        images_per_call (int): 每次调用请求的图片数量，num_images 按此拆分为尽量少的调用
+            （默认由 MIRRORPOST_IMAGES_PER_CALL 决定）
+        image_size (str): 输出分辨率，默认 "2k"；草稿模式传 DRAFT_IMAGE_SIZE，
+            选中的海报再用 finalize_poster 定稿
 
     返回:
         List[Image.Image]: 生成的海报列表
     """
-    # 初始化客户端
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        raise ValueError("GOOGLE_API_KEY 未在 .env 文件中设置")
+    ctx = _create_context(
+        user_prompt, aspect_ratio, num_images, thinking_mode, reference_image,
+        style_prompt, logo_image, qrcode_image, slogan, retry_policy, attempt_log,
+        hedge_policy, deadline, safety_abort_after, fill_policy, images_per_call, image_size
+    )
+
+    # 命中缓存时直接返回，不调用模型
+    cache_key, near_key, cached = _cache_lookup(ctx, user_prompt, use_cache, accept_offer)
+    if cached:
+        return cached["images"]
+
+    # 批量生成（按提交顺序收集结果）
+    results: List[Optional[Image.Image]] = [None] * num_images
+    failures: List[PosterResult] = []
+    for result in _iter_context(ctx, max_workers):
+        results[result.index] = result.image
+        if not result.success:
+            failures.append(result)
+
+    generated_images = [image for image in results if image is not None]
+
+    summary = ctx.attempt_log.summary()
+    print(
+        f"本批共调用模型 {summary['attempts']} 次（重试 {summary['retries']} 次），"
+        f"成功率 {summary['success_rate']:.0%}"
+    )
+
+    if not generated_images:
+        _raise_batch_failure(ctx, failures)
+
+    print(f"成功生成 {len(generated_images)} 张海报")
+
+    if cache_key:
+        cache_manager.put(cache_key, generated_images, near_key=near_key)
+
+    return generated_images
+
+
+def find_cache_offer(
+    user_prompt: str,
+    aspect_ratio: str = "9:16",
+    num_images: int = 8,
+    thinking_mode: bool = True,
+    reference_image: Optional[Image.Image] = None,
+    style_prompt: Optional[str] = None,
+    logo_image: Optional[Image.Image] = None,
+    qrcode_image: Optional[Image.Image] = None,
+    slogan: Optional[str] = None,
+    image_size: str = DEFAULT_IMAGE_SIZE
+) -> Optional[Dict]:
+    """
+    查找与本次请求近似的缓存结果，作为候选交给调用方决定是否使用（不调用模型）
+
+    近似结果不会被自动使用：提示词改了颜色、主体或氛围时估计的相似度仍可能很高。
+    调用方（如界面上的用户）确认后，把 offer_id 作为 accept_offer 传给 generate_posters。
+
+    参数:
+        user_prompt (str): 用户输入的海报描述
+        aspect_ratio (str): 海报纵横比
+        num_images (int): 生成数量
+        thinking_mode (bool): 是否启用 Thinking 模式
+        reference_image (Image.Image): 参考图片
+        style_prompt (str): 风格描述
+        logo_image (Image.Image): Logo 图片
+        qrcode_image (Image.Image): 二维码图片
+        slogan (str): Slogan 文案
+        image_size (str): 输出分辨率
+
+    返回:
+        Dict: {"offer_id", "similarity"}；缓存未启用或没有近似结果时返回 None
+    """
+    if not cache_manager.enabled:
+        return None
+    contents, config = _prepare_request(
+        user_prompt, aspect_ratio, thinking_mode, reference_image, style_prompt,
+        logo_image, qrcode_image, slogan, image_size
+    )
+    prompt_rest = _prompt_parts(
+        "", thinking_mode, style_prompt, reference_image, logo_image, qrcode_image, slogan, None
+    )
+    ctx = _BatchContext(contents, config, num_images, default_retry_policy, AttemptLog(), prompt_rest=prompt_rest)
+    return cache_manager.find_offer(_similarity_key(ctx, user_prompt), num_images)
 
-    client = genai.Client(api_key=api_key)
 
+def iter_posters(
+    user_prompt: str,
+    aspect_ratio: str = "9:16",
+    num_images: int = 8,
+    thinking_mode: bool = True,
+    reference_image: Optional[Image.Image] = None,
+    style_prompt: Optional[str] = None,
+    logo_image: Optional[Image.Image] = None,
+    qrcode_image: Optional[Image.Image] = None,
+    slogan: Optional[str] = None,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    retry_policy: Optional[RetryPolicy] = None,
+    attempt_log: Optional[AttemptLog] = None,
+    use_cache: bool = True,
+    accept_offer: Optional[str] = None,
+    hedge_policy: Optional[HedgePolicy] = DEFAULT_HEDGE_POLICY,
+    deadline: Optional[Deadline] = None,
+    safety_abort_after: int = DEFAULT_SAFETY_ABORT_AFTER,
+    fill_policy: Optional[FillPolicy] = DEFAULT_FILL_POLICY,
+    images_per_call: int = DEFAULT_IMAGES_PER_CALL,
+    image_size: str = DEFAULT_IMAGE_SIZE
+) -> Iterator[PosterResult]:
+    """
+    流式生成海报：每完成一张（成功或最终失败）就立即产出一个 PosterResult
+
+    参数同 generate_posters。产出顺序为完成顺序，可用 result.index 还原提交顺序；
+    启用补足策略时，失败的海报会以同一序号补发，每个序号只产出最终结果。
+    调用方提前停止迭代时，尚未开始的调用会被取消。截止时间到期（或被取消）或整批中止时，
+    未完成的海报以 CANCELLED_REASON / 中止原因产出后结束。
+    与 generate_posters 共用结果缓存：命中时按序号产出缓存的海报；整批迭代完成后写入成功的海报，
+    提前停止迭代时不写入。
+    """
+    ctx = _create_context(
+        user_prompt, aspect_ratio, num_images, thinking_mode, reference_image,
+        style_prompt, logo_image, qrcode_image, slogan, retry_policy, attempt_log,
+        hedge_policy, deadline, safety_abort_after, fill_policy, images_per_call, image_size
+    )
+
+    cache_key, near_key, cached = _cache_lookup(ctx, user_prompt, use_cache, accept_offer)
+    if cached:
+        for index, image in enumerate(cached["images"]):
+            yield PosterResult(index, image, None, 0.0)
+        return
+
+    generated: Dict[int, Image.Image] = {}
+    for result in _iter_context(ctx, max_workers):
+        if result.success:
+            generated[result.index] = result.image
+        yield result
+
+    if cache_key:
+        cache_manager.put(cache_key, [generated[index] for index in sorted(generated)], near_key=near_key)
+
+
+def finalize_poster(
+    draft_image: Image.Image,
+    user_prompt: str,
+    aspect_ratio: str = "9:16",
+    image_size: str = DEFAULT_IMAGE_SIZE,
+    style_prompt: Optional[str] = None,
+    logo_image: Optional[Image.Image] = None,
+    qrcode_image: Optional[Image.Image] = None,
+    slogan: Optional[str] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    attempt_log: Optional[AttemptLog] = None,
+    deadline: Optional[Deadline] = None
+) -> Image.Image:
+    """
+    以定稿分辨率重新渲染一张选中的草稿海报
+
+    草稿作为参考图发送，要求模型保持构图、文字与配色，只提高分辨率与细节。
+    提示词与素材应与生成草稿时相同；不使用 Thinking 前缀（构图已由草稿确定），不对冲也不补发。
+
+    参数:
+        draft_image (Image.Image): 草稿模式生成的海报
+        user_prompt (str): 生成草稿时的海报描述
+        aspect_ratio (str): 海报纵横比，默认 "9:16"
+        image_size (str): 定稿分辨率，"2k" 或 "4k"
+        style_prompt (str): 风格描述
+        logo_image (Image.Image): Logo 图片
+        qrcode_image (Image.Image): 二维码图片
+        slogan (str): Slogan 文案
+        retry_policy (RetryPolicy): 失败重试策略
+        attempt_log (AttemptLog): 传入后记录每次模型调用
+        deadline (Deadline): 截止时间
+
+    返回:
+        Image.Image: 定稿海报
+    """
+    ctx = _create_finalize_context(
+        draft_image, user_prompt, aspect_ratio, image_size, style_prompt,
+        logo_image, qrcode_image, slogan, retry_policy, attempt_log, deadline
+    )
+    failures: List[PosterResult] = []
+    for result in _iter_context(ctx, 1):
+        if result.success:
+            return result.image
+        failures.append(result)
+
+    _raise_batch_failure(ctx, failures)
+
+
+def _iter_context(ctx: _BatchContext, max_workers: int) -> Iterator[PosterResult]:
+    """按上下文调度一批生成，每完成一张产出一个 PosterResult"""
+    # 熔断期间整批快速失败
+    circuit_breaker.check()
+
+    started = time.monotonic()
+
+    # Thinking 模式：整批只规划一次
+    _plan_batch(ctx)
+    calls = _plan_calls(ctx.total, ctx.images_per_call)
+    workers = max(1, min(max_workers, len(calls)))
+
+    if workers == 1:
+        while calls:
+            indices = calls.pop(0)
+            images, reason = _generate_single(ctx, indices)
+            results, missing = _collect_call(ctx, indices, images, reason, started)
+            yield from results
+            if missing:
+                calls.insert(0, missing)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(_generate_single, ctx, indices): indices for indices in calls}
+        pending = set(futures)
+        while pending:
+            if ctx.stopped():
+                # 截止时间已到或整批中止：已经完成的调用照常收集，只放弃仍未完成的海报（进行中的调用受单次超时约束）
+                remaining = []
+                for future in pending:
+                    if not future.done():
+                        remaining.extend(futures[future])
+                        continue
+                    images, reason = future.result()
+                    # 已停止时 _collect_call 不会再要求补发，缺少的海报直接按停止原因产出
+                    results, _ = _collect_call(ctx, futures[future], images, reason, started)
+                    yield from results
+                if remaining:
+                    print(f"停止生成，放弃剩余 {len(remaining)} 张海报")
+                for index in sorted(remaining):
+                    yield PosterResult(index, None, ctx.stop_reason(), time.monotonic() - started)
+                return
+            done, pending = wait(pending, timeout=_poll_interval(ctx), return_when=FIRST_COMPLETED)
+            for future in done:
+                images, reason = future.result()
+                results, missing = _collect_call(ctx, futures[future], images, reason, started)
+                yield from results
+                if missing:
+                    replacement = executor.submit(_generate_single, ctx, missing)
+                    futures[replacement] = missing
+                    pending.add(replacement)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _raise_batch_failure(ctx: _BatchContext, failures: List[PosterResult]):
+    """没有任何海报完成时，按失败原因抛出最能说明情况的异常"""
+    if any(result.error_reason == CIRCUIT_OPEN_REASON for result in failures):
+        raise CircuitOpenError("图像服务暂时不可用，已暂停调用，请稍后重试")
+    if ctx.abort_reason:
+        raise ctx.abort_error()
+    if ctx.deadline.expired():
+        raise DeadlineExceeded("截止时间已到，未能完成任何海报")
+    # 本批失败触发了熔断时同样按服务不可用报告
+    circuit_breaker.check()
+    raise ValueError("所有海报生成均失败")
+
+
+def _plan_calls(num_images: int, images_per_call: int) -> List[List[int]]:
+    """把 num_images 张海报拆分为尽量少的调用，每个调用负责一组连续序号"""
+    return [
+        list(range(start, min(start + images_per_call, num_images)))
+        for start in range(0, num_images, images_per_call)
+    ]
+
+
+def _collect_call(
+    ctx: _BatchContext,
+    indices: List[int],
+    images: List[Image.Image],
+    reason: Optional[str],
+    started: float
+) -> Tuple[List[PosterResult], List[int]]:
+    """
+    把一次调用的结果分配给它负责的序号
+
+    返回:
+        tuple: (可以产出的结果, 需要立即再发一次调用的序号)。
+            调用返回了部分图片时，缺少的序号直接再发（模型给出的候选少于请求数量）；
+            调用完全失败时按补足策略决定是否补发，补发的序号不产出失败结果
+    """
+    elapsed = time.monotonic() - started
+    results = [PosterResult(index, image, None, elapsed) for index, image in zip(indices, images)]
+    missing = indices[len(images):]
+    if not missing:
+        return results, []
+    if images and not ctx.stopped():
+        return results, missing
+    if not images and ctx.try_replace(indices[0], reason):
+        return results, missing
+    results.extend(PosterResult(index, None, reason or ctx.stop_reason(), elapsed) for index in missing)
+    return results, []
+
+
+def _poll_interval(ctx: _BatchContext) -> float:
+    """调度循环检查截止时间的间隔：不超过 1 秒，也不超过剩余时间"""
+    remaining = ctx.deadline.remaining()
+    return 1.0 if remaining is None else min(1.0, remaining)
+
+
+def _create_context(
+    user_prompt: str,
+    aspect_ratio: str,
+    num_images: int,
+    thinking_mode: bool,
+    reference_image: Optional[Image.Image],
+    style_prompt: Optional[str],
+    logo_image: Optional[Image.Image],
+    qrcode_image: Optional[Image.Image],
+    slogan: Optional[str],
+    retry_policy: Optional[RetryPolicy],
+    attempt_log: Optional[AttemptLog],
+    hedge_policy: Optional[HedgePolicy],
+    deadline: Optional[Deadline],
+    safety_abort_after: int,
+    fill_policy: Optional[FillPolicy],
+    images_per_call: int,
+    image_size: str = DEFAULT_IMAGE_SIZE,
+    draft_image: Optional[Image.Image] = None
+) -> _BatchContext:
+    """检查 API Key 配置并构建一批生成的上下文（每次调用时再从 Key 池选择 Key）"""
+    key_pool.check()
+
+    contents, config = _prepare_request(
+        user_prompt, aspect_ratio, thinking_mode, reference_image, style_prompt,
+        logo_image, qrcode_image, slogan, image_size, draft_image
+    )
+
+    # 提示词中用户输入以外的片段：直接取自拼接前的片段，不依赖在拼接结果中查找用户提示词
+    prompt_rest = _prompt_parts(
+        "", thinking_mode, style_prompt, reference_image,
+        logo_image, qrcode_image, slogan, draft_image
+    )
+
+    return _BatchContext(
+        contents, config, num_images,
+        retry_policy or default_retry_policy,
+        attempt_log if attempt_log is not None else AttemptLog(),
+        hedge_policy,
+        deadline,
+        safety_abort_after,
+        fill_policy,
+        images_per_call,
+        planning=thinking_mode and PLANNER_ENABLED,
+        prompt_rest=prompt_rest
+    )
+
+
+def _create_finalize_context(
+    draft_image: Image.Image,
+    user_prompt: str,
+    aspect_ratio: str,
+    image_size: str,
+    style_prompt: Optional[str],
+    logo_image: Optional[Image.Image],
+    qrcode_image: Optional[Image.Image],
+    slogan: Optional[str],
+    retry_policy: Optional[RetryPolicy],
+    attempt_log: Optional[AttemptLog],
+    deadline: Optional[Deadline]
+) -> _BatchContext:
+    """构建单张定稿的上下文（草稿作为参考图，不对冲、不补发、不因安全过滤中止）"""
+    if image_size not in FINAL_IMAGE_SIZES:
+        raise ValueError(f"定稿分辨率只支持 {' / '.join(FINAL_IMAGE_SIZES)}")
+
+    return _create_context(
+        user_prompt, aspect_ratio, 1, False, None,
+        style_prompt, logo_image, qrcode_image, slogan, retry_policy, attempt_log,
+        None, deadline, 0, None, 1,
+        image_size=image_size,
+        draft_image=draft_image
+    )
+
+
+def build_request(
+    user_prompt: str,
+    aspect_ratio: str = "9:16",
+    thinking_mode: bool = True,
+    reference_image: Optional[Image.Image] = None,
+    style_prompt: Optional[str] = None,
+    logo_image: Optional[Image.Image] = None,
+    qrcode_image: Optional[Image.Image] = None,
+    slogan: Optional[str] = None,
+    image_size: str = DEFAULT_IMAGE_SIZE
+) -> tuple:
+    """
+    构建单张海报的模型请求，供不经过逐张调用路径的场景（如离线批量任务）复用
+
+    参数同 generate_posters
+
+    返回:
+        tuple: (contents, config)，与逐张生成时发送的请求相同
+    """
+    return _prepare_request(
+        user_prompt, aspect_ratio, thinking_mode, reference_image, style_prompt,
+        logo_image, qrcode_image, slogan, image_size
+    )
+
+
+def extract_images(response) -> List[Image.Image]:
+    """从模型响应中提取所有图片（供离线批量任务解析结果）"""
+    return _extract_images_from_response(response)
+
+
+def _cache_key(ctx: _BatchContext) -> str:
+    """根据模型、图片配置与完整请求内容计算缓存键"""
+    return make_key(IMAGE_MODEL, ctx.contents, ctx.config.image_config)
+
+
+def _similarity_key(ctx: _BatchContext, user_prompt: str) -> tuple:
+    """近似命中用的键：用户提示词的 MinHash 签名，提示词的其余片段、素材与配置必须完全相同"""
+    assets = ctx.contents[1:] if isinstance(ctx.contents, list) else []
+    return similarity_key(IMAGE_MODEL, ctx.prompt_rest + assets, ctx.config.image_config, user_prompt)
+
+
+def _cache_lookup(
+    ctx: _BatchContext,
+    user_prompt: str,
+    use_cache: bool,
+    accept_offer: Optional[str]
+) -> Tuple[Optional[str], Optional[tuple], Optional[Dict]]:
+    """
+    查找本批请求的缓存结果（generate_posters 与 iter_posters 共用）
+
+    精确未命中时再找素材相同、提示词子句相同的结果；近似结果只在调用方接受候选后使用
+
+    返回:
+        tuple: (缓存键, 近似键, 命中的缓存)；缓存未启用或调用方跳过缓存时均为 None
+    """
+    if not use_cache or not cache_manager.enabled:
+        return None, None, None
+    cache_key = _cache_key(ctx)
+    near_key = _similarity_key(ctx, user_prompt)
+    cached = cache_manager.get(cache_key, ctx.total) or cache_manager.get_equivalent(near_key, ctx.total)
+    if not cached and accept_offer:
+        cached = cache_manager.accept_offer(accept_offer, near_key, ctx.total)
+    return cache_key, near_key, cached
+
+
+def _prepare_request(
+    user_prompt: str,
+    aspect_ratio: str,
+    thinking_mode: bool,
+    reference_image: Optional[Image.Image],
+    style_prompt: Optional[str],
+    logo_image: Optional[Image.Image],
+    qrcode_image: Optional[Image.Image],
+    slogan: Optional[str],
+    image_size: str = DEFAULT_IMAGE_SIZE,
+    draft_image: Optional[Image.Image] = None
+) -> tuple:
+    """构建一批请求共用的 contents 与模型配置"""
     # 构建提示词
     enhanced_prompt = _build_prompt(
         user_prompt, thinking_mode, style_prompt, reference_image,
-        logo_image, qrcode_image, slogan
+        logo_image, qrcode_image, slogan, draft_image
     )
 
     # 配置模型参数
     config = types.GenerateContentConfig(
         image_config=types.ImageConfig(
             aspect_ratio=aspect_ratio,
-            image_size="2k"
+            image_size=image_size
         )
     )
 
-    # 批量生成
-    generated_images = []
-    for i in range(num_images):
-        print(f"正在生成第 {i+1}/{num_images} 张海报...")
+    # 准备内容（包含提示词和所有图片素材）
+    # 素材在这里统一缩放编码一次，整批调用复用同一份字节，避免 SDK 每次重新序列化原图
+    contents = [enhanced_prompt]
+
+    # 添加待定稿的草稿
+    if draft_image:
+        contents.append(encode_asset(draft_image, "reference"))
+
+    # 添加参考图片
+    if reference_image:
+        contents.append(encode_asset(reference_image, "reference"))
+
+    # 添加 Logo
+    if logo_image:
+        contents.append(encode_asset(logo_image, "logo"))
+
+    # 添加二维码
+    if qrcode_image:
+        contents.append(encode_asset(qrcode_image, "qrcode"))
+
+    # 如果只有文本，不用列表
+    if len(contents) == 1:
+        contents = contents[0]
+    else:
+        upload_bytes = sum(part_size(part) for part in contents)
+        print(f"素材已编码: {len(contents) - 1} 张，共 {upload_bytes / 1024:.0f} KB")
+
+    return contents, config
+
+
+def _generate_single(ctx: _BatchContext, indices: List[int]) -> Tuple[List[Image.Image], Optional[str]]:
+    """
+    发起一次调用生成一组海报（失败时按重试策略重试）
+
+    返回:
+        tuple: (图片列表, 错误原因)，图片最多 len(indices) 张，为空时错误原因必有值
+    """
+    index = indices[0]
+    print(f"正在生成第 {_label(indices)}/{ctx.total} 张海报...")
+
+    attempt = 0
+    while True:
+        if ctx.stopped():
+            return [], ctx.stop_reason()
+        attempt += 1
+        started = time.monotonic()
+        images, reason = _attempt_with_hedge(ctx, index, len(indices))
+        if reason == CANCELLED_REASON:
+            return [], ctx.stop_reason()
+        ctx.attempt_log.record(index, attempt, reason, time.monotonic() - started)
+        ctx.note_outcome(reason)
+
+        if images:
+            # 保存到本地
+            images = images[:len(indices)]
+            for image_index, image in zip(indices, images):
+                _save_image(image, image_index)
+            return images, None
+
+        delay = _next_retry_delay(ctx, index, attempt, reason)
+        if delay is None:
+            return [], reason
+        time.sleep(delay)
 
+
+def _label(indices: List[int]) -> str:
+    """日志中一组序号的显示文本，如 3 或 3-4"""
+    if len(indices) == 1:
+        return f"{indices[0]+1}"
+    return f"{indices[0]+1}-{indices[-1]+1}"
+
+
+def _next_retry_delay(
+    ctx: _BatchContext,
+    index: int,
+    attempt: int,
+    reason: str
+) -> Optional[float]:
+    """根据重试策略返回下次重试前的等待秒数，不再重试时返回 None"""
+    if not ctx.retry_policy.should_retry(reason, attempt):
+        return None
+    if not ctx.attempt_log.consume_retry(ctx.retry_policy.max_batch_retries):
+        return None
+
+    delay = ctx.retry_policy.backoff(reason, attempt)
+    remaining = ctx.deadline.remaining()
+    if remaining is not None and delay >= remaining:
+        # 等不到下次尝试就会超时，不再重试
+        return None
+    print(f"第 {index+1} 张{reason}，{delay:.1f} 秒后进行第 {attempt+1} 次尝试")
+    return delay
+
+
+def _attempt_with_hedge(
+    ctx: _BatchContext,
+    index: int,
+    count: int = 1
+) -> Tuple[List[Image.Image], Optional[str]]:
+    """
+    发起一次调用；启用对冲时，超过近期延迟分位数仍未返回就再发一个相同请求，先成功者胜出
+
+    同步调用无法中途中断，落败请求会在后台跑完，其结果直接丢弃。
+    """
+    delay = ctx.hedge_policy.hedge_delay(latency_tracker) if ctx.hedge_policy else None
+    if delay is None:
+        return _attempt_once(ctx, index, count)
+
+    primary = _hedge_executor.submit(_attempt_once, ctx, index, count)
+    try:
+        return primary.result(timeout=delay)
+    except FuturesTimeoutError:
+        pass
+
+    if not ctx.hedge_budget.try_spend():
+        return primary.result()
+
+    print(f"第 {index+1} 张超过 {delay:.1f} 秒未返回，发出对冲请求")
+    backup = _hedge_executor.submit(_attempt_once, ctx, index, count)
+
+    pending = {primary, backup}
+    result = ([], "未知错误")
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            if result[0]:
+                for loser in pending:
+                    loser.cancel()
+                return result
+    return result
+
+
+def _breaker_admit(ctx: _BatchContext) -> bool:
+    """熔断器放行检查：open 时直接拒绝，half_open 时等待探测结果而不是直接失败"""
+    while not circuit_breaker.allow():
+        if not circuit_breaker.probing() or ctx.stopped():
+            return False
+        time.sleep(0.2)
+    return True
+
+
+def _acquire_permit(ctx: _BatchContext) -> bool:
+    """等待限流器放行，截止时间到期或被取消时返回 False"""
+    while not ctx.stopped():
+        if rate_limiter.acquire(timeout=_poll_interval(ctx)):
+            if ctx.stopped():
+                # 等待期间批次已取消或到期：归还许可，不再发起调用
+                rate_limiter.release(OUTCOME_UNUSED)
+                return False
+            return True
+    return False
+
+
+def _plan_batch(ctx: _BatchContext):
+    """
+    Thinking 模式下调用一次文本模型为每张海报规划设计方案；失败时退回逐张规划（Thinking 前缀）
+
+    只生成一张时没有需要错开的方案，直接逐张规划，省去一次文本模型调用
+    """
+    if not ctx.planning or ctx.total <= 1 or ctx.plans is not None or ctx.stopped():
+        return
+    ctx.plans = []
+    api_key = key_pool.acquire()
+    started = time.monotonic()
+    try:
+        ctx.plans = plan_designs(get_client(api_key), _planner_brief(ctx), ctx.total, ctx.deadline.remaining())
+        print(f"设计规划完成: {len(ctx.plans)} 个方案，耗时 {time.monotonic() - started:.1f} 秒")
+    except Exception as e:
+        print(f"设计规划失败，改为逐张规划: {str(e)}")
+    finally:
+        # 规划使用文本模型，结果不计入 Key 的健康状态
+        key_pool.release(api_key, cancelled=True)
+
+
+def _prompt_text(ctx: _BatchContext) -> str:
+    """本批的文字提示词（contents 为列表时是第一项）"""
+    return ctx.contents if isinstance(ctx.contents, str) else ctx.contents[0]
+
+
+def _planner_brief(ctx: _BatchContext) -> str:
+    """发送给规划模型的需求：去掉 Thinking 前缀的完整提示词"""
+    return _prompt_text(ctx).replace(THINKING_PREFIX + ". ", "", 1)
+
+
+def _call_contents(ctx: _BatchContext, index: int):
+    """
+    某次调用发送的 contents：有设计方案时用该张的方案替换 Thinking 前缀
+
+    一次调用请求多张时（images_per_call > 1），候选共用该调用第一张的方案
+    """
+    if not ctx.plans:
+        return ctx.contents
+    plan = ctx.plans[index % len(ctx.plans)]
+    prompt = _prompt_text(ctx).replace(THINKING_PREFIX, f"Design plan: {plan}", 1)
+    if isinstance(ctx.contents, str):
+        return prompt
+    return [prompt] + ctx.contents[1:]
+
+
+def _call_config(ctx: _BatchContext, count: int = 1) -> types.GenerateContentConfig:
+    """单次调用的配置：请求多张时设置候选数量，有截止时间时把剩余时间作为本次 HTTP 请求的超时"""
+    update = {}
+    if count > 1:
+        update["candidate_count"] = count
+    remaining = ctx.deadline.remaining()
+    if remaining is not None:
+        update["http_options"] = types.HttpOptions(timeout=max(1000, int(remaining * 1000)))
+    return ctx.config.model_copy(update=update) if update else ctx.config
+
+
+def _attempt_once(
+    ctx: _BatchContext,
+    index: int,
+    count: int = 1
+) -> Tuple[List[Image.Image], Optional[str]]:
+    """发起一次模型调用（请求 count 张），返回 (图片列表, 错误原因)"""
+    # 熔断期间快速失败，不占用限流许可
+    if not _breaker_admit(ctx):
+        return [], CIRCUIT_OPEN_REASON
+
+    # 放行后必须报告调用结果或归还探测名额：提前返回、抛出异常或被取消时在 finally 中归还，
+    # 否则 half_open 状态的探测名额永远不会释放
+    reported = False
+    try:
+        # 等待共享限流器放行（截止时间到期则放弃）
+        if not _acquire_permit(ctx):
+            return [], CANCELLED_REASON
+        api_key = _acquire_key()
+        started = time.monotonic()
         try:
-            # 准备内容（包含提示词和所有图片素材）
-            contents = [enhanced_prompt]
-
-            # 添加参考图片
-            if reference_image:
-                contents.append(reference_image)
-
-            # 添加 Logo
-            if logo_image:
-                contents.append(logo_image)
-
-            # 添加二维码
-            if qrcode_image:
-                contents.append(qrcode_image)
-
-            # 如果只有文本，不用列表
-            if len(contents) == 1:
-                contents = contents[0]
-
-            # 生成内容
-            response = client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=contents,
-                config=config
+            # 生成内容（使用该 Key 的共享客户端）
+            response = get_client(api_key).models.generate_content(
+                model=IMAGE_MODEL,
+                contents=_call_contents(ctx, index),
+                config=_call_config(ctx, count)
             )
 
-            # 提取图片
-            image = _extract_image_from_response(response)
-            if image:
-                generated_images.append(image)
-                # 保存到本地
-                _save_image(image, i)
-            else:
-                print(f"警告: 第 {i+1} 张海报生成失败，跳过")
-
+            # 提取图片（多个候选时全部提取）
+            images = _extract_images_from_response(response)
         except Exception as e:
-            print(f"生成第 {i+1} 张时出错: {str(e)}")
-            continue
+            print(f"生成第 {index+1} 张时出错: {str(e)}")
+            reason = _classify_error(e)
+            key_pool.release(api_key, e)
+            rate_limiter.release(OUTCOME_THROTTLED if reason == "API配额不足" else OUTCOME_ERROR)
+            _report_to_breaker(ctx, reason)
+            reported = True
+            return [], reason
 
-    if not generated_images:
-        raise ValueError("所有海报生成均失败")
+        key_pool.release(api_key)
+        rate_limiter.release(OUTCOME_SUCCESS)
+        circuit_breaker.record_success()
+        reported = True
 
-    print(f"成功生成 {len(generated_images)} 张海报")
-    return generated_images
+        if images:
+            latency_tracker.record(time.monotonic() - started)
+            return images, None
+
+        print(f"警告: 第 {index+1} 张海报生成失败，跳过")
+        return [], SAFETY_REASON
+    finally:
+        if not reported:
+            circuit_breaker.release()
+
+
+def _acquire_key() -> str:
+    """从 Key 池选择本次调用使用的 Key；所有 Key 均已失效时归还限流许可并抛出 ValueError"""
+    try:
+        return key_pool.acquire()
+    except ValueError:
+        rate_limiter.release(OUTCOME_ERROR)
+        raise
+
+
+def _report_to_breaker(ctx: _BatchContext, reason: str):
+    """向熔断器报告一次失败调用：服务故障计入失败率，截止时间导致的超时与配额限制不计入"""
+    if reason in BREAKER_FAILURE_REASONS and not ctx.deadline.expired():
+        circuit_breaker.record_failure()
+    elif reason == SAFETY_REASON:
+        # 服务正常响应，只是内容被拦截
+        circuit_breaker.record_success()
+    else:
+        circuit_breaker.release()
+
+
+def _classify_error(error: Exception) -> str:
+    """将异常归类为错误原因（用于决定是否重试）"""
+    error_msg = str(error).lower()
+
+    if "timeout" in error_msg or "timed out" in error_msg:
+        return "生成超时"
+    elif is_quota_error(error):
+        return "API配额不足"
+    elif is_key_error(error):
+        return KEY_ERROR_REASON
+    elif "safety" in error_msg or "blocked" in error_msg or "filter" in error_msg:
+        return SAFETY_REASON
+    elif "network" in error_msg or "connection" in error_msg:
+        return "网络波动"
+    elif "server" in error_msg or "503" in error_msg or "500" in error_msg:
+        return "服务器繁忙"
+    else:
+        return "未知错误"
 
 
 def _build_prompt(
@@ -122,25 +1025,49 @@ def _build_prompt(
     reference_image: Optional[Image.Image],
     logo_image: Optional[Image.Image],
     qrcode_image: Optional[Image.Image],
-    slogan: Optional[str]
+    slogan: Optional[str],
+    draft_image: Optional[Image.Image] = None
 ) -> str:
-    """构建完整的提示词"""
+    """构建完整的提示词（去掉与用户提示词重复的子句）"""
+    return join_clauses(_prompt_parts(
+        user_prompt, thinking_mode, style_prompt, reference_image,
+        logo_image, qrcode_image, slogan, draft_image
+    ))
+
+
+def _prompt_parts(
+    user_prompt: str,
+    thinking_mode: bool,
+    style_prompt: Optional[str],
+    reference_image: Optional[Image.Image],
+    logo_image: Optional[Image.Image],
+    qrcode_image: Optional[Image.Image],
+    slogan: Optional[str],
+    draft_image: Optional[Image.Image] = None
+) -> List[str]:
+    """按顺序返回提示词的各个片段（用户提示词为空时不包含该片段）"""
     prompt_parts = []
 
     # Thinking 模式前缀
     if thinking_mode:
-        prompt_parts.append(
-            "First, analyze the design requirements and plan the visual strategy. "
-            "Then generate the poster based on your analysis."
-        )
+        prompt_parts.append(THINKING_PREFIX)
 
     # 用户输入
-    prompt_parts.append(user_prompt)
+    if user_prompt:
+        prompt_parts.append(user_prompt)
 
     # 风格描述
     if style_prompt:
         prompt_parts.append(f"Style reference: {style_prompt}")
 
+    # 定稿说明：草稿已确定构图，只提高分辨率与细节
+    if draft_image:
+        prompt_parts.append(
+            "The provided draft image is the approved preview of this poster. "
+            "Re-render it at full resolution: keep the layout, subject, text and colors unchanged, "
+            "and refine the details and typography"
+        )
+
     # 图生图说明
     if reference_image:
         prompt_parts.append(
@@ -162,21 +1089,24 @@ def _build_prompt(
 
     # 基础要求
     prompt_parts.append("high quality poster design, professional typography")
+    return prompt_parts
 
-    return ". ".join(prompt_parts)
 
-
-def _extract_image_from_response(response) -> Optional[Image.Image]:
-    """从响应中提取图片"""
-    for part in response.parts:
-        if hasattr(part, 'inline_data') and part.inline_data:
-            try:
-                image_bytes = part.inline_data.data
-                return Image.open(BytesIO(image_bytes))
-            except Exception as e:
-                print(f"图片解析失败: {str(e)}")
-                continue
-    return None
+def _extract_images_from_response(response) -> List[Image.Image]:
+    """从响应中提取所有图片（每个候选中的每个图片部分）"""
+    images = []
+    for candidate in response.candidates or []:
+        if not candidate.content or not candidate.content.parts:
+            continue
+        for part in candidate.content.parts:
+            if hasattr(part, 'inline_data') and part.inline_data:
+                try:
+                    image_bytes = part.inline_data.data
+                    images.append(Image.open(BytesIO(image_bytes)))
+                except Exception as e:
+                    print(f"图片解析失败: {str(e)}")
+                    continue
+    return images
 
 
 def _save_image(image: Image.Image, index: int):
@@ -0,0 +1,498 @@
+# MirrorPost AI - 生成结果缓存模块
+# 以请求内容（提示词、图片配置、素材图片）的哈希为键，把生成结果缓存到本地磁盘；
+# 素材相同、提示词子句完全相同（只有空白、标点、子句顺序不同）的请求直接复用结果；
+# 更模糊的近似（MinHash/LSH 估计的相似度达到阈值）只作为「候选」返回，调用方明确接受后才使用，
+# 且提示词中的数字（价格、日期、电话）与引号内的文字必须完全相同
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from PIL import Image
+
+# 加载环境变量
+load_dotenv()
+
+# 缓存参数（可通过环境变量覆盖）
+CACHE_ENABLED = os.getenv("MIRRORPOST_CACHE", "0") == "1"
+DEFAULT_CACHE_DIR = os.getenv("MIRRORPOST_CACHE_DIR", "cache")
+DEFAULT_MAX_BYTES = int(float(os.getenv("MIRRORPOST_CACHE_MAX_MB", "500")) * 1024 * 1024)
+DEFAULT_TTL_SECONDS = float(os.getenv("MIRRORPOST_CACHE_TTL_HOURS", "168")) * 3600
+# 近似候选的相似度阈值（估计的 Jaccard 相似度），设为 1 不提供候选
+DEFAULT_SIMILARITY = float(os.getenv("MIRRORPOST_CACHE_SIMILARITY", "0.9"))
+
+# MinHash / LSH 参数：128 个哈希函数分成 32 段，每段 4 个
+SHINGLE_SIZE = 4
+NUM_PERM = 128
+LSH_BANDS = 32
+_ROWS_PER_BAND = NUM_PERM // LSH_BANDS
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20250101)  # 固定种子，签名在重启后保持一致
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(NUM_PERM)
+]
+_NON_WORD = re.compile(r"[^\w]+")
+# 比较子句集合时的分隔：句末标点、逗号、顿号与换行
+_CLAUSE_BREAK = re.compile(r"[.!?;。！？；,，、\n]+")
+# 必须逐字相同的内容：数字串（含 19.9、2025-01-01、10:30 这类分隔）与各种引号、书名号内的文字
+_FACTS = re.compile(
+    r"\d+(?:[.,:/-]\d+)*"
+    r"|\"[^\"]*\"|(?<!\w)'[^']*'(?!\w)|“[^”]*”|‘[^’]*’|「[^」]*」|『[^』]*』|《[^》]*》"
+)
+
+
+def make_key(model: str, contents, image_config) -> str:
+    """
+    计算请求的内容哈希
+
+    参数:
+        model (str): 模型名称
+        contents: 发送给模型的内容（字符串、PIL 图片或二者组成的列表）
+        image_config: types.ImageConfig
+
+    返回:
+        str: 十六进制摘要
+    """
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(image_config.model_dump_json(exclude_none=True).encode("utf-8"))
+
+    parts = contents if isinstance(contents, list) else [contents]
+    for part in parts:
+        if isinstance(part, Image.Image):
+            digest.update(f"image:{part.mode}:{part.size}".encode("utf-8"))
+            digest.update(part.tobytes())
+        elif isinstance(part, bytes):
+            digest.update(b"bytes:")
+            digest.update(part)
+        elif hasattr(part, "inline_data") and part.inline_data:
+            # 已编码的 types.Part
+            digest.update(f"part:{part.inline_data.mime_type}".encode("utf-8"))
+            digest.update(part.inline_data.data)
+        else:
+            digest.update(f"text:{part}".encode("utf-8"))
+        digest.update(b"\x00")
+
+    return digest.hexdigest()
+
+
+def _shingles(text: str) -> set:
+    """规范化文本（小写、去标点、合并空白）后切成字符 shingle"""
+    text = " ".join(_NON_WORD.sub(" ", text.lower()).split())
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text: str) -> List[int]:
+    """
+    计算文本的 MinHash 签名
+
+    参数:
+        text (str): 提示词
+
+    返回:
+        List[int]: NUM_PERM 个最小哈希值，两个签名中相等位置的比例即 Jaccard 相似度的估计
+    """
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for shingle in _shingles(text)
+    ]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(signature_a: List[int], signature_b: List[int]) -> float:
+    """两个 MinHash 签名估计的 Jaccard 相似度"""
+    return sum(1 for x, y in zip(signature_a, signature_b) if x == y) / NUM_PERM
+
+
+def prompt_facts(text: str) -> List[str]:
+    """提取提示词中必须逐字相同的内容（数字串与引号内的文字），按出现顺序返回"""
+    return _FACTS.findall(text or "")
+
+
+def clause_signature(text: str) -> str:
+    """
+    提示词子句集合的哈希：每个子句小写、去标点、合并空白后排序，子句顺序与标点不同的提示词结果相同
+
+    参数:
+        text (str): 提示词
+
+    返回:
+        str: 十六进制摘要
+    """
+    clauses = sorted(
+        " ".join(_NON_WORD.sub(" ", clause.lower()).split()) for clause in _CLAUSE_BREAK.split(text or "")
+    )
+    return hashlib.sha256("\x1f".join(clause for clause in clauses if clause).encode("utf-8")).hexdigest()
+
+
+def similarity_key(model: str, fixed_parts: list, image_config, user_prompt: str) -> Tuple[str, List[int], str]:
+    """
+    计算近似命中用的键
+
+    参数:
+        model (str): 模型名称
+        fixed_parts (list): 请求中与用户提示词无关的部分（后端追加的固定说明与素材图片）
+        image_config: types.ImageConfig
+        user_prompt (str): 用户提示词（允许有细微差别的部分）
+
+    返回:
+        tuple: (固定部分、图片配置与提示词中数字 / 引号文字的哈希, 用户提示词的 MinHash 签名, 子句集合的哈希)；
+            第一项必须完全相同才会命中或成为候选，改了价格、日期或标题文字的提示词不会拿到旧海报
+    """
+    facts = "\x1f".join(prompt_facts(user_prompt))
+    asset_key = make_key(model, list(fixed_parts) + [f"facts:{facts}"], image_config)
+    return asset_key, minhash(user_prompt), clause_signature(user_prompt)
+
+
+def _bands(signature: List[int]) -> List[str]:
+    """把签名切成 LSH 分段，任一分段相同的条目才进入候选"""
+    return [
+        f"{band}:" + ",".join(map(str, signature[band * _ROWS_PER_BAND:(band + 1) * _ROWS_PER_BAND]))
+        for band in range(LSH_BANDS)
+    ]
+
+
+class CacheManager:
+    """缓存管理器：磁盘缓存生成结果，支持容量上限（LRU 淘汰）与过期时间"""
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        enabled: bool = CACHE_ENABLED,
+        similarity_threshold: float = DEFAULT_SIMILARITY
+    ):
+        """
+        初始化缓存管理器
+
+        参数:
+            cache_dir (str): 缓存目录
+            max_bytes (int): 缓存总大小上限（字节）
+            ttl_seconds (float): 缓存有效期（秒）
+            enabled (bool): 是否启用缓存
+            similarity_threshold (float): 近似候选的相似度阈值，>= 1 时不提供候选
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._index: Dict[str, Dict] = {}
+        # LSH 桶：(素材哈希, 分段) -> 缓存键
+        self._buckets: Dict[Tuple[str, str], set] = {}
+        # 子句集合完全相同的条目：(素材哈希, 子句集合哈希) -> 缓存键
+        self._clause_index: Dict[Tuple[str, str], str] = {}
+        if self.enabled:
+            self._ensure_dir()
+            self._index = self._load_index()
+            for key, entry in self._index.items():
+                self._add_to_buckets(key, entry)
+
+    def _ensure_dir(self):
+        """确保缓存目录存在"""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _index_path(self) -> str:
+        """索引文件路径"""
+        return os.path.join(self.cache_dir, "index.json")
+
+    def _load_index(self) -> Dict[str, Dict]:
+        """从磁盘加载索引（重启后缓存依然可用）"""
+        index_path = self._index_path()
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"加载缓存索引失败: {str(e)}")
+            return {}
+
+    def _save_index(self):
+        """保存索引（调用方需持有锁）"""
+        try:
+            tmp_path = self._index_path() + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._index, f, ensure_ascii=False)
+            os.replace(tmp_path, self._index_path())
+        except Exception as e:
+            print(f"保存缓存索引失败: {str(e)}")
+
+    def get(self, key: str, count: int) -> Optional[Dict]:
+        """
+        读取缓存
+
+        参数:
+            key (str): 请求哈希
+            count (int): 需要的图片数量，缓存中不足时视为未命中
+
+        返回:
+            Dict: {"images": List[Image.Image], "error_reason": str}，未命中返回 None
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry["created_at"] > self.ttl_seconds:
+                self._remove(key)
+                self._save_index()
+                return None
+            if len(entry["files"]) < count:
+                return None
+
+        cached = self._read(key, count)
+        if cached:
+            print(f"命中缓存: {key[:12]}（{count} 张）")
+        return cached
+
+    def get_equivalent(self, near_key: Tuple[str, List[int], str], count: int) -> Optional[Dict]:
+        """
+        读取素材相同、提示词子句完全相同（只有空白、标点、子句顺序不同）的缓存，可直接使用
+
+        参数:
+            near_key (tuple): similarity_key 的返回值
+            count (int): 需要的图片数量
+
+        返回:
+            Dict: 同 get；没有等价条目时返回 None
+        """
+        if not self.enabled:
+            return None
+
+        asset_key, _, clauses = near_key
+        with self._lock:
+            key = self._clause_index.get((asset_key, clauses))
+            entry = self._index.get(key) if key else None
+            if (entry is None or len(entry["files"]) < count
+                    or time.time() - entry["created_at"] > self.ttl_seconds):
+                return None
+
+        cached = self._read(key, count)
+        if cached:
+            print(f"命中等价缓存: {key[:12]}（子句相同）")
+        return cached
+
+    def find_offer(self, near_key: Tuple[str, List[int], str], count: int) -> Optional[Dict]:
+        """
+        查找提示词近似、素材相同的缓存条目，作为候选提供给调用方（不读取图片，也不自动使用）
+
+        参数:
+            near_key (tuple): similarity_key 的返回值
+            count (int): 需要的图片数量
+
+        返回:
+            Dict: {"offer_id": 缓存键, "similarity": 估计的相似度}；没有达到阈值的条目时返回 None
+        """
+        if not self.enabled or self.similarity_threshold >= 1:
+            return None
+
+        asset_key, signature, clauses = near_key
+        with self._lock:
+            now = time.time()
+            candidates = set()
+            for band in _bands(signature):
+                candidates |= self._buckets.get((asset_key, band), set())
+
+            best_key, best_score = None, self.similarity_threshold
+            for key in candidates:
+                entry = self._index.get(key)
+                if (entry is None or len(entry["files"]) < count
+                        or now - entry["created_at"] > self.ttl_seconds):
+                    continue
+                if entry["near"].get("clauses") == clauses:
+                    continue  # 子句相同的条目由 get_equivalent 直接命中，不需要候选
+                score = similarity(signature, entry["near"]["signature"])
+                if score >= best_score:
+                    best_key, best_score = key, score
+
+        if best_key is None:
+            return None
+        print(f"找到近似缓存候选: {best_key[:12]}（相似度 {best_score:.2f}）")
+        return {"offer_id": best_key, "similarity": best_score}
+
+    def accept_offer(self, offer_id: str, near_key: Tuple[str, List[int], str], count: int) -> Optional[Dict]:
+        """
+        读取调用方已接受的候选（find_offer 返回的 offer_id）
+
+        参数:
+            offer_id (str): 候选的缓存键
+            near_key (tuple): 本次请求的 similarity_key，素材与提示词中的数字 / 引号文字必须与候选相同
+            count (int): 需要的图片数量
+
+        返回:
+            Dict: 同 get；候选已失效或与本次请求的素材不符时返回 None
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._index.get(offer_id)
+            if (entry is None or not entry.get("near") or entry["near"]["asset"] != near_key[0]
+                    or len(entry["files"]) < count or time.time() - entry["created_at"] > self.ttl_seconds):
+                return None
+
+        cached = self._read(offer_id, count)
+        if cached:
+            print(f"使用已接受的近似缓存: {offer_id[:12]}")
+        return cached
+
+    def _read(self, key: str, count: int) -> Optional[Dict]:
+        """读取条目的前 count 张图片并更新访问时间，文件损坏时删除条目"""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            entry["last_access"] = time.time()
+            files = entry["files"][:count]
+
+        try:
+            images = []
+            for filename in files:
+                with Image.open(os.path.join(self.cache_dir, filename)) as img:
+                    img.load()
+                    images.append(img.copy())
+        except Exception as e:
+            print(f"读取缓存失败: {str(e)}")
+            with self._lock:
+                self._remove(key)
+                self._save_index()
+            return None
+
+        with self._lock:
+            self._save_index()
+        return {"images": images, "error_reason": entry.get("error_reason")}
+
+    def put(
+        self,
+        key: str,
+        images: List[Image.Image],
+        error_reason: Optional[str] = None,
+        near_key: Optional[Tuple[str, List[int], str]] = None
+    ):
+        """
+        写入缓存，超出容量时按最近最少使用淘汰
+
+        参数:
+            key (str): 请求哈希
+            images (List[Image.Image]): 生成的图片
+            error_reason (str): 本批次的主要错误原因
+            near_key (tuple): similarity_key 的返回值，传入后该条目可被等价命中或作为近似候选
+        """
+        if not self.enabled or not images:
+            return
+
+        files = []
+        size = 0
+        try:
+            for i, image in enumerate(images):
+                filename = f"{key}_{i+1}.png"
+                path = os.path.join(self.cache_dir, filename)
+                image.save(path, format="PNG")
+                files.append(filename)
+                size += os.path.getsize(path)
+        except Exception as e:
+            print(f"写入缓存失败: {str(e)}")
+            return
+
+        with self._lock:
+            if key in self._index:
+                self._remove(key, keep_files=files)
+            now = time.time()
+            self._index[key] = {
+                "files": files,
+                "size": size,
+                "error_reason": error_reason,
+                "created_at": now,
+                "last_access": now
+            }
+            if near_key:
+                self._index[key]["near"] = {"asset": near_key[0], "signature": near_key[1], "clauses": near_key[2]}
+                self._add_to_buckets(key, self._index[key])
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        """淘汰过期条目，再按最近访问时间淘汰直到低于容量上限（调用方需持有锁）"""
+        now = time.time()
+        for key in [k for k, e in self._index.items() if now - e["created_at"] > self.ttl_seconds]:
+            self._remove(key)
+
+        total = sum(e["size"] for e in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            total -= self._index[key]["size"]
+            self._remove(key)
+
+    def _add_to_buckets(self, key: str, entry: Dict):
+        """把条目登记到 LSH 桶（调用方需持有锁或在初始化中）"""
+        near = entry.get("near")
+        if not near:
+            return
+        for band in _bands(near["signature"]):
+            self._buckets.setdefault((near["asset"], band), set()).add(key)
+        if near.get("clauses"):
+            self._clause_index[(near["asset"], near["clauses"])] = key
+
+    def _remove(self, key: str, keep_files: Optional[List[str]] = None):
+        """删除条目及其文件（调用方需持有锁）"""
+        entry = self._index.pop(key, None)
+        if not entry:
+            return
+        near = entry.get("near")
+        if near:
+            for band in _bands(near["signature"]):
+                bucket = self._buckets.get((near["asset"], band))
+                if bucket:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[(near["asset"], band)]
+            if self._clause_index.get((near["asset"], near.get("clauses"))) == key:
+                del self._clause_index[(near["asset"], near["clauses"])]
+        for filename in entry["files"]:
+            if keep_files and filename in keep_files:
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except OSError:
+                pass
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+            self._save_index()
+
+    def stats(self) -> Dict:
+        """
+        获取缓存状态
+
+        返回:
+            Dict: 是否启用、近似候选阈值、条目数、占用字节数
+        """
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "similarity_threshold": self.similarity_threshold,
+                "entries": len(self._index),
+                "bytes": sum(e["size"] for e in self._index.values())
+            }
+
+
+# 进程内共享的结果缓存
+cache_manager = CacheManager()
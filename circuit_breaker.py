@@ -0,0 +1,212 @@
+# MirrorPost AI - 熔断模块
+# 图像服务连续出错时暂停调用并快速失败，冷却后放行少量探测请求，探测成功再恢复
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 熔断参数（可通过环境变量覆盖）
+BREAKER_ENABLED = os.getenv("MIRRORPOST_BREAKER", "1") != "0"
+DEFAULT_FAILURE_RATE = float(os.getenv("MIRRORPOST_BREAKER_FAILURE_RATE", "0.5"))
+DEFAULT_WINDOW = int(os.getenv("MIRRORPOST_BREAKER_WINDOW", "20"))
+DEFAULT_MIN_CALLS = int(os.getenv("MIRRORPOST_BREAKER_MIN_CALLS", "5"))
+DEFAULT_OPEN_SECONDS = float(os.getenv("MIRRORPOST_BREAKER_OPEN_SECONDS", "30"))
+DEFAULT_HALF_OPEN_PROBES = int(os.getenv("MIRRORPOST_BREAKER_PROBES", "1"))
+DEFAULT_PROBE_TIMEOUT = float(os.getenv("MIRRORPOST_BREAKER_PROBE_TIMEOUT", "180"))
+
+# 熔断器状态
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# 熔断期间被拒绝的调用的错误原因
+CIRCUIT_OPEN_REASON = "服务暂不可用"
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，图像服务暂时不可用"""
+
+
+class CircuitBreaker:
+    """熔断器：按最近调用的失败率在 closed / open / half_open 之间切换，线程安全"""
+
+    def __init__(
+        self,
+        failure_rate: float = DEFAULT_FAILURE_RATE,
+        window: int = DEFAULT_WINDOW,
+        min_calls: int = DEFAULT_MIN_CALLS,
+        open_seconds: float = DEFAULT_OPEN_SECONDS,
+        half_open_probes: int = DEFAULT_HALF_OPEN_PROBES,
+        probe_timeout: float = DEFAULT_PROBE_TIMEOUT,
+        enabled: bool = BREAKER_ENABLED
+    ):
+        """
+        初始化熔断器
+
+        参数:
+            failure_rate (float): 最近窗口内失败率达到该值时熔断
+            window (int): 统计失败率的最近调用数
+            min_calls (int): 窗口内调用数不足时不熔断
+            open_seconds (float): 熔断后的冷却时间（秒），到期后进入 half_open 放行探测请求
+            half_open_probes (int): half_open 状态下同时放行的探测请求数
+            probe_timeout (float): 探测请求超过该秒数仍无结果时视为丢失，重新熔断并冷却
+            enabled (bool): 是否启用熔断
+        """
+        self.failure_rate = failure_rate
+        self.min_calls = max(1, min_calls)
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        self.probe_timeout = probe_timeout
+        self.enabled = enabled
+
+        self._outcomes = deque(maxlen=max(1, window))  # True 表示失败
+        self._state = STATE_CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_started_at = 0.0
+        self._trip_count = 0
+        self._lock = threading.Lock()
+
+    def _update_state(self):
+        """
+        冷却时间到期时从 open 进入 half_open；探测请求超时未归还时回到 open 重新冷却（调用方需持有锁）
+        """
+        now = time.monotonic()
+        if (self._state == STATE_HALF_OPEN and self._probes_in_flight > 0
+                and now - self._probe_started_at >= self.probe_timeout):
+            print(f"[CircuitBreaker] 探测请求 {self.probe_timeout:.0f} 秒无结果，重新冷却")
+            self._state = STATE_OPEN
+            self._opened_at = now
+            self._probes_in_flight = 0
+        if self._state == STATE_OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = STATE_HALF_OPEN
+            self._probes_in_flight = 0
+            print("[CircuitBreaker] 冷却结束，放行探测请求")
+
+    def _trip(self):
+        """熔断（调用方需持有锁）"""
+        self._state = STATE_OPEN
+        self._opened_at = time.monotonic()
+        self._probes_in_flight = 0
+        self._trip_count += 1
+        print(f"[CircuitBreaker] 图像服务失败率过高，暂停调用 {self.open_seconds:.0f} 秒")
+
+    def check(self):
+        """
+        批量生成前检查：熔断且仍在冷却中时直接抛出 CircuitOpenError，不占用探测名额
+        """
+        retry_after = self.retry_after()
+        if retry_after is not None:
+            raise CircuitOpenError(f"图像服务暂时不可用，请约 {retry_after:.0f} 秒后重试")
+
+    def retry_after(self) -> Optional[float]:
+        """
+        熔断冷却的剩余秒数
+
+        返回:
+            float: 剩余秒数，未处于冷却中返回 None
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._update_state()
+            if self._state != STATE_OPEN:
+                return None
+            return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def allow(self) -> bool:
+        """
+        单次调用前检查是否放行
+
+        返回:
+            bool: True 表示可以调用（调用结束后必须 record_success / record_failure / release 之一）
+        """
+        if not self.enabled:
+            return True
+        with self._lock:
+            self._update_state()
+            if self._state == STATE_CLOSED:
+                return True
+            if self._state == STATE_HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                self._probe_started_at = time.monotonic()
+                return True
+            return False
+
+    def probing(self) -> bool:
+        """是否处于 half_open 状态（探测请求结果未定）"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            self._update_state()
+            return self._state == STATE_HALF_OPEN
+
+    def record_success(self):
+        """记录一次服务正常响应；探测成功时恢复 closed"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._state = STATE_CLOSED
+                self._outcomes.clear()
+                print("[CircuitBreaker] 探测成功，恢复调用")
+            elif self._state == STATE_CLOSED:
+                self._outcomes.append(False)
+
+    def record_failure(self):
+        """记录一次服务故障；探测失败时重新熔断，失败率超限时熔断"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._trip()
+            elif self._state == STATE_CLOSED:
+                self._outcomes.append(True)
+                if len(self._outcomes) >= self.min_calls and self._failure_rate() >= self.failure_rate:
+                    self._trip()
+
+    def release(self):
+        """调用结束但结果不能说明服务状态（如被取消、限流）时归还探测名额"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def _failure_rate(self) -> float:
+        """最近窗口内的失败率（调用方需持有锁）"""
+        if not self._outcomes:
+            return 0.0
+        return sum(self._outcomes) / len(self._outcomes)
+
+    def stats(self) -> Dict:
+        """
+        获取熔断器当前状态
+
+        返回:
+            Dict: 状态、最近失败率、窗口调用数、冷却剩余秒数、累计熔断次数
+        """
+        with self._lock:
+            self._update_state()
+            retry_after = None
+            if self._state == STATE_OPEN:
+                retry_after = round(max(0.0, self.open_seconds - (time.monotonic() - self._opened_at)), 1)
+            return {
+                "enabled": self.enabled,
+                "state": self._state,
+                "failure_rate": round(self._failure_rate(), 2),
+                "window_calls": len(self._outcomes),
+                "retry_after": retry_after,
+                "trip_count": self._trip_count
+            }
+
+
+# 进程内共享的熔断器（所有批次共用同一个图像服务）
+circuit_breaker = CircuitBreaker()
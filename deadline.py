@@ -0,0 +1,53 @@
+# MirrorPost AI - 截止时间模块
+# 一次请求的总时间预算，传递到每一次模型调用；超时或调用方取消后停止剩余工作
+
+import threading
+import time
+from typing import Optional
+
+# 截止时间已到或被取消时，未完成海报的错误原因
+CANCELLED_REASON = "请求已取消"
+
+
+class DeadlineExceeded(Exception):
+    """截止时间已到（或调用方已取消）且没有任何海报完成"""
+
+
+class Deadline:
+    """截止时间：记录剩余时间预算与取消状态，线程安全"""
+
+    def __init__(self, seconds: Optional[float] = None):
+        """
+        初始化截止时间
+
+        参数:
+            seconds (float): 从现在起的时间预算（秒），None 表示不限时（仍可手动取消）
+        """
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> Optional[float]:
+        """
+        剩余秒数
+
+        返回:
+            float: 剩余秒数（已取消时为 0），不限时返回 None
+        """
+        if self._cancelled.is_set():
+            return 0.0
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        """是否已超时或已取消"""
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def cancel(self):
+        """取消：尚未开始的调用不再发起"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
@@ -0,0 +1,113 @@
+# MirrorPost AI - 设计规划模块
+# Thinking 模式下整批只调用一次文本模型，为每张海报写出不同的设计方案，图像调用直接按方案绘制
+
+import json
+import os
+from typing import List, Optional
+
+from dotenv import load_dotenv
+from google import genai
+from google.genai import types
+
+# 加载环境变量
+load_dotenv()
+
+# 规划参数（可通过环境变量覆盖）
+PLANNER_ENABLED = os.getenv("MIRRORPOST_PLANNER", "1") != "0"
+PLANNER_MODEL = os.getenv("MIRRORPOST_PLANNER_MODEL", "gemini-2.5-flash")
+PLANNER_TIMEOUT = float(os.getenv("MIRRORPOST_PLANNER_TIMEOUT", "30"))
+
+# 单个方案的最大长度（过长的方案会挤占图像模型的提示词）
+MAX_PLAN_CHARS = 800
+
+PLANNER_INSTRUCTION = (
+    "You are the art director for a batch of {count} poster designs. The brief is:\n\n"
+    "{brief}\n\n"
+    "Analyze the design requirements and write {count} distinct design plans, one per poster. "
+    "Each plan must fix the layout, focal subject, color palette, typography and mood in two or three sentences, "
+    "keep every requirement of the brief, and differ clearly from the other plans. "
+    "Return a JSON array of {count} strings."
+)
+
+
+def build_planner_prompt(brief: str, count: int) -> str:
+    """构建发送给文本模型的规划提示词"""
+    return PLANNER_INSTRUCTION.format(brief=brief, count=count)
+
+
+def parse_plans(text: str, count: int) -> List[str]:
+    """
+    解析文本模型返回的方案列表
+
+    参数:
+        text (str): 模型返回的 JSON 文本
+        count (int): 需要的方案数量
+
+    返回:
+        List[str]: 恰好 count 个方案（不足时循环复用，多余时截断）
+
+    异常:
+        ValueError: 返回内容不是非空的字符串数组
+    """
+    text = (text or "").strip()
+    if text.startswith("```"):
+        # 去掉 Markdown 代码块标记
+        text = text.strip("`").split("\n", 1)[-1]
+    plans = json.loads(text)
+    if not isinstance(plans, list):
+        raise ValueError("设计规划返回的不是方案列表")
+    plans = [str(plan).strip().rstrip(".")[:MAX_PLAN_CHARS] for plan in plans if str(plan).strip()]
+    if not plans:
+        raise ValueError("设计规划没有返回任何方案")
+    return [plans[i % len(plans)] for i in range(count)]
+
+
+def _planner_config(timeout: Optional[float]) -> types.GenerateContentConfig:
+    """规划调用的模型配置：要求返回 JSON 字符串数组"""
+    seconds = PLANNER_TIMEOUT if timeout is None else min(PLANNER_TIMEOUT, timeout)
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=list[str],
+        http_options=types.HttpOptions(timeout=max(1000, int(seconds * 1000)))
+    )
+
+
+def plan_designs(
+    client: genai.Client,
+    brief: str,
+    count: int,
+    timeout: Optional[float] = None
+) -> List[str]:
+    """
+    调用一次文本模型，为一批海报生成 count 个不同的设计方案
+
+    参数:
+        client (genai.Client): 共享客户端
+        brief (str): 海报需求（不含 Thinking 前缀的完整提示词）
+        count (int): 方案数量（每张海报一个）
+        timeout (float): 本次调用的时间上限（秒），不超过 PLANNER_TIMEOUT
+
+    返回:
+        List[str]: count 个设计方案
+    """
+    response = client.models.generate_content(
+        model=PLANNER_MODEL,
+        contents=build_planner_prompt(brief, count),
+        config=_planner_config(timeout)
+    )
+    return parse_plans(response.text, count)
+
+
+async def plan_designs_async(
+    client: genai.Client,
+    brief: str,
+    count: int,
+    timeout: Optional[float] = None
+) -> List[str]:
+    """plan_designs 的异步版本"""
+    response = await client.aio.models.generate_content(
+        model=PLANNER_MODEL,
+        contents=build_planner_prompt(brief, count),
+        config=_planner_config(timeout)
+    )
+    return parse_plans(response.text, count)
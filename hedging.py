@@ -0,0 +1,109 @@
+# MirrorPost AI - 对冲请求模块
+# 某张海报超过近期延迟的某个分位数仍未返回时，再发一个相同请求，谁先成功用谁
+
+import math
+import threading
+from collections import deque
+from typing import Optional
+
+
+class LatencyTracker:
+    """延迟统计：保存最近若干次成功调用的耗时，线程安全"""
+
+    def __init__(self, window: int = 200):
+        """
+        初始化延迟统计
+
+        参数:
+            window (int): 保留的最近样本数
+        """
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        """记录一次成功调用的耗时（秒）"""
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """
+        计算延迟分位数
+
+        参数:
+            p (float): 分位数，0-1 之间，如 0.9 表示 p90
+
+        返回:
+            float: 对应的秒数，没有样本时返回 None
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        rank = min(len(samples) - 1, max(0, math.ceil(p * len(samples)) - 1))
+        return samples[rank]
+
+    def count(self) -> int:
+        """当前样本数"""
+        with self._lock:
+            return len(self._samples)
+
+
+class HedgePolicy:
+    """对冲策略：何时发出备份请求，以及每批最多额外花费多少次调用"""
+
+    def __init__(
+        self,
+        percentile: float = 0.9,
+        min_samples: int = 10,
+        min_delay: float = 5.0,
+        max_extra_ratio: float = 0.2
+    ):
+        """
+        初始化对冲策略
+
+        参数:
+            percentile (float): 超过近期延迟的该分位数仍未返回时发出备份请求
+            min_samples (int): 样本不足时不对冲（延迟估计不可靠）
+            min_delay (float): 对冲等待时间的下限（秒）
+            max_extra_ratio (float): 每批额外调用数上限占请求数量的比例
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_extra_ratio = max_extra_ratio
+
+    def hedge_delay(self, tracker: "LatencyTracker") -> Optional[float]:
+        """
+        计算发出备份请求前的等待秒数
+
+        返回:
+            float: 等待秒数，样本不足时返回 None（不对冲）
+        """
+        if tracker.count() < self.min_samples:
+            return None
+        return max(self.min_delay, tracker.percentile(self.percentile))
+
+    def budget_for(self, num_images: int) -> "HedgeBudget":
+        """为一批生成创建额外调用预算（至少 1 次）"""
+        return HedgeBudget(max(1, math.ceil(num_images * self.max_extra_ratio)))
+
+
+class HedgeBudget:
+    """一批生成中对冲请求的额外调用预算，线程安全"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def try_spend(self) -> bool:
+        """占用一次额外调用，预算用完时返回 False"""
+        with self._lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+
+# 进程内共享的延迟统计（所有批次的成功调用）
+latency_tracker = LatencyTracker()
@@ -0,0 +1,65 @@
+# MirrorPost AI - 素材编码模块
+# 将上传的素材图片缩放并编码为紧凑的字节，每批生成只编码一次，所有调用复用
+
+from io import BytesIO
+from typing import Dict, Tuple
+
+from google.genai import types
+from PIL import Image
+
+# 各类素材的编码方式：(最长边像素, 格式)
+# 参考图只取风格与构图，JPEG 即可；Logo / 二维码需要透明度与清晰边缘，保留 PNG
+ASSET_PROFILES: Dict[str, Tuple[int, str]] = {
+    "reference": (1536, "JPEG"),
+    "logo": (1024, "PNG"),
+    "qrcode": (1024, "PNG"),
+    "combo": (1024, "AUTO"),
+}
+
+JPEG_QUALITY = 90
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    """判断图片是否带透明通道"""
+    return image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def encode_asset(image: Image.Image, kind: str) -> types.Part:
+    """
+    缩放并编码一张素材图片
+
+    参数:
+        image (Image.Image): 原始素材
+        kind (str): 素材类型，"reference" / "logo" / "qrcode" / "combo"
+
+    返回:
+        types.Part: 可直接放入 contents 的内联图片
+    """
+    max_dim, image_format = ASSET_PROFILES[kind]
+
+    if max(image.size) > max_dim:
+        image = image.copy()
+        # 二维码用最近邻缩放，保持模块边缘锐利便于扫码
+        resample = Image.NEAREST if kind == "qrcode" else Image.LANCZOS
+        image.thumbnail((max_dim, max_dim), resample)
+
+    if image_format == "AUTO":
+        image_format = "PNG" if _has_alpha(image) else "JPEG"
+
+    buffer = BytesIO()
+    if image_format == "JPEG":
+        image.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY)
+        mime_type = "image/jpeg"
+    else:
+        if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+            image = image.convert("RGBA")
+        image.save(buffer, format="PNG")
+        mime_type = "image/png"
+
+    return types.Part.from_bytes(data=buffer.getvalue(), mime_type=mime_type)
+
+
+def part_size(part) -> int:
+    """返回内联图片的字节数（非图片返回 0）"""
+    inline_data = getattr(part, "inline_data", None)
+    return len(inline_data.data) if inline_data and inline_data.data else 0
@@ -0,0 +1,253 @@
+# MirrorPost AI - 多轮微调模块
+# 每张海报对应一个多轮对话（client.chats），微调时只发送本轮的修改指令，不再重建提示词、重新编码素材和整张海报
+# 对话历史只保留一段提示词摘要、之前的修改指令与最新一张海报，不带 Logo / 二维码 / 参考图
+# 对话缓存在内存中，按最近使用淘汰，超时未用的对话自动过期
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from google.genai import types
+from PIL import Image
+
+from backend import IMAGE_MODEL, extract_images
+from circuit_breaker import circuit_breaker
+from client_manager import get_client
+from image_encoder import encode_asset
+from key_pool import key_pool
+from rate_limiter import OUTCOME_ERROR, OUTCOME_SUCCESS, OUTCOME_THROTTLED, is_quota_error, rate_limiter
+
+# 加载环境变量
+load_dotenv()
+
+# 微调对话参数（可通过环境变量覆盖）
+DEFAULT_MAX_SESSIONS = int(os.getenv("MIRRORPOST_REFINE_SESSIONS", "32"))
+DEFAULT_SESSION_TTL = float(os.getenv("MIRRORPOST_REFINE_TTL", "1800"))
+DEFAULT_MAX_TURNS = int(os.getenv("MIRRORPOST_REFINE_TURNS", "3"))
+DEFAULT_PERMIT_TIMEOUT = 60.0
+
+# 对话中提示词摘要的最大字数
+SUMMARY_CHARS = 300
+
+
+class _RefineSession:
+    """一张海报的微调对话：历史中只有一轮「摘要 + 之前的修改指令」与模型返回的最新海报"""
+
+    def __init__(self, poster: Image.Image, prompt: str, config: types.GenerateContentConfig):
+        self.poster = poster
+        self.summary = summarize_prompt(prompt)
+        self.config = config
+        self.chat = None  # 第一次微调时才创建
+        self.api_key: Optional[str] = None
+        self.instructions: List[str] = []
+        self.turns = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def context_text(self) -> str:
+        """对话首轮的文字部分：提示词摘要与之前的修改指令"""
+        text = f"This poster was generated from the brief: {self.summary}"
+        if self.instructions:
+            text += "\nChanges already applied: " + "; ".join(self.instructions)
+        return text
+
+    def first_message(self, instruction: str) -> list:
+        """
+        对话的第一条消息：摘要 + 当前海报 + 本轮指令，作为用户轮发送
+
+        海报放在用户轮而不是伪造一条模型轮：历史中的模型轮都来自真实响应，带有模型返回的 thought signature
+        """
+        return [
+            types.Part.from_text(text=self.context_text()),
+            encode_asset(self.poster, "reference"),
+            types.Part.from_text(
+                text=f"Edit this poster as follows and keep everything else unchanged: {instruction}"
+            )
+        ]
+
+
+def summarize_prompt(prompt: str, max_chars: int = SUMMARY_CHARS) -> str:
+    """把生成提示词截成一段简短摘要（对话中只需提示主题，细节已在海报里）"""
+    prompt = " ".join((prompt or "").split())
+    return prompt if len(prompt) <= max_chars else prompt[:max_chars].rstrip() + "…"
+
+
+class RefineManager:
+    """微调对话管理器：按海报编号缓存对话，线程安全"""
+
+    def __init__(
+        self,
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        ttl: float = DEFAULT_SESSION_TTL,
+        max_turns: int = DEFAULT_MAX_TURNS
+    ):
+        """
+        初始化微调对话管理器
+
+        参数:
+            max_sessions (int): 最多缓存的对话数，超出时淘汰最久未用的
+            ttl (float): 对话超过该秒数未使用即过期
+            max_turns (int): 对话中保留的最近修改指令条数（海报只保留最新一张）
+        """
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl
+        self.max_turns = max(1, max_turns)
+        self._sessions: "OrderedDict[str, _RefineSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, poster_id: str, poster: Image.Image, prompt: str, config: types.GenerateContentConfig):
+        """
+        登记一张海报，之后可对它多轮微调（只保存引用，第一次微调时才创建对话）
+
+        参数:
+            poster_id (str): 海报编号
+            poster (Image.Image): 海报图片
+            prompt (str): 生成该海报的提示词（对话中只发送其摘要）
+            config (types.GenerateContentConfig): 生成该海报的模型配置
+        """
+        with self._lock:
+            self._sessions[poster_id] = _RefineSession(poster, prompt, config)
+            self._sessions.move_to_end(poster_id)
+            self._evict()
+
+    def has(self, poster_id: str) -> bool:
+        """海报是否有可用的微调对话（未过期、未被淘汰）"""
+        with self._lock:
+            self._evict()
+            return poster_id in self._sessions
+
+    def drop(self, poster_id: str):
+        """丢弃一张海报的对话"""
+        with self._lock:
+            self._sessions.pop(poster_id, None)
+
+    def _evict(self):
+        """淘汰过期与超出数量的对话（调用方需持有锁）"""
+        now = time.monotonic()
+        for poster_id in [pid for pid, session in self._sessions.items() if now - session.last_used > self.ttl]:
+            del self._sessions[poster_id]
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def _get(self, poster_id: str) -> _RefineSession:
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(poster_id)
+            if session is None:
+                raise ValueError("微调对话已过期，请重新生成海报")
+            self._sessions.move_to_end(poster_id)
+            session.last_used = time.monotonic()
+            return session
+
+    def refine(self, poster_id: str, instruction: str) -> Image.Image:
+        """
+        在海报的对话中发送一轮修改指令
+
+        参数:
+            poster_id (str): 海报编号
+            instruction (str): 本轮修改指令（只发送这一句，摘要与最新海报已在对话中）
+
+        返回:
+            Image.Image: 修改后的海报（同时成为对话中的当前海报）
+
+        异常:
+            ValueError: 对话已过期，或模型没有返回图片（如触发安全过滤）
+            CircuitOpenError: 图像服务熔断中
+        """
+        session = self._get(poster_id)
+        with session.lock:
+            circuit_breaker.check()
+            # 首轮的对话在拿到图片后才挂到会话上，失败时下次重新带上摘要与原海报
+            chat = session.chat
+            if chat is None:
+                session.api_key = key_pool.acquire()
+                key_pool.release(session.api_key, cancelled=True)  # 对话期间固定使用该 Key，不占用负载
+                chat = get_client(session.api_key).chats.create(model=IMAGE_MODEL, config=session.config)
+                message = session.first_message(instruction)
+            else:
+                message = instruction
+
+            if not rate_limiter.acquire(timeout=DEFAULT_PERMIT_TIMEOUT):
+                raise TimeoutError("请求过多，请稍后重试")
+            started = time.monotonic()
+            try:
+                response = chat.send_message(message)
+                images = extract_images(response)
+            except Exception as e:
+                rate_limiter.release(OUTCOME_THROTTLED if is_quota_error(e) else OUTCOME_ERROR)
+                key_pool.report(session.api_key, e)
+                raise
+            rate_limiter.release(OUTCOME_SUCCESS)
+            key_pool.report(session.api_key)
+
+            if not images:
+                # 空响应不会进入对话历史，对话仍停在上一张海报
+                raise ValueError("模型没有返回图片，可能触发了内容安全过滤，请换个说法")
+
+            session.chat = chat
+            session.poster = images[0]
+            session.instructions = (session.instructions + [instruction])[-self.max_turns:]
+            session.turns += 1
+            self._trim(session)
+            print(f"微调完成（第 {session.turns} 轮，耗时 {time.monotonic() - started:.1f} 秒）")
+            _save_refined(images[0])
+            return images[0]
+
+    def refine_many(self, poster_ids: List[str], instruction: str, max_workers: int = 4) -> Dict[str, Image.Image]:
+        """
+        对多张海报并发发送同一条修改指令
+
+        返回:
+            Dict[str, Image.Image]: 修改成功的海报（失败的海报保持原样，不出现在结果中）
+        """
+        def run(poster_id: str) -> Optional[Image.Image]:
+            try:
+                return self.refine(poster_id, instruction)
+            except Exception as e:
+                print(f"海报 {poster_id} 微调失败: {str(e)}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(poster_ids) or 1))) as executor:
+            images = list(executor.map(run, poster_ids))
+        return {poster_id: image for poster_id, image in zip(poster_ids, images) if image is not None}
+
+    def _trim(self, session: _RefineSession):
+        """
+        用「摘要 + 修改指令」与模型最新一轮的回复重建对话，之前的海报不再随每轮上传
+
+        模型轮原样保留（含 thought signature），只替换它之前的用户轮
+        """
+        latest = session.chat.get_history(curated=True)[-1]
+        history = [types.Content(role="user", parts=[types.Part.from_text(text=session.context_text())]), latest]
+        session.chat = get_client(session.api_key).chats.create(
+            model=IMAGE_MODEL, config=session.config, history=history
+        )
+
+    def stats(self) -> Dict:
+        """缓存中的对话数与累计微调轮数"""
+        with self._lock:
+            self._evict()
+            return {
+                "sessions": len(self._sessions),
+                "turns": sum(session.turns for session in self._sessions.values())
+            }
+
+
+def _save_refined(image: Image.Image):
+    """保存微调后的海报到本地"""
+    output_dir = "generated_posters"
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    output_path = os.path.join(output_dir, f"poster_{timestamp}_refined.png")
+    image.save(output_path)
+    print(f"已保存: {output_path}")
+
+
+# 进程内共享的微调对话管理器
+refine_manager = RefineManager()
@@ -0,0 +1,262 @@
+# MirrorPost AI - 多比例改版模块
+# 把选定的海报在本地改成其他纵横比：按显著性图做内容感知裁剪，不足的部分用边缘延展填充；
+# 本地结果达不到质量阈值时才交给模型重绘
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image, ImageFilter
+
+# 加载环境变量
+load_dotenv()
+
+# 可改版的纵横比（与生成设置中的选项一致）
+RELAYOUT_RATIOS = ("9:16", "16:9", "1:1", "3:4", "4:3")
+
+# 本地改版的质量阈值（0-1），低于阈值时调用模型重绘
+QUALITY_THRESHOLD = float(os.getenv("MIRRORPOST_RELAYOUT_QUALITY", "0.75"))
+
+# 显著性图的分辨率（长边像素），只用于选择裁剪窗口
+SALIENCY_SIDE = 256
+
+# 填充面积对质量的基础惩罚（填充区域越大、被延展的边缘越杂乱，质量越低）
+PAD_PENALTY = 0.5
+
+# 裁掉显著内容的额外惩罚：每裁掉 1% 的显著性，质量再扣 LOSS_PENALTY%（标题、二维码被裁掉一部分就不可用）
+LOSS_PENALTY = 3.0
+
+# 宽高比变化超过该倍数（如 9:16 改 16:9 约为 3.2 倍）时本地只能大幅裁剪或填充，直接交给模型重绘
+MAX_LOCAL_CHANGE = float(os.getenv("MIRRORPOST_RELAYOUT_MAX_CHANGE", "1.8"))
+
+
+class RelayoutResult:
+    """单个比例的改版结果"""
+
+    def __init__(self, image: Image.Image, aspect_ratio: str, method: str, quality: float):
+        self.image = image
+        self.aspect_ratio = aspect_ratio
+        self.method = method  # "original" / "crop" / "crop+pad" / "pad" / "model"
+        self.quality = quality  # 本地改版的质量估计（交给模型重绘时为本地结果的质量）
+
+
+def parse_ratio(aspect_ratio: str) -> float:
+    """把 "9:16" 形式的纵横比转换为宽高比"""
+    width, height = aspect_ratio.split(":")
+    return float(width) / float(height)
+
+
+def ratio_change(image: Image.Image, aspect_ratio: str) -> float:
+    """海报改成目标纵横比时宽高比变化的倍数（>= 1）"""
+    target = parse_ratio(aspect_ratio)
+    source = image.width / image.height
+    return max(target / source, source / target)
+
+
+def saliency_map(image: Image.Image, max_side: int = SALIENCY_SIDE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    计算缩小后的显著性图
+
+    显著性 = 与背景色（各通道中位数）的颜色差 + 灰度梯度幅值（文字、主体边缘），两项各自归一化后相加
+
+    参数:
+        image (Image.Image): 海报
+        max_side (int): 计算分辨率的长边像素
+
+    返回:
+        tuple: (显著性图（总和为 1）, 灰度图（0-1）)，尺寸相同
+    """
+    small = image.convert("RGB")
+    small.thumbnail((max_side, max_side))
+    rgb = np.asarray(small, dtype=np.float32) / 255.0
+
+    contrast = np.linalg.norm(rgb - np.median(rgb.reshape(-1, 3), axis=0), axis=2)
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    grad_y, grad_x = np.gradient(gray)
+    edges = np.hypot(grad_x, grad_y)
+
+    saliency = contrast / (contrast.max() + 1e-6) + edges / (edges.max() + 1e-6)
+    return saliency / (saliency.sum() + 1e-12), gray
+
+
+def _plan_narrow(saliency: np.ndarray, gray: np.ndarray, target: float) -> Tuple[int, int, float, float]:
+    """
+    在显著性图上为「变窄」的改版选择裁剪宽度与位置
+
+    从正好裁到目标比例（不填充）到完全不裁（只填充），逐个宽度取保留显著性最多的窗口，
+    按「(保留的显著性 - LOSS_PENALTY × 裁掉的显著性) ×（1 - 填充比例 × (PAD_PENALTY + 上下边缘杂乱度)）」选出最优宽度
+
+    返回:
+        tuple: (窗口宽度, 窗口起点, 保留的显著性, 质量)，单位为显著性图的列
+    """
+    height, width = saliency.shape
+    profile = np.concatenate([[0.0], np.cumsum(saliency.sum(axis=0))])
+    min_width = min(width, max(1, int(round(height * target))))
+
+    best = (width, 0, 1.0, -1.0)
+    for window in range(min_width, width + 1):
+        sums = profile[window:] - profile[:-window]
+        start = int(np.argmax(sums))
+        kept = float(sums[start])
+
+        # 裁剪后仍比目标宽，需要在上下填充
+        pad = 1.0 - height * target / window
+        edge_rows = max(1, height // 50)
+        strip = np.concatenate([gray[:edge_rows, start:start + window], gray[-edge_rows:, start:start + window]])
+        busy = min(1.0, float(strip.std()) * 4)
+        quality = (kept - LOSS_PENALTY * (1.0 - kept)) * (1.0 - max(0.0, pad) * (PAD_PENALTY + busy))
+        if quality > best[3]:
+            best = (window, start, kept, quality)
+    return best
+
+
+def _edge_pad(pixels: np.ndarray, top: int, bottom: int) -> Image.Image:
+    """上下边缘延展填充，并把延展区域模糊后羽化接缝，避免出现拉丝条纹"""
+    padded = np.pad(pixels, ((top, bottom), (0, 0), (0, 0)), mode="edge")
+    image = Image.fromarray(padded)
+    radius = max(2, max(top, bottom) // 6)
+
+    # 模糊结果只有低频内容，缩小后模糊再放大，大半径时耗时降低一个数量级
+    factor = max(1, radius // 4)
+    small = image.resize((max(1, image.width // factor), max(1, image.height // factor)), Image.BILINEAR)
+    blurred = small.filter(ImageFilter.GaussianBlur(radius / factor)).resize(image.size, Image.BILINEAR)
+
+    # 蒙版：原图区域为 0，离接缝越远越接近 255
+    height = padded.shape[0]
+    rows = np.arange(height, dtype=np.float32)
+    distance = np.maximum(top - rows, rows - (height - bottom - 1))
+    feather = max(1.0, radius / 2)
+    ramp = np.clip(distance / feather, 0.0, 1.0) * 255
+    mask = Image.fromarray(np.repeat(ramp[:, None], padded.shape[1], axis=1).astype(np.uint8))
+    return Image.composite(blurred, image, mask)
+
+
+def relayout(image: Image.Image, aspect_ratio: str) -> RelayoutResult:
+    """
+    在本地把海报改成另一个纵横比（不调用模型）
+
+    参数:
+        image (Image.Image): 海报
+        aspect_ratio (str): 目标纵横比，如 "1:1"
+
+    返回:
+        RelayoutResult: 改版结果与质量估计
+    """
+    rgb = image.convert("RGB")
+    target = parse_ratio(aspect_ratio)
+    source = rgb.width / rgb.height
+    if abs(target - source) < 0.01:
+        return RelayoutResult(rgb.copy(), aspect_ratio, "original", 1.0)
+
+    pixels = np.asarray(rgb)
+    saliency, gray = saliency_map(rgb)
+
+    # 变宽的改版转置后按变窄处理，最后再转置回来
+    wider = target > source
+    if wider:
+        pixels = pixels.transpose(1, 0, 2)
+        saliency, gray = saliency.T, gray.T
+        target = 1.0 / target
+
+    window, start, kept, quality = _plan_narrow(saliency, gray, target)
+
+    # 显著性图的列换算为像素列
+    height, width = pixels.shape[:2]
+    scale = width / saliency.shape[1]
+    crop_width = min(width, max(int(round(height * target)), int(round(window * scale))))
+    crop_start = min(width - crop_width, int(round(start * scale)))
+    cropped = pixels[:, crop_start:crop_start + crop_width]
+
+    padded_height = max(height, int(round(crop_width / target)))
+    pad_total = padded_height - height
+    if pad_total > 0:
+        result = _edge_pad(np.ascontiguousarray(cropped), pad_total // 2, pad_total - pad_total // 2)
+        method = "pad" if crop_width == width else "crop+pad"
+    else:
+        result = Image.fromarray(np.ascontiguousarray(cropped))
+        method = "crop"
+
+    if wider:
+        result = result.transpose(Image.Transpose.TRANSPOSE)
+    return RelayoutResult(result, aspect_ratio, method, quality)
+
+
+def relayout_poster(
+    image: Image.Image,
+    aspect_ratio: str,
+    fallback: Optional[Callable[[Image.Image, str], Image.Image]] = None,
+    threshold: float = QUALITY_THRESHOLD
+) -> RelayoutResult:
+    """
+    改版一张海报：先在本地改版，质量低于阈值或宽高比变化超过 MAX_LOCAL_CHANGE 时交给模型重绘
+
+    参数:
+        image (Image.Image): 海报
+        aspect_ratio (str): 目标纵横比
+        fallback (Callable): fallback(本地改版结果, 纵横比) -> 模型重绘的海报；为 None 时总是使用本地结果
+        threshold (float): 质量阈值
+
+    返回:
+        RelayoutResult: 改版结果（模型重绘失败时退回本地结果）
+    """
+    local = relayout(image, aspect_ratio)
+    change = ratio_change(image, aspect_ratio)
+    if fallback is None or (local.quality >= threshold and change <= MAX_LOCAL_CHANGE):
+        return local
+
+    if change > MAX_LOCAL_CHANGE:
+        print(f"[Relayout] {aspect_ratio} 宽高比变化 {change:.1f} 倍，交给模型重绘")
+    else:
+        print(f"[Relayout] {aspect_ratio} 本地改版质量 {local.quality:.2f} 低于阈值 {threshold:.2f}，交给模型重绘")
+    try:
+        return RelayoutResult(fallback(local.image, aspect_ratio), aspect_ratio, "model", local.quality)
+    except Exception as e:
+        print(f"[Relayout] {aspect_ratio} 模型重绘失败，使用本地结果: {str(e)}")
+        return local
+
+
+def relayout_all(
+    image: Image.Image,
+    aspect_ratios: List[str],
+    fallback: Optional[Callable[[Image.Image, str], Image.Image]] = None,
+    max_workers: int = 4
+) -> Dict[str, RelayoutResult]:
+    """
+    把一张海报改成多个纵横比（需要模型重绘的比例并发执行）
+
+    参数:
+        image (Image.Image): 海报
+        aspect_ratios (List[str]): 目标纵横比列表
+        fallback (Callable): 同 relayout_poster
+        max_workers (int): 最大并发数
+
+    返回:
+        Dict[str, RelayoutResult]: 纵横比 -> 改版结果（保持传入顺序）
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(aspect_ratios)))) as executor:
+        futures = {
+            ratio: executor.submit(relayout_poster, image, ratio, fallback) for ratio in aspect_ratios
+        }
+        return {ratio: future.result() for ratio, future in futures.items()}
+
+
+def save_relayouts(results: Dict[str, RelayoutResult], output_dir: str = "generated_posters") -> List[str]:
+    """
+    保存改版结果到本地
+
+    返回:
+        List[str]: 保存的文件路径（文件名带纵横比，如 poster_..._16x9.png）
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    paths = []
+    for ratio, result in results.items():
+        output_path = os.path.join(output_dir, f"poster_{timestamp}_{ratio.replace(':', 'x')}.png")
+        result.image.save(output_path)
+        print(f"已保存: {output_path}")
+        paths.append(output_path)
+    return paths